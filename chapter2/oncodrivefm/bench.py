@@ -0,0 +1,214 @@
+"""
+OncodriveFM benchmarks
+
+Generates a synthetic cohort (a TDM matrix and a mapping of rows into groups),
+runs the analysis end to end and reports the time spent in every phase and the peak memory as JSON.
+The samplings are seeded, so runs with the same parameters are comparable.
+
+	$ python bench.py --rows 20000 --cols 500 --density 0.01 --groups 1000 -N 10000 -o bench.json
+"""
+
+import os
+import os.path
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import resource
+
+from datetime import datetime
+
+import numpy as np
+
+from bgcore import tsv
+
+from oncodrivefm import VERSION, tdm
+from oncodrivefm.analysis import OncodriveFmAnalysis
+from oncodrivefm.mapping import MatrixMapping
+from oncodrivefm.method import create_method
+from oncodrivefm.scheduler import Scheduler
+
+def generate_matrix(path, num_rows, num_cols, num_slices, density, rs):
+	"""
+	Writes a random TDM matrix where each cell has a value with probability density
+	"""
+
+	slice_names = ["SLICE{0}".format(i) for i in xrange(num_slices)]
+
+	with open(path, "w") as f:
+		f.write("\t".join(["COLUMN", "ROW"] + slice_names) + "\n")
+
+		# Generated by blocks of rows to keep the memory bounded
+		block_rows = max(1, 2 ** 20 // max(num_cols, 1))
+		for start in xrange(0, num_rows, block_rows):
+			end = min(start + block_rows, num_rows)
+			rows, cols = np.nonzero(rs.random_sample((end - start, num_cols)) < density)
+			values = rs.random_sample((rows.size, num_slices))
+			lines = ["C{0}\tR{1}\t{2}\n".format(col, start + row, "\t".join("{0:.4f}".format(v) for v in vs))
+						for row, col, vs in zip(rows, cols, values)]
+			f.writelines(lines)
+
+def generate_mapping(num_rows, num_groups, group_size, rs):
+	"""
+	Returns {group_name : [row_names]} with random groups
+	"""
+
+	if num_groups == 0:
+		return dict(("R{0}".format(row), ["R{0}".format(row)]) for row in xrange(num_rows))
+
+	return dict(("G{0}".format(group), ["R{0}".format(row) for row in rs.randint(0, num_rows, group_size)])
+				for group in xrange(num_groups))
+
+def save_results(path, mapping, method, results, slice_names):
+	for slice_results_index, slice_name in enumerate(slice_names):
+		with tsv.open(os.path.join(path, "results-{0}.tsv".format(slice_name)), "w") as f:
+			tsv.write_line(f, "ID", *method.results_columns)
+			for row_index, row_name in enumerate(mapping.group_names):
+				value = results[slice_results_index, row_index]
+				if not np.isnan(value):
+					tsv.write_line(f, row_name, value, null_value="-")
+
+def peak_memory():
+	"""
+	Peak resident memory in MB of this process and its children
+	"""
+
+	self_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	children_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+	return dict(process=self_kb / 1024.0, workers=children_kb / 1024.0)
+
+def run(args):
+	rs = np.random.RandomState(args.seed)
+
+	tmp_path = tempfile.mkdtemp(prefix="oncodrivefm-bench-")
+
+	try:
+		data_path = os.path.join(tmp_path, "data.tdm")
+
+		start_time = time.time()
+		generate_matrix(data_path, args.num_rows, args.num_cols, args.num_slices, args.density, rs)
+		generation_time = time.time() - start_time
+
+		# Wall time of every phase, they run one after the other
+		timings = {}
+
+		run_start_time = start_time = time.time()
+		matrix = tdm.load_matrix(data_path, sparse=args.sparse)
+		timings["load"] = time.time() - start_time
+
+		group_row_names = generate_mapping(args.num_rows, args.num_groups, args.group_size, rs)
+
+		start_time = time.time()
+		mapping = MatrixMapping(matrix, group_row_names)
+		timings["mapping"] = time.time() - start_time
+
+		test = "zscore" if args.num_groups > 0 else "empirical"
+		method_name = "{0}-{1}".format(args.estimator, test)
+		method = create_method(method_name)
+
+		analysis = OncodriveFmAnalysis(
+			"oncodrivefm.bench",
+			num_samplings=args.num_samplings,
+			mut_threshold=args.mut_threshold,
+			num_cores=args.num_cores,
+			adaptive_exceedances=args.adaptive_exceedances,
+			seed=args.seed)
+
+		slices = range(matrix.num_slices)
+
+		# Starting and stopping the workers
+		start_time = time.time()
+		scheduler = Scheduler(args.num_cores)
+		timings["workers"] = time.time() - start_time
+
+		try:
+			# Counting the mutations, calculating the observed values and publishing the backgrounds
+			start_time = time.time()
+			results = analysis.submit(scheduler, matrix, mapping, method_name, slices)
+			timings["preparation"] = time.time() - start_time
+
+			# Waiting for the samplings, the comparisons are done meanwhile as they complete
+			start_time = time.time()
+			scheduler.wait()
+			timings["sampling"] = time.time() - start_time
+		finally:
+			start_time = time.time()
+			scheduler.close()
+			timings["workers"] += time.time() - start_time
+
+		start_time = time.time()
+		method.combine(results.T)
+		timings["combination"] = time.time() - start_time
+
+		start_time = time.time()
+		save_results(tmp_path, mapping, method, results, matrix.slice_names)
+		timings["output"] = time.time() - start_time
+
+		timings["total"] = time.time() - run_start_time
+
+		return dict(
+			version=VERSION,
+			date=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+			params=dict(
+				rows=args.num_rows, cols=args.num_cols, slices=args.num_slices, density=args.density,
+				groups=args.num_groups, group_size=args.group_size, samplings=args.num_samplings,
+				threshold=args.mut_threshold, estimator=args.estimator, method=method_name,
+				cores=args.num_cores, sparse=args.sparse, adaptive=args.adaptive_exceedances, seed=args.seed),
+			data=dict(
+				file_size=os.path.getsize(data_path),
+				values=int(sum(matrix.slice_rows(slice)[1].size for slice in slices)),
+				generation_time=generation_time),
+			timings=timings,
+			# Time spent in every step of the analysis, the comparison overlaps the sampling
+			analysis_timings=analysis.timings,
+			peak_memory=peak_memory())
+	finally:
+		shutil.rmtree(tmp_path, ignore_errors=True)
+
+def main():
+	parser = argparse.ArgumentParser(prog="bench.py", description="OncodriveFM benchmarks with synthetic cohorts")
+
+	parser.add_argument("--rows", dest="num_rows", type=int, default=5000, metavar="N",
+						help="Number of rows (genes)")
+	parser.add_argument("--cols", dest="num_cols", type=int, default=200, metavar="N",
+						help="Number of columns (samples)")
+	parser.add_argument("--slices", dest="num_slices", type=int, default=3, metavar="N",
+						help="Number of slices (scores)")
+	parser.add_argument("--density", dest="density", type=float, default=0.01, metavar="RATIO",
+						help="Ratio of cells with a value")
+	parser.add_argument("--groups", dest="num_groups", type=int, default=0, metavar="N",
+						help="Number of random groups of rows (pathways). By default rows are analysed one by one")
+	parser.add_argument("--group-size", dest="group_size", type=int, default=50, metavar="N",
+						help="Number of rows of each group")
+	parser.add_argument("-N", "--samplings", dest="num_samplings", type=int, default=10000, metavar="N",
+						help="Number of samplings")
+	parser.add_argument("-t", "--threshold", dest="mut_threshold", type=int, default=2, metavar="N",
+						help="Minimum number of mutations")
+	parser.add_argument("-e", "--estimator", dest="estimator", choices=["mean", "median"], default="mean",
+						help="Test estimator")
+	parser.add_argument("-j", "--cores", dest="num_cores", type=int, metavar="N",
+						help="Number of cores. By default all the available cores")
+	parser.add_argument("--sparse", dest="sparse", default=False, action="store_true",
+						help="Load the matrix as a sparse matrix")
+	parser.add_argument("--adaptive", dest="adaptive_exceedances", type=int, metavar="EXCEEDANCES",
+						help="Use adaptive sampling")
+	parser.add_argument("--seed", dest="seed", type=int, default=0,
+						help="Seed used to generate the synthetic cohort and the samplings")
+	parser.add_argument("-o", "--output", dest="output_path", metavar="PATH",
+						help="File where the JSON report is written. By default the standard output")
+
+	args = parser.parse_args()
+
+	report = run(args)
+
+	if args.output_path is not None:
+		with open(args.output_path, "w") as f:
+			json.dump(report, f, indent=2, sort_keys=True)
+	else:
+		json.dump(report, sys.stdout, indent=2, sort_keys=True)
+		sys.stdout.write("\n")
+
+if __name__ == "__main__":
+	main()
@@ -1,12 +1,9 @@
 import os.path
 import logging
-import random
 import math
 import time
 
-from itertools import repeat
-
-import multiprocessing as mp
+from functools import partial
 
 import numpy as np
 from scipy import stats
@@ -14,118 +11,403 @@ from statsmodels.sandbox.stats.multicomp import multipletests
 
 from mapping import MatrixMapping
 from method.factory import create_method
+from sampling import sample_estimations
+from background import attach_background
+from scheduler import Scheduler
+from cache import NullCache
+from segments import segment_counts, segment_take
+
+# Number of samplings computed by each task sent to the workers
+SAMPLINGS_PER_TASK = 1000
+
+# Number of samplings of the first round of the adaptive sampling, next rounds double it
+ADAPTIVE_FIRST_ROUND = 100
 
 def sampling(params):
-	method, data, count = params
-	return method.estimator(random.sample(data, count))
+	method, background_path, count, num_samplings, seed = params
+	data = attach_background(background_path)
+	# Forked workers share the parent random state, each task needs its own one.
+	# Without seed it is initialized from the system entropy.
+	rs = np.random.RandomState(seed)
+	return sample_estimations(method.estimators, data, count, num_samplings, rs)
 
 class OncodriveFmAnalysis(object):
 
-	def __init__(self, log_name, num_samplings, mut_threshold, num_cores=None):
+	def __init__(self, log_name, num_samplings, mut_threshold, num_cores=None, cache_path=None,
+				 adaptive_exceedances=None, seed=None):
+		"""
+		:param seed: When defined every sampling task has its own random stream derived from this seed,
+		the background values, the mutations count and the position of its samplings,
+		so the results are reproducible whatever the number of cores or the order of completion.
+		:param adaptive_exceedances: When defined the samplings are drawn in rounds until the group with
+		the highest observed value of each mutations count has at least this number of samplings greater
+		or equal than it (Besag-Clifford sequential rule) or num_samplings is reached.
+		"""
+
 		self.num_samplings = num_samplings
 		self.mut_threshold = mut_threshold
 		self.num_cores = num_cores
+		self.adaptive_exceedances = adaptive_exceedances
+		self.seed = seed
+
+		self.cache = NullCache(cache_path) if cache_path is not None else None
+
+		# Accumulated seconds spent in the counting, observed and comparison phases
+		self.timings = dict(counting=0.0, observed=0.0, comparison=0.0)
 
 		self.log = logging.getLogger(log_name)
 
-	def _count_mutations(self, valid_data, slice, mapping):
+	def _count_mutations(self, row_counts, mapping):
 		"""
-		Counts the number of mutations for each group in the given slice of valid_data
-		:param valid_data: [slice, gene, sample] masked for nan's
-		:param slice: the slice to count
+		Counts the number of mutations for each group
+		:param row_counts: [rows] the number of mutations of each matrix row
 		:param mapping: a MatrixMapping with groups which mutations has to be counted
-		:return: [(mut_count, [group_indices])]
+		:return: [(mut_count, [group_indices])], sorted group indices with mutations over the threshold
 		"""
 
-		# Create a dictionary for each slice where each key represents a mutations count over the mutations threshold
-		# and each value a list of group indices with that mutations count [{mut_count : [group_indices]}]
+		group_counts = segment_counts(row_counts[mapping.group_rows], mapping.group_indptr)
 
-		group_counts = {}
+		group_indices = np.nonzero(group_counts >= self.mut_threshold)[0]
 
-		for group_index, group_rows in mapping.group_row_indices.items(): #TODO parallelize
+		# Group the indices by mutations count into an ordered list of tuples sorted by mut_count
 
-			mut_count = valid_data[slice, group_rows, :].count()
+		order = np.argsort(group_counts[group_indices], kind="mergesort")
+		sorted_indices = group_indices[order]
+		sorted_counts = group_counts[sorted_indices]
 
-			if mut_count >= self.mut_threshold:
-				if mut_count in group_counts:
-					group_counts[mut_count] += [group_index]
-				else:
-					group_counts[mut_count] = [group_index]
+		bounds = np.nonzero(np.diff(sorted_counts))[0] + 1
 
-		# Convert the group_counts dictionary {mut_count : [group_indices]}
-		# into an ordered list of tuples sorted by mut_count [(mut_count, [group_indices])]
+		mut_counts = [(int(indices_counts[0]), indices.tolist())
+						for indices, indices_counts in zip(np.split(sorted_indices, bounds), np.split(sorted_counts, bounds))
+						if indices.size > 0]
 
-		total_group_indices = set()
+		return mut_counts, group_indices
 
-		mut_counts = []
-		for mut_count, group_indices in sorted(group_counts.items(), key=lambda p:p[0]):
-			mut_counts += [(mut_count, group_indices)]
-			total_group_indices.update(group_indices)
+	def compute(self, matrix, mapping, method, slices, slice_completed=None, keep_results=True):
 
-		return mut_counts, sorted(total_group_indices)
+		scheduler = Scheduler(self.num_cores)
 
-	def compute(self, matrix, mapping, method, slices):
+		try:
+			results = self.submit(scheduler, matrix, mapping, method, slices, slice_completed, keep_results)
+			scheduler.wait()
+		finally:
+			scheduler.close()
 
-		num_slices = len(slices)
+		return results
 
-		valid_data = np.ma.masked_invalid(matrix.data)
+	def submit(self, scheduler, matrix, mapping, method, slices, slice_completed=None, keep_results=True):
+		"""
+		Submits the analysis to a scheduler that can be shared with other analyses.
+		The results are only complete after the scheduler has finished waiting.
+		:param slice_completed: function called with the slice results index and the slice results as soon as
+		the results of that slice are complete, usually from the scheduler callbacks
+		:param keep_results: when False the results of every slice are only referenced until
+		they are passed to slice_completed, so they are released once it has done with them
+		:return: the results array, or None when the results are not kept
+		"""
+
+		num_slices = len(slices)
 
 		method = create_method(method)
 		if method is None:
 			raise Exception("Unknown test method: {0}".format(method))
 
-		results = method.create_results(num_slices, mapping.num_groups)
-
-		pool = mp.Pool(self.num_cores)
+		results = method.create_results(num_slices, mapping.num_groups) if keep_results else None
 
 		for slice_results_index, slice in enumerate(slices):
+			slice_results = self._slice_results(method, mapping, results, slice_results_index)
+			completed = None
+			if slice_completed is not None:
+				completed = partial(slice_completed, slice_results_index, slice_results)
+			self._submit_slice(scheduler, matrix, mapping, method, slice, slice_results, completed)
+
+		return results
+
+	def _slice_results(self, method, mapping, results, slice_results_index):
+		"""
+		Returns the results array of a slice, a new one when the results of all the slices are not kept
+		"""
+
+		if results is None:
+			return method.create_results(1, mapping.num_groups)[0]
+
+		return results[slice_results_index]
+
+	def _prepare_slice(self, matrix, mapping, method, slice):
+		"""
+		Counts the mutations and calculates the observed estimator of every group
+		:return: (background, mut_counts, observed)
+		"""
+
+		self.log.info("[{0}]".format(matrix.slice_names[slice]))
+
+		# Valid values by rows, the ones of row i are background[indptr[i]:indptr[i + 1]]
+		indptr, background = matrix.slice_rows(slice)
+
+		self.log.info("  Counting mutations ...")
+
+		start_time = time.time()
+
+		mut_counts, group_indices = self._count_mutations(np.diff(indptr), mapping)
+
+		self.timings["counting"] += time.time() - start_time
+
+		self.log.info("  Calculating observed estimator ...")
+
+		start_time = time.time()
+
+		observed = np.empty(mapping.num_groups)
+		observed[:] = np.nan
+
+		# Gather the values of the rows of every group and reduce them by group
+		entries, entries_indptr = segment_take(mapping.group_indptr, group_indices)
+		values, values_indptr = segment_take(indptr, mapping.group_rows[entries])
+		observed[group_indices] = method.observed_segments(background[values], values_indptr[entries_indptr])
+
+		self.timings["observed"] += time.time() - start_time
+
+		return background, mut_counts, observed
+
+	def _sampling_seed(self, background_digest, mut_count):
+		"""
+		Seed of the random streams of a null distribution, every task appends the offset of its first sampling
+		"""
+
+		if self.seed is None:
+			return None
+
+		return [self.seed, int(background_digest[:8], 16), mut_count]
+
+	def _submit_slice(self, scheduler, matrix, mapping, method, slice, results, completed=None):
+
+		background, mut_counts, observed = self._prepare_slice(matrix, mapping, method, slice)
+
+		self.log.info("  Bootstrapping with {0} repetitions ...".format(self.num_samplings))
+
+		# Only the path of the published background is sent to the workers
+		background_path = scheduler.store.publish(background)
+
+		if self.cache is not None or self.seed is not None:
+			background_digest = NullCache.background_digest(background)
+
+		samplings = []
 
-			self.log.info("[{0}]".format(matrix.slice_names[slice]))
+		for mut_count, group_indices in mut_counts:
+			self.log.debug("    With {0} mutations -> {1} groups ...".format(mut_count, len(group_indices)))
 
-			self.log.info("  Counting mutations ...")
+			cache_key = None
+			if self.cache is not None:
+				cache_key = self.cache.key(background_digest, method.ESTIMATOR, mut_count, self.num_samplings, self.seed)
+				cached_estimations = self.cache.get(cache_key)
+				if cached_estimations is not None:
+					start_time = time.time()
+					results[group_indices] = method.compare(observed[group_indices], cached_estimations)
+					self.timings["comparison"] += time.time() - start_time
+					continue
 
-			mut_counts, group_indices = self._count_mutations(valid_data, slice, mapping)
+			seed = self._sampling_seed(background_digest, mut_count) if self.seed is not None else None
 
-			self.log.info("  Calculating observed estimator ...")
+			samplings += [NullSampling(self, scheduler, method, background_path, mut_count,
+									   group_indices, observed[group_indices], results, cache_key, seed)]
 
-			observed = np.empty(mapping.num_groups)
-			observed[:] = np.nan
+		# The slice is completed when the last of its null samplings is, then its background is not needed anymore
+		def slice_completed():
+			scheduler.store.release(background_path)
+			if completed is not None:
+				completed()
+
+		if len(samplings) == 0:
+			slice_completed()
+		else:
+			pending = [len(samplings)]
+			def sampling_completed():
+				pending[0] -= 1
+				if pending[0] == 0:
+					slice_completed()
+
+			for null_sampling in samplings:
+				null_sampling.completed = sampling_completed
+
+		for null_sampling in samplings:
+			null_sampling.start()
+
+	def plan(self, store, matrix, mapping, method, slices, shard_size):
+		"""
+		Splits the samplings of the analysis into shards saved into a ShardStore,
+		to be run by independent workers and merged with reduce.
+		:param shard_size: the maximum number of samplings of every shard,
+		rounded up to a multiple of the samplings per task so results match a local analysis with the same seed
+		:return: the number of shards
+		"""
+
+		method = create_method(method)
+		if method is None:
+			raise Exception("Unknown test method: {0}".format(method))
 
-			for group_index in group_indices: #TODO parallelize
-				group_rows = mapping.group_row_indices[group_index]
-				observed[group_index] = method.observed(valid_data[slice, group_rows, :])
+		shard_size = max(1, int(math.ceil(float(shard_size) / SAMPLINGS_PER_TASK))) * SAMPLINGS_PER_TASK
 
-			self.log.info("  Bootstrapping with {0} repetitions ...".format(self.num_samplings))
+		store.create(self._plan_params(matrix, method, slices))
 
-			background = valid_data[slice].compressed().tolist()
+		num_shards = 0
+		for slice in slices:
+			background, mut_counts, observed = self._prepare_slice(matrix, mapping, method, slice)
 
-			estimations = np.empty(self.num_samplings)
+			background_path = store.add_background(background)
+			background_digest = NullCache.background_digest(background)
 
 			for mut_count, group_indices in mut_counts:
-				self.log.debug("    With {0} mutations -> {1} groups ...".format(mut_count, len(group_indices)))
+				num_shards += store.add_distribution(matrix.slice_names[slice], background_digest, background_path,
+													 method.name, mut_count, self.num_samplings, shard_size,
+													 self._sampling_seed(background_digest, mut_count))
+
+		store.save()
+
+		return num_shards
+
+	def reduce(self, store, matrix, mapping, method, slices, slice_completed=None, keep_results=True):
+		"""
+		Merges the samplings of the shards of a plan and compares the observed values with them.
+		The analysis parameters have to match the ones used for the plan.
+		:param keep_results: see submit
+		:return: the results array, or None when the results are not kept
+		"""
 
+		method = create_method(method)
+		if method is None:
+			raise Exception("Unknown test method: {0}".format(method))
 
-				#for i in xrange(self.num_samplings):
-				#	sample = random.sample(background, mut_count)
-				#	sampling_estimations[i] = method.estimator(sample)
+		store.load()
 
-				iter = repeat((method, background, mut_count), self.num_samplings)
-				res = pool.map_async(sampling, iter)
+		params = self._plan_params(matrix, method, slices)
+		for key, value in params.items():
+			if store.params.get(key) != value:
+				raise Exception("The analysis {0} does not match the planned one: {1} != {2}".format(
+					key, value, store.params.get(key)))
 
-				while not res.ready():
-					try:
-						time.sleep(0.1)
-					except KeyboardInterrupt:
-						pool.terminate()
-						raise
+		results = method.create_results(len(slices), mapping.num_groups) if keep_results else None
 
-				estimations[:] = np.array(res.get())
+		for slice_results_index, slice in enumerate(slices):
+			slice_results = self._slice_results(method, mapping, results, slice_results_index)
 
-				results[slice_results_index, group_indices] = method.compare(observed[group_indices], estimations)
+			background, mut_counts, observed = self._prepare_slice(matrix, mapping, method, slice)
+			background_digest = NullCache.background_digest(background)
+
+			self.log.info("  Merging shards ...")
+
+			for mut_count, group_indices in mut_counts:
+				estimations = store.samples(matrix.slice_names[slice], background_digest, mut_count)
+
+				if self.cache is not None:
+					self.cache.put(self.cache.key(background_digest, method.ESTIMATOR, mut_count,
+												  self.num_samplings, self.seed), estimations)
+
+				start_time = time.time()
+				slice_results[group_indices] = method.compare(observed[group_indices], estimations)
+				self.timings["comparison"] += time.time() - start_time
+
+			if slice_completed is not None:
+				slice_completed(slice_results_index, slice_results)
+
+			del slice_results
 
 		return results
 
+	def _plan_params(self, matrix, method, slices):
+		return dict(
+			method=method.name,
+			num_samplings=self.num_samplings,
+			mut_threshold=self.mut_threshold,
+			seed=self.seed,
+			slices=[matrix.slice_names[slice] for slice in slices])
+
 	def combine(self, results, method):
 		method = create_method(method)
 
 		return method.combine(results)
+
+class NullSampling(object):
+	"""
+	Null distribution of a mutations count sampled by tasks in a scheduler.
+	Once completed the groups with that mutations count are compared with it.
+
+	With adaptive sampling the samplings are drawn in rounds of increasing size until all the groups are decided,
+	that is when the highest observed value has been reached at least adaptive_exceedances times.
+	Decided groups have an estimated pvalue of at least adaptive_exceedances / samplings drawn.
+	"""
+
+	def __init__(self, analysis, scheduler, method, background_path, mut_count,
+				 group_indices, observed, results, cache_key=None, seed=None):
+
+		self.analysis = analysis
+		self.scheduler = scheduler
+		self.method = method
+		self.background_path = background_path
+		self.mut_count = mut_count
+		self.group_indices = group_indices
+		self.observed = observed
+		self.results = results
+		self.cache_key = cache_key
+		self.seed = seed
+
+		# Function called once the groups have been compared
+		self.completed = None
+
+		self.adaptive = analysis.adaptive_exceedances is not None
+		self.max_observed = np.max(observed)
+
+		self.rounds = []
+		self.num_drawn = 0
+		self.num_exceedances = 0
+		self.round_size = ADAPTIVE_FIRST_ROUND if self.adaptive else analysis.num_samplings
+
+	def start(self):
+		self._submit_round()
+
+	def _submit_round(self):
+		round_size = min(self.round_size, self.analysis.num_samplings - self.num_drawn)
+		starts = range(0, round_size, SAMPLINGS_PER_TASK)
+
+		self._round = [None] * len(starts)
+		self._round_pending = len(starts)
+		round_offset = self.num_drawn
+		self.num_drawn += round_size
+
+		for task_index, start in enumerate(starts):
+			# The random stream of a task is identified by the position of its first sampling
+			seed = self.seed + [round_offset + start] if self.seed is not None else None
+			params = (self.method, self.background_path, self.mut_count, min(SAMPLINGS_PER_TASK, round_size - start), seed)
+			self.scheduler.submit(sampling, params, partial(self._task_completed, task_index))
+
+	def _task_completed(self, task_index, estimations):
+		self._round[task_index] = estimations
+		self._round_pending -= 1
+		if self._round_pending > 0:
+			return
+
+		estimations = np.concatenate(self._round)
+		self.rounds += [estimations]
+
+		if self.adaptive:
+			self.num_exceedances += np.count_nonzero(estimations >= self.max_observed)
+			if self.num_drawn < self.analysis.num_samplings and self.num_exceedances < self.analysis.adaptive_exceedances:
+				self.round_size *= 2
+				self._submit_round()
+				return
+
+			self.analysis.log.debug("    {0} mutations decided after {1} samplings".format(self.mut_count, self.num_drawn))
+
+		self._completed()
+
+	def _completed(self):
+		estimations = np.concatenate(self.rounds)
+
+		# Only complete distributions are cached
+		if self.cache_key is not None and self.num_drawn == self.analysis.num_samplings:
+			self.analysis.cache.put(self.cache_key, estimations)
+
+		start_time = time.time()
+		self.results[self.group_indices] = self.method.compare(self.observed, estimations)
+		self.analysis.timings["comparison"] += time.time() - start_time
+
+		if self.completed is not None:
+			self.completed()
@@ -0,0 +1,95 @@
+import os
+import os.path
+import shutil
+import tempfile
+
+from collections import OrderedDict
+
+import numpy as np
+
+# Shared memory file system, when available the backgrounds never hit the disk
+_SHM_PATH = "/dev/shm"
+
+# Maximum number of backgrounds kept attached by every process, the least recently used are detached first
+MAX_ATTACHED = 4
+
+# Backgrounds already attached by the current process in order of use {path : array}
+_attached = OrderedDict()
+
+class BackgroundStore(object):
+	"""
+	Publishes the background of each slice once into a memory-mapped file,
+	so the workers can attach to it read-only and only the path has to be sent with every task.
+	"""
+
+	def __init__(self, path=None):
+		"""
+		:param path: Directory where the backgrounds are written. By default the shared memory
+		file system if available, otherwise the system temporary directory.
+		"""
+
+		if path is None and os.path.isdir(_SHM_PATH):
+			path = _SHM_PATH
+
+		self.path = tempfile.mkdtemp(prefix="oncodrivefm-", dir=path)
+		self._count = 0
+
+	def publish(self, background):
+		"""
+		Publishes a background.
+		:param background: the array of background values
+		:return: the path to be used with attach_background
+		"""
+
+		path = os.path.join(self.path, "{0}.npy".format(self._count))
+		self._count += 1
+
+		np.save(path, np.ascontiguousarray(background))
+
+		return path
+
+	def release(self, path):
+		"""
+		Removes a published background once none of the pending tasks use it.
+		The workers detach it before their next task.
+		:param path: the path returned by publish
+		"""
+
+		if os.path.exists(path):
+			os.remove(path)
+
+	def close(self):
+		"""
+		Removes all the published backgrounds.
+		"""
+
+		shutil.rmtree(self.path, ignore_errors=True)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+def attach_background(path):
+	"""
+	Returns a read-only view of a published background. The view is kept for next calls
+	until its background is released or it is one of the least recently used.
+	:param path: the path returned by BackgroundStore.publish
+	"""
+
+	# The memory of a released background is only freed once every process has detached it
+	for attached_path in [p for p in _attached if p != path and not os.path.exists(p)]:
+		del _attached[attached_path]
+
+	if path in _attached:
+		data = _attached.pop(path)
+	else:
+		data = np.load(path, mmap_mode="r")
+
+	_attached[path] = data
+
+	while len(_attached) > MAX_ATTACHED:
+		_attached.popitem(last=False)
+
+	return data
@@ -0,0 +1,112 @@
+import json
+import struct
+
+import numpy as np
+
+from matrix import Matrix
+
+# Binary matrix container layout:
+#
+#   MAGIC (8 bytes)
+#   data offset (8 bytes, little endian)
+#   header (JSON: dtype, shape, slice_names, row_names, col_names, params)
+#   padding up to the data offset (multiple of ALIGNMENT)
+#   data [slices, rows, cols] in C order
+
+MAGIC = "OFMBMX01"
+
+EXTENSION = ".bmx"
+
+ALIGNMENT = 64
+
+DTYPES = ["float32", "float64"]
+
+def is_binary_matrix(path):
+	"""
+	Checks whether a file is a binary matrix container looking at its magic number
+	"""
+
+	try:
+		with open(path, "rb") as f:
+			return f.read(len(MAGIC)) == MAGIC
+	except IOError:
+		return False
+
+def save_matrix(matrix, path, dtype=None, params=None):
+	"""
+	Saves a matrix into a binary container
+	:param matrix: the Matrix to save
+	:param path: the destination path
+	:param dtype: float32 or float64, by default the one of the matrix data
+	:param params: [(key, value)] to be saved with the matrix
+	"""
+
+	dtype = np.dtype(dtype or matrix.dtype)
+	if dtype.name not in DTYPES:
+		raise Exception("Unsupported data type for binary matrices: {0}".format(dtype.name))
+
+	header = dict(
+		dtype=dtype.str,
+		shape=[matrix.num_slices, matrix.num_rows, matrix.num_cols],
+		slice_names=list(matrix.slice_names or []),
+		row_names=list(matrix.row_names or []),
+		col_names=list(matrix.col_names or []),
+		params=[(str(key), str(value)) for key, value in params or []])
+
+	header_data = json.dumps(header)
+	offset = len(MAGIC) + 8 + len(header_data)
+	offset += (ALIGNMENT - offset % ALIGNMENT) % ALIGNMENT
+
+	with open(path, "wb") as f:
+		f.write(MAGIC)
+		f.write(struct.pack("<Q", offset))
+		f.write(header_data)
+		f.write(" " * (offset - f.tell()))
+
+	# Write slice by slice so matrices larger than the available memory can be converted
+	if matrix.num_slices * matrix.num_rows * matrix.num_cols > 0:
+		data = np.memmap(path, dtype=dtype, mode="r+", offset=offset,
+						 shape=(matrix.num_slices, matrix.num_rows, matrix.num_cols))
+		for slice in xrange(matrix.num_slices):
+			data[slice] = matrix.dense_slice(slice)
+		data.flush()
+		del data
+
+def _read_header(path):
+	with open(path, "rb") as f:
+		if f.read(len(MAGIC)) != MAGIC:
+			raise Exception("Not a binary matrix: {0}".format(path))
+		offset = struct.unpack("<Q", f.read(8))[0]
+		header = json.loads(f.read(offset - len(MAGIC) - 8))
+	return offset, header
+
+def load_params(path):
+	"""
+	Returns the parameters saved with a binary matrix as a dictionary
+	"""
+
+	offset, header = _read_header(path)
+	return dict((key.encode("utf-8"), value.encode("utf-8")) for key, value in header.get("params", []))
+
+def load_matrix(path, mode="r"):
+	"""
+	Opens a binary matrix container. The data is memory-mapped so only the name tables are read.
+	:param path: the container path
+	:param mode: the numpy.memmap mode, read-only by default
+	"""
+
+	offset, header = _read_header(path)
+
+	num_slices, num_rows, num_cols = header["shape"]
+	dtype = np.dtype(str(header["dtype"]))
+
+	if num_slices * num_rows * num_cols > 0:
+		data = np.memmap(path, dtype=dtype, mode=mode, offset=offset, shape=(num_slices, num_rows, num_cols))
+	else:
+		data = np.empty((num_slices, num_rows, num_cols), dtype=dtype)
+
+	names = lambda key: [name.encode("utf-8") for name in header[key]]
+
+	return Matrix(num_rows, num_cols, num_slices,
+				  row_names=names("row_names"), col_names=names("col_names"), slice_names=names("slice_names"),
+				  data=data)
@@ -0,0 +1,75 @@
+import os
+import os.path
+import hashlib
+import tempfile
+
+import numpy as np
+
+class NullCache(object):
+	"""
+	On-disk cache of sampled null distributions.
+
+	Every distribution is kept in its own numpy file named by a hash of the background values,
+	the estimator, the mutations count, the number of samplings and the random seed.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+
+		if not os.path.exists(path):
+			os.makedirs(path)
+
+	@staticmethod
+	def background_digest(background):
+		"""
+		Content hash of a background.
+		:param background: the array of background values
+		"""
+
+		return hashlib.sha1(np.ascontiguousarray(background, dtype=np.float64).tostring()).hexdigest()
+
+	@staticmethod
+	def key(background_digest, estimator, mut_count, num_samplings, seed=None):
+		return hashlib.sha1("{0}:{1}:{2}:{3}:{4}".format(
+			background_digest, estimator, mut_count, num_samplings, seed)).hexdigest()
+
+	def _path(self, key):
+		return os.path.join(self.path, key[:2], "{0}.npy".format(key))
+
+	def get(self, key):
+		"""
+		Returns the cached distribution for the key or None if not found.
+		"""
+
+		path = self._path(key)
+		if not os.path.exists(path):
+			return None
+
+		try:
+			return np.load(path)
+		except (IOError, ValueError):
+			# Corrupted entry, it will be overwritten
+			return None
+
+	def put(self, key, estimations):
+		"""
+		Saves a distribution. The file is renamed once written so concurrent readers never see partial entries.
+		"""
+
+		path = self._path(key)
+		dir_path = os.path.dirname(path)
+		if not os.path.exists(dir_path):
+			try:
+				os.makedirs(dir_path)
+			except OSError:
+				if not os.path.isdir(dir_path):
+					raise
+
+		fd, tmp_path = tempfile.mkstemp(suffix=".npy", dir=dir_path)
+		try:
+			with os.fdopen(fd, "wb") as f:
+				np.save(f, estimations)
+			os.rename(tmp_path, path)
+		except:
+			os.remove(tmp_path)
+			raise
@@ -2,15 +2,22 @@ import os
 import os.path
 import argparse
 import logging
+import threading
+import traceback
+import Queue
 
 import numpy as np
 from datetime import datetime
+from contextlib import contextmanager
 
 from oncodrivefm import VERSION
+from oncodrivefm import tdm
+from oncodrivefm import binmatrix
 
 from bgcore import tsv
 
 from oncodrivefm.mapping import MatrixMapping
+from oncodrivefm.matrix import Matrix
 
 _LOG_LEVELS = {
 	"debug" : logging.DEBUG,
@@ -20,6 +27,96 @@ _LOG_LEVELS = {
 	"critical" : logging.CRITICAL,
 	"notset" : logging.NOTSET }
 
+# Number of rows formatted before writing them
+ROWS_PER_WRITE = 10000
+
+@contextmanager
+def _atomic_open(path):
+	"""
+	Opens a file for writing with a hidden temporary name and renames it once closed without errors
+	"""
+
+	dirname, basename = os.path.split(path)
+	tmp_path = os.path.join(dirname, ".{0}".format(basename))
+
+	f = tsv.open(tmp_path, "w")
+	try:
+		yield f
+	except:
+		f.close()
+		os.remove(tmp_path)
+		raise
+
+	f.close()
+	os.rename(tmp_path, path)
+
+def _write_rows(f, row_names, data, rows, null_value="-"):
+	"""
+	Writes the rows of data with the given indices, lines are formatted and written by chunks
+	"""
+
+	for start in xrange(0, len(rows), ROWS_PER_WRITE):
+		lines = []
+		for row_index in rows[start:start + ROWS_PER_WRITE]:
+			values = [v if not np.isnan(v) else None for v in data[row_index]]
+			lines += [tsv.line_text(row_names[row_index], *values, null_value=null_value)]
+		f.write("".join(lines))
+
+class _ResultsWriter(object):
+	"""
+	Saves the results of every slice from a dedicated thread, so the scheduler callbacks only have to queue them.
+	The results of a slice are released as soon as they are saved.
+	"""
+
+	def __init__(self, save):
+		"""
+		:param save: function called with the slice results index and the slice results
+		"""
+
+		self._save = save
+		self._queue = Queue.Queue()
+		self._error = None
+
+		self._thread = threading.Thread(target=self._run, name="results-writer")
+		self._thread.daemon = True
+		self._thread.start()
+
+	def __call__(self, slice_results_index, slice_results):
+		# Failing here stops the analysis instead of computing results that can not be saved
+		self._check()
+		self._queue.put((slice_results_index, slice_results))
+
+	def _run(self):
+		while True:
+			item = self._queue.get()
+			if item is None:
+				break
+
+			if self._error is None:
+				try:
+					self._save(*item)
+				except Exception:
+					self._error = traceback.format_exc()
+
+			del item
+
+	def _check(self):
+		if self._error is not None:
+			raise Exception("Error saving the results:\n{0}".format(self._error))
+
+	def close(self):
+		"""
+		Waits until all the queued results are saved
+		"""
+
+		if self._thread.is_alive():
+			self._queue.put(None)
+			# Joining with a timeout keeps the main thread responsive to keyboard interrupts
+			while self._thread.is_alive():
+				self._thread.join(1.0)
+
+		self._check()
+
 class Command(object):
 	def __init__(self, prog=None, desc=""):
 		parser = argparse.ArgumentParser(prog=prog, description=desc)
@@ -61,7 +158,7 @@ class Command(object):
 							help="Analysis name")
 
 		parser.add_argument("--output-format", dest="output_format", metavar="FORMAT",
-							choices=["tsv", "tsv.gz", "tsv.bz2"], default="tsv",
+							choices=["tsv", "tsv.gz", "tsv.bz2", "bmx"], default="tsv",
 							help="The FORMAT for the output file")
 
 	def _check_args(self):
@@ -71,6 +168,26 @@ class Command(object):
 	def _error(self, msg):
 		self._arg_errors += [msg]
 
+	def load_matrix(self, path, sparse=False):
+		"""
+		Loads a data matrix. Binary matrices are detected and memory-mapped, TDM files are loaded by default,
+		and plain matrices can be loaded defining the slice name after the path: /file.tsv#slice=SIFT
+		:param sparse: whether TDM files are loaded as sparse matrices
+		"""
+
+		if binmatrix.is_binary_matrix(path):
+			return binmatrix.load_matrix(path)
+
+		pos = path.rfind("#")
+		if pos >= 0:
+			path, options = path[:pos], path[pos + 1:]
+			key, sep, slice_name = options.partition("=")
+			if key not in ["slice", "name"] or len(slice_name) == 0:
+				raise Exception("Unknown matrix option: {0}".format(options))
+			return tdm.load_plain_matrix(path, slice_name)
+
+		return tdm.load_matrix(path, sparse=sparse)
+
 	def load_mapping(self, matrix, path, filt=None):
 		map = {}
 
@@ -103,27 +220,70 @@ class Command(object):
 	def save_splited_results(self, output_path, analysis_name, output_format,
 								matrix, mapping, method, results, slices, suffix=""):
 
+		if output_format == "bmx":
+			if len(suffix) > 0:
+				suffix = "-{0}".format(suffix)
+
+			path = os.path.join(output_path, "{0}{1}.{2}".format(analysis_name, suffix, output_format))
+			self.log.debug("  > {0}".format(path))
+
+			results_matrix = Matrix(mapping.num_groups, len(method.results_columns), len(slices),
+									row_names=mapping.group_names, col_names=method.results_columns,
+									slice_names=[matrix.slice_names[slice] for slice in slices],
+									data=results.reshape((len(slices), mapping.num_groups, 1)))
+
+			binmatrix.save_matrix(results_matrix, path, params=[
+				("version", VERSION), ("method", method.name),
+				("date", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))] + self.parameters)
+			return
+
+		for slice_results_index, slice in enumerate(slices):
+			self.save_slice_results(output_path, analysis_name, output_format,
+									matrix, mapping, method, slice, results[slice_results_index], suffix)
+
+	def save_slice_results(self, output_path, analysis_name, output_format,
+							matrix, mapping, method, slice, slice_results, suffix=""):
+		"""
+		Saves the results of one slice. The file is written with a temporary name and renamed once completed,
+		so any results file found while the analysis is running is complete.
+		"""
+
 		if len(suffix) > 0:
 			suffix = "-{0}".format(suffix)
 
-		for slice_results_index, slice in enumerate(slices):
-			slice_name = matrix.slice_names[slice]
-			path = os.path.join(output_path, "{0}{1}-{2}.{3}".format(
-				analysis_name, suffix, slice_name, output_format))
-			self.log.debug("  > {0}".format(path))
+		slice_name = matrix.slice_names[slice]
+		path = os.path.join(output_path, "{0}{1}-{2}.{3}".format(
+			analysis_name, suffix, slice_name, output_format))
+		self.log.debug("  > {0}".format(path))
+
+		with _atomic_open(path) as f:
+			tsv.write_line(f, "## version={0}".format(VERSION))
+			tsv.write_line(f, "## slice={0}".format(slice_name))
+			tsv.write_line(f, "## method={0}".format(method.name))
+			tsv.write_line(f, "## date={0}".format(datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+			for key, value in self.parameters:
+				tsv.write_line(f, "## {0}={1}".format(key, value))
+			tsv.write_line(f, "ID", *method.results_columns)
+			_write_rows(f, mapping.group_names, slice_results.reshape((-1, 1)),
+						np.nonzero(~np.isnan(slice_results))[0])
+
+	def stream_splited_results(self, output_path, analysis_name, output_format,
+								matrix, mapping, method, slices, suffix=""):
+		"""
+		Returns a function to be passed as slice_completed to the analysis
+		that saves the results of every slice as soon as they are complete from a writer thread.
+		It has to be closed once the analysis finishes to wait for the pending results to be saved.
+		Binary results are a single container that is saved with save_splited_results once the analysis finishes.
+		"""
+
+		if output_format == "bmx":
+			return None
+
+		def save(slice_results_index, slice_results):
+			self.save_slice_results(output_path, analysis_name, output_format,
+									matrix, mapping, method, slices[slice_results_index], slice_results, suffix)
 
-			with tsv.open(path, 'w') as f:
-				tsv.write_line(f, "## version={0}".format(VERSION))
-				tsv.write_line(f, "## slice={0}".format(slice_name))
-				tsv.write_line(f, "## method={0}".format(method.name))
-				tsv.write_line(f, "## date={0}".format(datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-				for key, value in self.parameters:
-					tsv.write_line(f, "## {0}={1}".format(key, value))
-				tsv.write_line(f, "ID", *method.results_columns)
-				for row_index, row_name in enumerate(mapping.group_names):
-					value = results[slice_results_index, row_index]
-					if not np.isnan(value):
-						tsv.write_line(f, row_name, value, null_value="-")
+		return _ResultsWriter(save)
 
 	def save_matrix(self, output_path, analysis_name, output_format,
 						 row_names, col_names, data,
@@ -138,21 +298,35 @@ class Command(object):
 		path = os.path.join(output_path, "{0}{1}.{2}".format(analysis_name, suffix, output_format))
 		self.log.debug("  > {0}".format(path))
 
-		with tsv.open(path, 'w') as f:
+		if output_format == "bmx":
+			valid_rows = [row_index for row_index, row_name in enumerate(row_names)
+							if len(row_name) > 0 and valid_row(data[row_index, :])]
+
+			data_matrix = Matrix(len(valid_rows), len(col_names), 1,
+								 row_names=[row_names[row_index] for row_index in valid_rows], col_names=col_names,
+								 slice_names=["data"], data=data[valid_rows, :].reshape((1, len(valid_rows), len(col_names))))
+
+			binmatrix.save_matrix(data_matrix, path, params=[
+				("version", VERSION),
+				("date", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))] + params + self.parameters)
+			return
+
+		rows = []
+		for row_index, row_name in enumerate(row_names):
+			if len(row_name) == 0:
+				self.log.warn("Empty identifier detected")
+				continue
+
+			if valid_row(data[row_index, :]):
+				rows += [row_index]
+
+		with _atomic_open(path) as f:
 			tsv.write_line(f, "## version={0}".format(VERSION))
 			tsv.write_line(f, "## date={0}".format(datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
 			for key, value in params + self.parameters:
 				tsv.write_line(f, "## {0}={1}".format(key, value))
 			tsv.write_line(f, "ID", *col_names)
-			for row_index, row_name in enumerate(row_names):
-				if len(row_name) == 0:
-					self.log.warn("Empty identifier detected")
-					continue
-
-				row = data[row_index, :]
-				if valid_row(row):
-					values = [v if not np.isnan(v) else None for v in row]
-					tsv.write_line(f, row_name, *values, null_value="-")
+			_write_rows(f, row_names, data, rows)
 
 	#DEPRECATED
 	def save_combined_results(self, output_path, analysis_name, output_format,
@@ -6,6 +6,7 @@ from datetime import datetime
 
 from bgcore import tsv
 from oncodrivefm import tdm
+from oncodrivefm import binmatrix
 
 from oncodrivefm.analysis import OncodriveFmAnalysis
 from oncodrivefm.method import create_method, method_names, PVALUE_EPSILON
@@ -21,7 +22,7 @@ class CombineCommand(Command):
 		Command._add_arguments(self, parser)
 
 		parser.add_argument("data_paths", metavar="DATA", nargs="+",
-							help="Files with the results to be combined")
+							help="Files with the results to be combined, either TSV or binary matrices")
 
 		parser.add_argument("-m", dest="method", metavar="NAME",
 							choices=method_names(),
@@ -46,10 +47,26 @@ class CombineCommand(Command):
 		columns = []
 		col_names = []
 		row_name_index = {}
+		row_names = []
 		for col_index, data_file in enumerate(data_paths):
 			self.log.debug("  > {0}".format(data_file))
-			names = []
-			values = []
+
+			if binmatrix.is_binary_matrix(data_file):
+				# Binary results have a slice for each column to combine with the values in the first column
+				params = binmatrix.load_params(data_file)
+				if "method" in params:
+					if method is None:
+						method = params["method"]
+					elif method != params["method"]:
+						self.log.warn("Different method of computation used for file {0}".format(data_file))
+
+				matrix = binmatrix.load_matrix(data_file)
+				row_indices = tdm.name_indices(matrix.row_names, row_name_index, row_names)
+				for slice, slice_name in enumerate(matrix.slice_names):
+					col_names += [slice_name]
+					columns += [(row_indices, matrix.data[slice, :, 0])]
+				continue
+
 			with tsv.open(data_file, "r") as f:
 				col_name, ext = os.path.splitext(os.path.basename(data_file))
 				params = tsv.params(f)
@@ -61,31 +78,29 @@ class CombineCommand(Command):
 					elif method != params["method"]:
 						self.log.warn("Different method of computation used for file {0}".format(data_file))
 
-				for name, value in tsv.lines(f, (str, float), header=True, null_value="-"):
-					if len(name) == 0:
-						self.log.warn("Empty identifier detected")
-						continue
+				tsv.header(f)
 
-					if name not in row_name_index:
-						row_name_index[name] = len(row_name_index)
+				names = []
+				tokens = []
+				for line in f:
+					if line.startswith("#"):
+						continue
+					fields = line.rstrip("\n").split("\t", 2)
+					if len(fields[0]) == 0:
+						if len(fields) > 1:
+							self.log.warn("Empty identifier detected")
+						continue
+					names += [fields[0]]
+					tokens += [fields[1] if len(fields) > 1 else "-"]
 
-					names += [name]
-					values += [value]
 			col_names += [col_name]
-			columns += [(names, values)]
-
-		num_cols = len(columns)
-		num_rows = len(row_name_index)
-		row_names = [None] * num_rows
-		for name, index in row_name_index.items():
-			row_names[index] = name
+			columns += [(tdm.name_indices(names, row_name_index, row_names), tdm.parse_values(tokens))]
 
-		data = np.empty((num_rows, num_cols))
+		data = np.empty((len(row_names), len(columns)))
 		data[:] = np.nan
 
-		for col_index, (names, values) in enumerate(columns):
-			for i, name in enumerate(names):
-				data[row_name_index[name], col_index] = values[i]
+		for col_index, (row_indices, values) in enumerate(columns):
+			data[row_indices, col_index] = values
 
 		return row_names, col_names, data, method
 
@@ -97,7 +112,6 @@ class CombineCommand(Command):
 		self.log.info("Loading data ...")
 
 		#TODO: Allow to specify the name of the column to load from data files: --data-column=PVALUE && /file.tsv,column=PVALUE
-		#TODO: Allow TDM format
 
 		row_names, col_names, data, method = self.load_data(self.args.data_paths, self.args.method)
 
@@ -117,7 +131,7 @@ class CombineCommand(Command):
 
 		self.log.info("Combining data using method '{0}' ...".format(method.name))
 
-		combined_results = method.combine(np.ma.masked_invalid(data))
+		combined_results = method.combine(data)
 
 		self.log.info("Saving combined results ...")
 		self.save_matrix(self.args.output_path, self.args.analysis_name, self.args.output_format,
@@ -13,6 +13,7 @@ from oncodrivefm.method.factory import create_method
 from oncodrivefm.method.empirical import EmpiricalTest
 from oncodrivefm.method.zscore import ZscoreTest
 from oncodrivefm.mapping import MatrixMapping
+from oncodrivefm.shards import ShardStore
 
 from base import Command
 
@@ -24,7 +25,8 @@ class ComputeCommand(Command):
 		Command._add_arguments(self, parser)
 
 		parser.add_argument("data_path", metavar="DATA",
-							help="File containing the data matrix in TDM format")
+							help="File containing the data matrix in TDM format."
+								 " Plain matrices are also supported with /file.tsv#slice=NAME")
 
 		parser.add_argument("-N", "--samplings", dest="num_samplings", type=int, default=10000, metavar="NUMBER",
 							help="Number of samplings to compute the FM bias pvalue")
@@ -46,6 +48,32 @@ class ComputeCommand(Command):
 							help="File containing the features to be filtered. By default labels are includes,"
 								 " labels preceded with - are excludes.")
 
+		parser.add_argument("--adaptive", dest="adaptive_exceedances", type=int, metavar="EXCEEDANCES",
+							help="Draw samplings in rounds and stop when the most extreme observed value has been reached"
+								 " EXCEEDANCES times (e.g. 10) or the number of samplings is completed")
+
+		parser.add_argument("--sparse", dest="sparse", default=False, action="store_true",
+							help="Keep only the valid values of TDM matrices in memory."
+								 " Recommended for large matrices where most of the values are empty")
+
+		parser.add_argument("--seed", dest="seed", type=int, metavar="SEED",
+							help="Seed for the random samplings. Analyses with the same seed are reproducible"
+								 " whatever the number of cores")
+
+		parser.add_argument("--cache", dest="cache_path", metavar="PATH",
+							help="Directory where the sampled null distributions are cached to be reused by next analyses")
+
+		parser.add_argument("--shards", dest="shards_path", metavar="PATH",
+							help="Instead of running the samplings, split them into shards saved in PATH (a shared directory)"
+								 " to be run by oncodrivefm-worker in several processes or hosts")
+
+		parser.add_argument("--shard-size", dest="shard_size", type=int, default=10000, metavar="NUMBER",
+							help="Maximum number of samplings of every shard")
+
+		parser.add_argument("--reduce", dest="reduce", default=False, action="store_true",
+							help="Merge the completed shards in the --shards PATH and save the results."
+								 " The rest of arguments have to be the same than the ones used to split them")
+
 		parser.add_argument("--save-data", dest="save_data", default=False, action="store_true",
 							help="The input data matrix will be saved")
 
@@ -58,9 +86,24 @@ class ComputeCommand(Command):
 		if self.args.num_samplings < 1:
 			self._error("Number of samplings out of range [2, ..)")
 
+		if self.args.adaptive_exceedances is not None and self.args.adaptive_exceedances < 1:
+			self._error("Number of exceedances for adaptive sampling out of range [1, ..)")
+
+		if self.args.seed is not None and not 0 <= self.args.seed < 2**32:
+			self._error("Seed out of range [0, 2^32)")
+
 		if self.args.mut_threshold < 1:
 			self._error("Minimum number of mutations out of range [1, ..)")
 
+		if self.args.shard_size < 1:
+			self._error("Number of samplings per shard out of range [1, ..)")
+
+		if self.args.reduce and self.args.shards_path is None:
+			self._error("The shards PATH is required to merge them")
+
+		if self.args.shards_path is not None and self.args.adaptive_exceedances is not None:
+			self._error("Adaptive sampling is not supported with shards")
+
 		if self.args.filter is not None:
 			if not os.path.exists(self.args.filter):
 				self._error("Filter file not found: {0}".format(self.args.filter))
@@ -73,9 +116,7 @@ class ComputeCommand(Command):
 		self.log.info("Loading data ...")
 		self.log.debug("  > {0}".format(self.args.data_path))
 
-		#TODO: Support loading plain matrices: /file.tsv#name=SIFT
-
-		self.matrix = tdm.load_matrix(self.args.data_path)
+		self.matrix = self.load_matrix(self.args.data_path, sparse=self.args.sparse)
 
 		self.log.debug("  {0} rows, {1} columns and {2} slices".format(
 		self.matrix.num_rows, self.matrix.num_cols, self.matrix.num_slices))
@@ -131,7 +172,7 @@ class ComputeCommand(Command):
 				slice_name = self.matrix.slice_names[i]
 				self.log.info("Saving {0} data matrix ...".format(slice_name))
 				self.save_matrix(self.args.output_path, self.args.analysis_name, self.args.output_format,
-								 self.matrix.row_names, self.matrix.col_names, self.matrix.data[i],
+								 self.matrix.row_names, self.matrix.col_names, self.matrix.dense_slice(i),
 								 suffix="data-{0}".format(slice_name))
 
 		# Run the analysis
@@ -142,18 +183,52 @@ class ComputeCommand(Command):
 			"oncodrivefm.compute",
 			num_samplings = self.args.num_samplings,
 			mut_threshold = self.args.mut_threshold,
-			num_cores=self.args.num_cores)
-
-		results = analysis.compute(self.matrix, self.mapping, method_name, slices)
+			num_cores=self.args.num_cores,
+			cache_path=self.args.cache_path,
+			adaptive_exceedances=self.args.adaptive_exceedances,
+			seed=self.args.seed)
 
 		method = create_method(method_name)
 
-		self.log.info("Saving results ...")
+		if self.args.shards_path is not None and not self.args.reduce:
+			self.log.info("Splitting the samplings into shards ...")
+			self.log.debug("  > {0}".format(self.args.shards_path))
+
+			num_shards = analysis.plan(ShardStore(self.args.shards_path), self.matrix, self.mapping, method_name,
+									   slices, self.args.shard_size)
+
+			self.log.info("{0} shards pending to be run with: oncodrivefm-worker {1}".format(
+				num_shards, self.args.shards_path))
+			return
 
-		#TODO: Have an option to save in TDM instead of splited
-		self.save_splited_results(
+		# The results of every slice are saved as soon as they are complete, and then released
+		slice_completed = self.stream_splited_results(
 			self.args.output_path, self.args.analysis_name, self.args.output_format,
-			self.matrix, self.mapping, method, results, slices)
+			self.matrix, self.mapping, method, slices)
+
+		keep_results = slice_completed is None
+
+		try:
+			if self.args.reduce:
+				self.log.info("Merging shards ...")
+				self.log.debug("  > {0}".format(self.args.shards_path))
+
+				results = analysis.reduce(ShardStore(self.args.shards_path), self.matrix, self.mapping, method_name,
+										  slices, slice_completed, keep_results)
+			else:
+				results = analysis.compute(self.matrix, self.mapping, method_name, slices, slice_completed,
+										   keep_results)
+		finally:
+			if slice_completed is not None:
+				slice_completed.close()
+
+		if slice_completed is None:
+			self.log.info("Saving results ...")
+
+			#TODO: Have an option to save in TDM instead of splited
+			self.save_splited_results(
+				self.args.output_path, self.args.analysis_name, self.args.output_format,
+				self.matrix, self.mapping, method, results, slices)
 
 def main():
 	ComputeCommand().run()
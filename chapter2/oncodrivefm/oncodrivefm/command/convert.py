@@ -0,0 +1,54 @@
+import os
+import os.path
+
+from oncodrivefm import binmatrix
+
+from base import Command
+
+class ConvertCommand(Command):
+	def __init__(self):
+		Command.__init__(self, prog="oncodrivefm-convert", desc="Convert a data matrix into the binary matrix format")
+
+	def _add_arguments(self, parser):
+		Command._add_arguments(self, parser)
+
+		parser.add_argument("data_path", metavar="DATA",
+							help="File containing the data matrix in TDM format."
+								 " Plain matrices are also supported with /file.tsv#slice=NAME")
+
+		parser.add_argument("--dtype", dest="dtype", metavar="TYPE",
+							choices=binmatrix.DTYPES, default="float64",
+							help="The TYPE of the values: float32 or float64")
+
+	def _check_args(self):
+		Command._check_args(self)
+
+		if self.args.analysis_name is None:
+			name = os.path.basename(self.args.data_path.split("#")[0])
+			if name.endswith(".gz"):
+				name = name[:-3]
+			self.args.analysis_name, ext = os.path.splitext(name)
+
+	def run(self):
+		Command.run(self)
+
+		self.log.info("Loading data ...")
+		self.log.debug("  > {0}".format(self.args.data_path))
+
+		matrix = self.load_matrix(self.args.data_path)
+
+		self.log.debug("  {0} rows, {1} columns and {2} slices".format(
+			matrix.num_rows, matrix.num_cols, matrix.num_slices))
+
+		path = os.path.join(self.args.output_path, "{0}{1}".format(self.args.analysis_name, binmatrix.EXTENSION))
+
+		self.log.info("Saving binary matrix ...")
+		self.log.debug("  > {0}".format(path))
+
+		binmatrix.save_matrix(matrix, path, dtype=self.args.dtype)
+
+def main():
+	ConvertCommand().run()
+
+if __name__ == "__main__":
+	main()
@@ -9,6 +9,7 @@ from bgcore.labelfilter import LabelFilter
 
 from oncodrivefm import tdm
 from oncodrivefm.analysis import OncodriveFmAnalysis
+from oncodrivefm.scheduler import Scheduler
 from oncodrivefm.method.factory import create_method
 from oncodrivefm.method.empirical import EmpiricalTest
 from oncodrivefm.method.zscore import ZscoreTest
@@ -24,7 +25,8 @@ class FullCommand(Command):
 		Command._add_arguments(self, parser)
 
 		parser.add_argument("data_path", metavar="DATA",
-							help="File containing the data matrix in TDM format")
+							help="File containing the data matrix in TDM format."
+								 " Plain matrices are also supported with /file.tsv#slice=NAME")
 
 		parser.add_argument("-N", "--samplings", dest="num_samplings", type=int, default=10000, metavar="NUMBER",
 							help="Number of samplings to compute the FM bias pvalue")
@@ -49,6 +51,21 @@ class FullCommand(Command):
 							help="File containing the features to be filtered. By default labels are includes,"
 								 " labels preceded with - are excludes.")
 
+		parser.add_argument("--adaptive", dest="adaptive_exceedances", type=int, metavar="EXCEEDANCES",
+							help="Draw samplings in rounds and stop when the most extreme observed value has been reached"
+								 " EXCEEDANCES times (e.g. 10) or the number of samplings is completed")
+
+		parser.add_argument("--sparse", dest="sparse", default=False, action="store_true",
+							help="Keep only the valid values of TDM matrices in memory."
+								 " Recommended for large matrices where most of the values are empty")
+
+		parser.add_argument("--seed", dest="seed", type=int, metavar="SEED",
+							help="Seed for the random samplings. Analyses with the same seed are reproducible"
+								 " whatever the number of cores")
+
+		parser.add_argument("--cache", dest="cache_path", metavar="PATH",
+							help="Directory where the sampled null distributions are cached to be reused by next analyses")
+
 		parser.add_argument("--save-data", dest="save_data", default=False, action="store_true",
 							help="The input data matrix will be saved")
 
@@ -64,6 +81,12 @@ class FullCommand(Command):
 		if self.args.num_samplings < 1:
 			self._error("Number of samplings out of range [2, ..)")
 
+		if self.args.adaptive_exceedances is not None and self.args.adaptive_exceedances < 1:
+			self._error("Number of exceedances for adaptive sampling out of range [1, ..)")
+
+		if self.args.seed is not None and not 0 <= self.args.seed < 2**32:
+			self._error("Seed out of range [0, 2^32)")
+
 		if self.args.mut_gene_threshold < 1:
 			self._error("Minimum number of mutations per gene out of range [1, ..)")
 
@@ -93,9 +116,7 @@ class FullCommand(Command):
 		self.log.info("Loading data ...")
 		self.log.debug("  > {0}".format(self.args.data_path))
 
-		#TODO: Support loading plain matrices: /file.tsv#slice=SIFT
-
-		self.matrix = tdm.load_matrix(self.args.data_path)
+		self.matrix = self.load_matrix(self.args.data_path, sparse=self.args.sparse)
 
 		self.log.debug("  {0} rows, {1} columns and {2} slices".format(
 			self.matrix.num_rows, self.matrix.num_cols, self.matrix.num_slices))
@@ -119,46 +140,110 @@ class FullCommand(Command):
 				slice_name = self.matrix.slice_names[i]
 				self.log.info("Saving {0} data matrix ...".format(slice_name))
 				self.save_matrix(self.args.output_path, self.args.analysis_name, self.args.output_format,
-							  self.matrix.row_names, self.matrix.col_names, self.matrix.data[i],
+							  self.matrix.row_names, self.matrix.col_names, self.matrix.dense_slice(i),
 							  suffix="data-{0}".format(slice_name))
 
-		# GENES ---------------------------------------
+		# Both levels are analysed at the same time sharing the workers
+
+		scheduler = Scheduler(self.args.num_cores)
+
+		genes_slice_completed = pathways_slice_completed = None
+
+		try:
+			# GENES ---------------------------------------
+
+			# One to one mapping for genes
+
+			map = {}
+			for row_name in self.matrix.row_names:
+				if self.filter.valid(row_name):
+					map[row_name] = (row_name,)
+			genes_mapping = MatrixMapping(self.matrix, map)
+			genes_method_name = "{0}-{1}".format(self.args.estimator, EmpiricalTest.NAME)
+
+			# Analysis for genes
+
+			self.log.info("Analysing genes with '{0}' ...".format(genes_method_name))
+
+			analysis = OncodriveFmAnalysis(
+				"oncodrivefm.genes",
+				num_samplings = self.args.num_samplings,
+				mut_threshold = self.args.mut_gene_threshold,
+				num_cores=self.args.num_cores,
+				cache_path=self.args.cache_path,
+				adaptive_exceedances=self.args.adaptive_exceedances,
+				seed=self.args.seed)
+
+			if self.args.save_analysis:
+				genes_slice_completed = self.stream_splited_results(
+					self.args.output_path, self.args.analysis_name, self.args.output_format,
+					self.matrix, genes_mapping, create_method(genes_method_name), slices, suffix="genes")
+
+			genes_results = analysis.submit(scheduler, self.matrix, genes_mapping, genes_method_name, slices,
+											genes_slice_completed)
+
+			# PATHWAYS ---------------------------------------
 
-		# One to one mapping for genes
+			if self.args.mapping is not None:
 
-		map = {}
-		for row_name in self.matrix.row_names:
-			if self.filter.valid(row_name):
-				map[row_name] = (row_name,)
-		genes_mapping = MatrixMapping(self.matrix, map)
-		genes_method_name = "{0}-{1}".format(self.args.estimator, EmpiricalTest.NAME)
+				# Load pathways mappping
 
-		# Analysis for genes
+				self.log.info("Loading pathways mapping ...")
+				self.log.debug("  > {0}".format(self.args.mapping))
 
-		self.log.info("Analysing genes with '{0}' ...".format(genes_method_name))
+				pathways_mapping = self.load_mapping(self.matrix, self.args.mapping)
 
-		analysis = OncodriveFmAnalysis(
-			"oncodrivefm.genes",
-			num_samplings = self.args.num_samplings,
-			mut_threshold = self.args.mut_gene_threshold,
-			num_cores=self.args.num_cores)
+				self.log.debug("  {0} pathways".format(pathways_mapping.num_groups))
 
-		results = analysis.compute(self.matrix, genes_mapping, genes_method_name, slices)
+				pathways_method_name = "{0}-{1}".format(self.args.estimator, ZscoreTest.NAME)
+
+				# Analysis for pathways
+
+				self.log.info("Analysing pathways with '{0}' ...".format(pathways_method_name))
+
+				analysis = OncodriveFmAnalysis(
+					"oncodrivefm.pathways",
+					num_samplings = self.args.num_samplings,
+					mut_threshold = self.args.mut_pathway_threshold,
+					num_cores=self.args.num_cores,
+					cache_path=self.args.cache_path,
+					adaptive_exceedances=self.args.adaptive_exceedances,
+					seed=self.args.seed)
+
+				if self.args.save_analysis:
+					pathways_slice_completed = self.stream_splited_results(
+						self.args.output_path, self.args.analysis_name, self.args.output_format,
+						self.matrix, pathways_mapping, create_method(pathways_method_name), slices, suffix="pathways")
+
+				pathways_results = analysis.submit(scheduler, self.matrix, pathways_mapping, pathways_method_name,
+												   slices, pathways_slice_completed)
+
+			self.log.info("Waiting for the samplings to complete ...")
+
+			scheduler.wait()
+		finally:
+			scheduler.close()
+
+			for slice_completed in [genes_slice_completed, pathways_slice_completed]:
+				if slice_completed is not None:
+					slice_completed.close()
+
+		# Genes results
 
 		method = create_method(genes_method_name)
 
-		if self.args.save_analysis:
+		if self.args.save_analysis and genes_slice_completed is None:
 			self.log.info("Saving genes analysis results ...")
 			self.save_splited_results(
 				self.args.output_path, self.args.analysis_name, self.args.output_format,
 				self.matrix, genes_mapping,
-				method, results, slices, suffix="genes")
+				method, genes_results, slices, suffix="genes")
 
 		# Combination for genes
 
 		self.log.info("Combining analysis results ...")
 
-		combined_results = method.combine(np.ma.masked_invalid(results.T))
+		combined_results = method.combine(genes_results.T)
 
 		self.log.info("Saving genes combined results ...")
 		self.save_matrix(self.args.output_path, self.args.analysis_name, self.args.output_format,
@@ -169,45 +254,22 @@ class FullCommand(Command):
 		if self.args.mapping is None:
 			return
 
-		# PATHWAYS ---------------------------------------
-
-		# Load pathways mappping
-
-		self.log.info("Loading pathways mapping ...")
-		self.log.debug("  > {0}".format(self.args.mapping))
-
-		pathways_mapping = self.load_mapping(self.matrix, self.args.mapping)
-
-		self.log.debug("  {0} pathways".format(pathways_mapping.num_groups))
-
-		pathways_method_name = "{0}-{1}".format(self.args.estimator, ZscoreTest.NAME)
-
-		# Analysis for pathways
-
-		self.log.info("Analysing pathways with '{0}' ...".format(pathways_method_name))
-
-		analysis = OncodriveFmAnalysis(
-			"oncodrivefm.pathways",
-			num_samplings = self.args.num_samplings,
-			mut_threshold = self.args.mut_pathway_threshold,
-			num_cores=self.args.num_cores)
-
-		results = analysis.compute(self.matrix, pathways_mapping, pathways_method_name, slices)
+		# Pathways results
 
 		method = create_method(pathways_method_name)
 
-		if self.args.save_analysis:
+		if self.args.save_analysis and pathways_slice_completed is None:
 			self.log.info("Saving pathways analysis results ...")
 			self.save_splited_results(
 				self.args.output_path, self.args.analysis_name, self.args.output_format,
 				self.matrix, pathways_mapping,
-				method, results, slices, suffix="pathways")
+				method, pathways_results, slices, suffix="pathways")
 
 		# Combination for pathways
 
 		self.log.info("Combining analysis results ...")
 
-		combined_results = method.combine(np.ma.masked_invalid(results.T))
+		combined_results = method.combine(pathways_results.T)
 
 		self.log.info("Saving pathways combined results ...")
 		self.save_matrix(self.args.output_path, self.args.analysis_name, self.args.output_format,
@@ -0,0 +1,66 @@
+import os.path
+import multiprocessing as mp
+
+from oncodrivefm.shards import ShardStore, run_worker
+
+from base import Command
+
+class WorkerCommand(Command):
+	def __init__(self):
+		Command.__init__(self, prog="oncodrivefm-worker",
+						 desc="Run the pending shards of an analysis split with oncodrivefm-compute --shards")
+
+	def _add_arguments(self, parser):
+		Command._add_arguments(self, parser)
+
+		parser.add_argument("shards_path", metavar="PATH",
+							help="Directory with the shards, it can be shared by workers in several hosts")
+
+		parser.add_argument("--requeue", dest="requeue", default=False, action="store_true",
+							help="Move the shards claimed by other workers back to pending before running."
+								 " Use it only when no other worker is running, i.e. after a failure")
+
+	def _check_args(self):
+		Command._check_args(self)
+
+		if not os.path.isdir(self.args.shards_path):
+			self._error("Shards directory not found: {0}".format(self.args.shards_path))
+
+	def run(self):
+		Command.run(self)
+
+		store = ShardStore(self.args.shards_path)
+
+		if self.args.requeue:
+			self.log.info("{0} shards requeued".format(store.requeue()))
+
+		pending, running, completed = store.status()
+		self.log.info("{0} shards pending, {1} running and {2} completed".format(pending, running, completed))
+
+		num_workers = self.args.num_cores or mp.cpu_count()
+
+		self.log.info("Running shards with {0} workers ...".format(num_workers))
+
+		# Every worker claims shards until there are no more, the same than workers in other hosts
+		workers = [mp.Process(target=run_worker, args=(self.args.shards_path,)) for i in xrange(num_workers)]
+		for worker in workers:
+			worker.start()
+
+		failed = 0
+		for worker in workers:
+			worker.join()
+			if worker.exitcode != 0:
+				failed += 1
+
+		pending, running, completed = store.status()
+		self.log.info("{0} shards pending, {1} running and {2} completed".format(pending, running, completed))
+
+		if failed > 0:
+			self.log.error("{0} workers failed, their shards can be run again with --requeue".format(failed))
+			exit(-1)
+
+def main():
+	WorkerCommand().run()
+
+if __name__ == "__main__":
+	main()
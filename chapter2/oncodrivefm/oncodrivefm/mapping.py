@@ -1,3 +1,5 @@
+import numpy as np
+
 class MatrixMapping(object):
 	"""
 	Represents mappings between labeled groups and matrix rows.
@@ -20,4 +22,13 @@ class MatrixMapping(object):
 			self.group_names[group_index] = group_name
 			self.group_name_index[group_name] = group_index
 			row_indices = [matrix.row_name_index[name] for name in row_names if name in matrix.row_name_index]
-			self.group_row_indices[group_index] = row_indices
\ No newline at end of file
+			self.group_row_indices[group_index] = row_indices
+
+		# Flattened group rows, the rows of group i are group_rows[group_indptr[i]:group_indptr[i + 1]]
+
+		self.group_indptr = np.zeros(self.num_groups + 1, dtype=np.int64)
+		np.cumsum([len(self.group_row_indices[i]) for i in xrange(self.num_groups)], out=self.group_indptr[1:])
+
+		self.group_rows = np.empty(self.group_indptr[-1], dtype=np.int64)
+		for group_index, row_indices in self.group_row_indices.items():
+			self.group_rows[self.group_indptr[group_index]:self.group_indptr[group_index + 1]] = row_indices
\ No newline at end of file
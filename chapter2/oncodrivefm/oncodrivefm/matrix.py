@@ -4,14 +4,22 @@ import numpy as np
 class Matrix(object):
 	def __init__(self, num_rows, num_cols, num_slices,
 				 initial_value=np.nan, dtype=float,
-				 row_names=None, col_names=None, slice_names=None):
+				 row_names=None, col_names=None, slice_names=None, data=None):
+		"""
+		:param data: an existing [slices, rows, cols] array to use instead of allocating a new one (i.e. a memmap)
+		"""
 
 		self.num_rows = num_rows
 		self.num_cols = num_cols
 		self.num_slices = num_slices
 
-		self.data = np.empty((num_slices, num_rows, num_cols), dtype=dtype)
-		self.data[:] = initial_value
+		if data is not None:
+			if data.shape != (num_slices, num_rows, num_cols):
+				raise Exception("Data shape {0} does not match the matrix dimensions".format(data.shape))
+			self.data = data
+		else:
+			self.data = np.empty((num_slices, num_rows, num_cols), dtype=dtype)
+			self.data[:] = initial_value
 
 		self.set_row_names(row_names)
 		self.set_col_names(col_names)
@@ -72,6 +80,29 @@ class Matrix(object):
 		for slice, value in enumerate(values):
 			self.data[slice, row, col] = value if value is not None else np.nan
 
+	@property
+	def dtype(self):
+		return self.data.dtype
+
+	def dense_slice(self, slice=0):
+		"""
+		Returns the [rows, cols] array of values of a slice
+		"""
+
+		return self.data[self._slice_index(slice)]
+
+	def slice_rows(self, slice=0):
+		"""
+		Returns the valid (not NaN) values of a slice by rows in compressed sparse rows form
+		:return: (indptr, values), where the values of the row i are values[indptr[i]:indptr[i + 1]]
+		"""
+
+		data = self.data[self._slice_index(slice)]
+		valid = ~np.isnan(data)
+		indptr = np.zeros(self.num_rows + 1, dtype=np.int64)
+		np.cumsum(valid.sum(axis=1), out=indptr[1:])
+		return indptr, data[valid]
+
 	def masked_invalid(self, slice=0):
 		return np.ma.masked_invalid(self.data[self._slice_index(slice)])
 
@@ -81,21 +112,109 @@ class Matrix(object):
 		return random.sample(flat_data, size)
 
 	def __repr__(self):
-		sb = ["Matrix("]
+		sb = [self.__class__.__name__, "("]
 		sb += ["num_rows=", str(self.num_rows), ", "]
 		sb += ["num_cols=", str(self.num_cols), ", "]
 		sb += ["num_slices=", str(self.num_slices)]
 		sb += ["):\n"]
 		for slice, name in enumerate(self.slice_names):
+			data = self.dense_slice(slice)
 			sb += ["\nslice ", name, ":\n"]
 			sb += ["\t", "\t".join(self.col_names), "\n"]
 			for row in xrange(min(self.num_rows, 100)):
 				sb += [self.row_names[row]]
 				for col in xrange(min(self.num_cols, 100)):
-					sb += ["\t", str(self.data[slice, row, col])]
+					sb += ["\t", str(data[row, col])]
 				sb += ["\n"]
 		return "".join(sb)
 
+class SparseMatrix(Matrix):
+	"""
+	Matrix that only stores the valid (not NaN) values, as compressed sparse rows (CSR) for each slice.
+	"""
+
+	def __init__(self, num_rows, num_cols, num_slices, dtype=float,
+				 row_names=None, col_names=None, slice_names=None):
+
+		self.num_rows = num_rows
+		self.num_cols = num_cols
+		self.num_slices = num_slices
+
+		self.indptr = [np.zeros(num_rows + 1, dtype=np.int64) for slice in xrange(num_slices)]
+		self.indices = [np.empty(0, dtype=np.int64) for slice in xrange(num_slices)]
+		self.values = [np.empty(0, dtype=dtype) for slice in xrange(num_slices)]
+
+		self.set_row_names(row_names)
+		self.set_col_names(col_names)
+		self.set_slice_names(slice_names)
+
+	@property
+	def dtype(self):
+		return self.values[0].dtype if self.num_slices > 0 else np.dtype(float)
+
+	@property
+	def density(self):
+		size = self.num_slices * self.num_rows * self.num_cols
+		return sum(values.size for values in self.values) / float(size) if size > 0 else 0.0
+
+	def set_slice_values(self, slice, rows, cols, values):
+		"""
+		Replaces the values of a slice from coordinates. NaN values are discarded,
+		and for repeated coordinates the last value is kept.
+		"""
+
+		slice = self._slice_index(slice)
+
+		valid = ~np.isnan(values)
+		rows, cols, values = rows[valid], cols[valid], values[valid]
+
+		# Sort by row and column keeping the order of appearance for repeated coordinates
+		order = np.lexsort((np.arange(rows.size), cols, rows))
+		rows, cols, values = rows[order], cols[order], values[order]
+
+		last = np.ones(rows.size, dtype=bool)
+		last[:-1] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+		rows, cols, values = rows[last], cols[last], values[last]
+
+		indptr = np.zeros(self.num_rows + 1, dtype=np.int64)
+		np.cumsum(np.bincount(rows, minlength=self.num_rows), out=indptr[1:])
+
+		self.indptr[slice] = indptr
+		self.indices[slice] = cols.astype(np.int64)
+		self.values[slice] = values.astype(self.values[slice].dtype)
+
+	def get(self, row, col, slice=0):
+		row, col, slice = self._indices_all(row, col, slice)
+		start, end = self.indptr[slice][row:row + 2]
+		pos = start + np.searchsorted(self.indices[slice][start:end], col)
+		if pos < end and self.indices[slice][pos] == col:
+			return self.values[slice][pos]
+		return np.nan
+
+	def set(self, row, col, slice, value):
+		raise Exception("Sparse matrices can not be modified by element")
+
+	def set_slices(self, row, col, values):
+		raise Exception("Sparse matrices can not be modified by element")
+
+	def dense_slice(self, slice=0):
+		slice = self._slice_index(slice)
+		data = np.empty((self.num_rows, self.num_cols), dtype=self.dtype)
+		data[:] = np.nan
+		rows = np.repeat(np.arange(self.num_rows), np.diff(self.indptr[slice]))
+		data[rows, self.indices[slice]] = self.values[slice]
+		return data
+
+	def slice_rows(self, slice=0):
+		slice = self._slice_index(slice)
+		return self.indptr[slice], self.values[slice]
+
+	def masked_invalid(self, slice=0):
+		return np.ma.masked_invalid(self.dense_slice(slice))
+
+	def sample(self, size, slice=0):
+		return random.sample(self.values[self._slice_index(slice)], size)
+
 if __name__ == "__main__":
 	import sys
 	from . import tdm
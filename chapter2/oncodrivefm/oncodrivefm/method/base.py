@@ -1 +1,34 @@
+import numpy as np
+
 PVALUE_EPSILON = 1.0e-8
+
+def fdr_bh(pvalues):
+	"""
+	Benjamini-Hochberg FDR correction in one pass. NaN values are ignored and kept as NaN.
+	:param pvalues: [groups]
+	:return: [groups] qvalues
+	"""
+
+	pvalues = np.asarray(pvalues, dtype=float)
+
+	qvalues = np.empty(pvalues.size)
+	qvalues[:] = np.nan
+
+	valid_indices = np.nonzero(~np.isnan(pvalues))[0]
+	size = valid_indices.size
+	if size == 0:
+		return qvalues
+
+	# Walk the pvalues from the highest to the lowest keeping the minimum adjusted value
+	order = valid_indices[np.argsort(pvalues[valid_indices], kind="mergesort")[::-1]]
+	adjusted = pvalues[order] * size / np.arange(size, 0, -1, dtype=float)
+	qvalues[order] = np.minimum(np.minimum.accumulate(adjusted), 1.0)
+
+	return qvalues
+
+def as_array(results):
+	"""
+	Converts results that can be masked into a plain array where the masked values are NaN
+	"""
+
+	return np.ma.filled(np.ma.asarray(results, dtype=float), np.nan)
@@ -1,8 +1,9 @@
 import numpy as np
 from scipy import stats
-from statsmodels.sandbox.stats.multicomp import multipletests
 
-from base import PVALUE_EPSILON
+from oncodrivefm.segments import segment_means, segment_medians
+
+from base import PVALUE_EPSILON, fdr_bh, as_array
 
 class EmpiricalTest(object):
 	NAME = "empirical"
@@ -15,21 +16,40 @@ class EmpiricalTest(object):
 	def observed(self, data):
 		raise Exception("Abstract method")
 
+	def observed_segments(self, values, indptr):
+		"""
+		Vectorized observed estimator
+		:param values: the values of all the groups
+		:param indptr: the values of the group i are values[indptr[i]:indptr[i + 1]]
+		:return: [groups]
+		"""
+		raise Exception("Abstract method")
+
 	def estimator(self, sample):
 		raise Exception("Abstract method")
 
+	def estimators(self, samples):
+		"""
+		Vectorized estimator
+		:param samples: [samplings, sample_size]
+		:return: [samplings]
+		"""
+		raise Exception("Abstract method")
+
 	def create_results(self, num_slices, num_rows):
 		results = np.empty((num_slices, num_rows))
 		results[:] = np.nan
 		return results
 
 	def compare(self, observed, samples):
-		def _count_ge_samples(obs):
-			return np.ma.masked_less(samples, obs).count() if not np.isnan(obs) else 0
+		observed = np.asarray(observed, dtype=float)
 
-		count_ge_samples = np.vectorize(_count_ge_samples)
+		# Sort the samples once and count the samples greater or equal than each observed value by binary search
+		sorted_samples = np.sort(samples, axis=None)
+		count_ge_samples = sorted_samples.size - np.searchsorted(sorted_samples, observed, side="left")
+		count_ge_samples[np.isnan(observed)] = 0
 
-		pvalues = count_ge_samples(observed) / float(samples.size)
+		pvalues = count_ge_samples / float(samples.size)
 
 		pvalues[pvalues < PVALUE_EPSILON] = PVALUE_EPSILON
 
@@ -38,51 +58,52 @@ class EmpiricalTest(object):
 	def combine(self, results):
 		"""
 		Fisher's combination of pvalues
-		:param results:
-		:return:
+		:param results: [groups, slices] pvalues, NaN or masked values are ignored
+		:return: [pvalues, qvalues]
 		"""
 
-		results = np.copy(results)
-		results[results < PVALUE_EPSILON] = PVALUE_EPSILON
+		results = as_array(results)
 
-		log = np.ma.log(results)
-		s = log.sum(axis=1)
-		count = log.count(axis=1)
+		valid = ~np.isnan(results)
+		count = valid.sum(axis=1)
+		log_sum = np.log(np.where(valid, np.maximum(results, PVALUE_EPSILON), 1.0)).sum(axis=1)
 
-		size = s.size
-		is_nan = s.mask
-		valid_indices = np.where(~is_nan)
-		invalid_indices = np.where(is_nan)
+		pvalues = np.empty(results.shape[0])
+		pvalues[:] = np.nan
 
-		pv = 1.0 - stats.chi2.cdf(-2.0 * s[valid_indices], 2 * count[valid_indices])
-		pvalues = np.empty(size)
-		pvalues[valid_indices] = pv
-		pvalues[invalid_indices] = np.nan
+		combined = count > 0
+		pvalues[combined] = stats.chi2.sf(-2.0 * log_sum[combined], 2 * count[combined])
 
-		if pv.size != 0:
-			qv = multipletests(pv, method='fdr_bh')[1]
-		else:
-			qv = np.array([])
-		qvalues = np.empty(size)
-		qvalues[valid_indices] = qv
-		qvalues[invalid_indices] = np.nan
-
-		return np.array([pvalues, qvalues])
+		return np.array([pvalues, fdr_bh(pvalues)])
 
 class MeanEmpiricalTest(EmpiricalTest):
 	NAME = "mean-empirical"
+	ESTIMATOR = "mean"
 
 	def observed(self, data):
 		return np.ma.mean(data)
 
+	def observed_segments(self, values, indptr):
+		return segment_means(values, indptr)
+
 	def estimator(self, sample):
 		return np.mean(sample)
 
+	def estimators(self, samples):
+		return np.mean(samples, axis=1)
+
 class MedianEmpiricalTest(EmpiricalTest):
 	NAME = "median-empirical"
+	ESTIMATOR = "median"
 
 	def observed(self, data):
 		return np.ma.median(data)
 
+	def observed_segments(self, values, indptr):
+		return segment_medians(values, indptr)
+
 	def estimator(self, sample):
-		return np.median(sample)
\ No newline at end of file
+		return np.median(sample)
+
+	def estimators(self, samples):
+		return np.median(samples, axis=1)
\ No newline at end of file
@@ -1,6 +1,9 @@
 import numpy as np
 from scipy import stats
-from statsmodels.sandbox.stats.multicomp import multipletests
+
+from oncodrivefm.segments import segment_means, segment_medians
+
+from base import fdr_bh, as_array
 
 class ZscoreTest(object):
 	NAME = "zscore"
@@ -13,9 +16,26 @@ class ZscoreTest(object):
 	def observed(self, data):
 		raise Exception("Abstract method")
 
+	def observed_segments(self, values, indptr):
+		"""
+		Vectorized observed estimator
+		:param values: the values of all the groups
+		:param indptr: the values of the group i are values[indptr[i]:indptr[i + 1]]
+		:return: [groups]
+		"""
+		raise Exception("Abstract method")
+
 	def estimator(self, sample):
 		raise Exception("Abstract method")
 
+	def estimators(self, samples):
+		"""
+		Vectorized estimator
+		:param samples: [samplings, sample_size]
+		:return: [samplings]
+		"""
+		raise Exception("Abstract method")
+
 	def create_results(self, num_slices, num_rows):
 		results = np.empty((num_slices, num_rows))
 		results[:] = np.nan
@@ -32,47 +52,56 @@ class ZscoreTest(object):
 	def combine(self, results):
 		"""
 		Stouffer combination of zscores
-		:param results:
-		:return:
+		:param results: [groups, slices] zscores, NaN or masked values are ignored
+		:return: [zscores, pvalues, qvalues]
 		"""
 
-		zscores = results.sum(axis=1) / np.sqrt(results.count(axis=1))
+		results = as_array(results)
 
-		size = zscores.size
-		is_nan = zscores.mask
-		valid_indices = np.where(~is_nan)
-		invalid_indices = np.where(is_nan)
+		valid = ~np.isnan(results)
+		count = valid.sum(axis=1)
+		zscore_sum = np.where(valid, results, 0.0).sum(axis=1)
 
-		pv = stats.norm.sf(zscores[valid_indices])
+		zscores = np.empty(results.shape[0])
+		zscores[:] = np.nan
 
-		pvalues = np.empty(size)
-		pvalues[valid_indices] = pv
-		pvalues[invalid_indices] = np.nan
+		combined = count > 0
+		zscores[combined] = zscore_sum[combined] / np.sqrt(count[combined])
 
-		if pv.size != 0:
-			qv = multipletests(pv, method='fdr_bh')[1]
-		else:
-			qv = np.array([])
-		qvalues = np.empty(size)
-		qvalues[valid_indices] = qv
-		qvalues[invalid_indices] = np.nan
+		pvalues = np.empty(results.shape[0])
+		pvalues[:] = np.nan
+		pvalues[combined] = stats.norm.sf(zscores[combined])
 
-		return np.array([zscores, pvalues, qvalues])
+		return np.array([zscores, pvalues, fdr_bh(pvalues)])
 
 class MeanZscoreTest(ZscoreTest):
 	NAME = "mean-zscore"
+	ESTIMATOR = "mean"
 
 	def observed(self, data):
 		return np.ma.mean(data)
 
+	def observed_segments(self, values, indptr):
+		return segment_means(values, indptr)
+
 	def estimator(self, sample):
 		return np.mean(sample)
 
+	def estimators(self, samples):
+		return np.mean(samples, axis=1)
+
 class MedianZscoreTest(ZscoreTest):
 	NAME = "median-zscore"
+	ESTIMATOR = "median"
 
 	def observed(self, data):
 		return np.ma.median(data)
 
+	def observed_segments(self, values, indptr):
+		return segment_medians(values, indptr)
+
 	def estimator(self, sample):
 		return np.median(sample)
+
+	def estimators(self, samples):
+		return np.median(samples, axis=1)
@@ -0,0 +1,64 @@
+import numpy as np
+
+# Maximum number of elements of an index matrix drawn at once
+MAX_BLOCK_SIZE = 2 ** 22
+
+def sample_indices(size, count, num_samplings, rs=np.random):
+	"""
+	Draws num_samplings random samples of count elements without replacement from range(size).
+	:param size: the population size
+	:param count: the number of elements of each sample
+	:param num_samplings: the number of samples to draw
+	:param rs: the random state to draw from
+	:return: [num_samplings, count] index matrix
+	"""
+
+	if count > size:
+		raise ValueError("Sample larger than population: {0} > {1}".format(count, size))
+
+	if count * 2 > size:
+		# Dense samples: take the positions of the count smallest random keys of each row
+		keys = rs.random_sample((num_samplings, size))
+		return np.argpartition(keys, count - 1, axis=1)[:, :count]
+
+	# Sparse samples: draw with replacement and redraw the duplicates until there are none left.
+	# The process is symmetric on the population elements, so the resulting subsets are uniform.
+
+	indices = rs.randint(0, size, (num_samplings, count))
+	while True:
+		indices.sort(axis=1)
+		rows, cols = np.nonzero(indices[:, 1:] == indices[:, :-1])
+		if rows.size == 0:
+			break
+		indices[rows, cols + 1] = rs.randint(0, size, rows.size)
+
+	return indices
+
+def sample_estimations(estimators, background, count, num_samplings, rs=np.random):
+	"""
+	Estimates num_samplings random samples of count elements from the background.
+	:param estimators: vectorized estimator reducing a [samplings, count] matrix into [samplings]
+	:param background: the values to sample from
+	:param count: the number of elements of each sample
+	:param num_samplings: the number of samples
+	:param rs: the random state to draw from
+	:return: [num_samplings] estimations
+	"""
+
+	background = np.asarray(background)
+
+	estimations = np.empty(num_samplings)
+
+	if num_samplings == 0:
+		return estimations
+
+	# Dense samples need a random key per background element
+	row_size = background.size if count * 2 > background.size else count
+	block_size = max(1, MAX_BLOCK_SIZE // max(row_size, 1))
+
+	for start in xrange(0, num_samplings, block_size):
+		end = min(start + block_size, num_samplings)
+		indices = sample_indices(background.size, count, end - start, rs)
+		estimations[start:end] = estimators(background[indices])
+
+	return estimations
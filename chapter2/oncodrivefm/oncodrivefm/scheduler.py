@@ -0,0 +1,87 @@
+import threading
+import traceback
+
+import multiprocessing as mp
+
+from background import BackgroundStore
+
+class TaskError(Exception):
+	pass
+
+def _run_task(task):
+	func, params = task
+	try:
+		return True, func(params)
+	except Exception:
+		return False, traceback.format_exc()
+
+class Scheduler(object):
+	"""
+	Runs tasks from several analyses over a shared worker pool.
+
+	Every task has a callback that is called with its result from the pool results thread,
+	callbacks can submit new tasks. Callbacks are never called concurrently.
+	"""
+
+	def __init__(self, num_cores=None):
+		self.pool = mp.Pool(num_cores)
+		self.store = BackgroundStore()
+
+		self._lock = threading.Lock()
+		self._finished = threading.Event()
+		self._finished.set()
+		self._pending = 0
+		self._errors = []
+
+	def submit(self, func, params, callback):
+		"""
+		Submits a task to be run by the workers
+		:param func: module level function to run with params
+		:param params: the function parameters
+		:param callback: function to call with the result once completed
+		"""
+
+		with self._lock:
+			self._pending += 1
+			self._finished.clear()
+
+		self.pool.apply_async(_run_task, ((func, params),),
+							  callback=lambda result: self._task_completed(result, callback))
+
+	def _task_completed(self, result, callback):
+		success, value = result
+		try:
+			if not success:
+				raise TaskError(value)
+			callback(value)
+		except TaskError as e:
+			self._errors += [e]
+		except Exception:
+			self._errors += [TaskError(traceback.format_exc())]
+
+		with self._lock:
+			self._pending -= 1
+			if self._pending == 0 or len(self._errors) > 0:
+				self._finished.set()
+
+	def wait(self):
+		"""
+		Waits until all the submitted tasks (and the ones submitted by their callbacks) are completed.
+		"""
+
+		try:
+			# Waiting with a timeout keeps the main thread responsive to keyboard interrupts
+			while not self._finished.wait(1.0):
+				pass
+		except KeyboardInterrupt:
+			self.pool.terminate()
+			raise
+
+		if len(self._errors) > 0:
+			self.pool.terminate()
+			raise self._errors[0]
+
+	def close(self):
+		self.pool.close()
+		self.pool.join()
+		self.store.close()
@@ -0,0 +1,76 @@
+import numpy as np
+
+# Reductions over contiguous segments of a flat array,
+# the segment i is values[indptr[i]:indptr[i + 1]].
+
+def segment_lengths(indptr):
+	return np.diff(indptr)
+
+def segment_ids(indptr):
+	"""
+	Returns the segment index of every element
+	"""
+
+	return np.repeat(np.arange(len(indptr) - 1), segment_lengths(indptr))
+
+def segment_take(indptr, segments):
+	"""
+	Selects some segments
+	:param indptr: the segments boundaries
+	:param segments: the indices of the segments to select
+	:return: (indices, new_indptr) where indices are the positions of the elements of the selected segments
+	in the flat array, and new_indptr the boundaries of the selected segments in indices
+	"""
+
+	segments = np.asarray(segments, dtype=np.int64)
+	starts = indptr[segments]
+	lengths = indptr[segments + 1] - starts
+
+	new_indptr = np.zeros(segments.size + 1, dtype=np.int64)
+	np.cumsum(lengths, out=new_indptr[1:])
+
+	# Position of every element inside its segment plus the start of the segment in the flat array
+	offsets = np.repeat(starts - new_indptr[:-1], lengths)
+	indices = np.arange(new_indptr[-1], dtype=np.int64) + offsets
+
+	return indices, new_indptr
+
+def segment_sums(values, indptr):
+	lengths = segment_lengths(indptr)
+	sums = np.zeros(lengths.size, dtype=np.result_type(values.dtype, np.float64))
+	non_empty = lengths > 0
+	if np.any(non_empty):
+		sums[non_empty] = np.add.reduceat(values[:indptr[-1]], indptr[:-1][non_empty])
+	return sums
+
+def segment_counts(counts, indptr):
+	"""
+	Integer sums over segments
+	"""
+
+	cumsum = np.zeros(len(counts) + 1, dtype=np.int64)
+	np.cumsum(counts, out=cumsum[1:])
+	return cumsum[indptr[1:]] - cumsum[indptr[:-1]]
+
+def segment_means(values, indptr):
+	lengths = segment_lengths(indptr)
+	means = np.empty(lengths.size)
+	means[:] = np.nan
+	non_empty = lengths > 0
+	means[non_empty] = segment_sums(values, indptr)[non_empty] / lengths[non_empty]
+	return means
+
+def segment_medians(values, indptr):
+	lengths = segment_lengths(indptr)
+
+	# Sort the values inside every segment
+	sorted_values = values[np.lexsort((values, segment_ids(indptr)))]
+
+	medians = np.empty(lengths.size)
+	medians[:] = np.nan
+	non_empty = np.nonzero(lengths > 0)[0]
+	starts = indptr[non_empty]
+	lo = starts + (lengths[non_empty] - 1) // 2
+	hi = starts + lengths[non_empty] // 2
+	medians[non_empty] = (sorted_values[lo] + sorted_values[hi]) / 2.0
+	return medians
@@ -0,0 +1,235 @@
+import os
+import os.path
+import json
+import socket
+import tempfile
+
+import numpy as np
+
+from method.factory import create_method
+from analysis import sampling, SAMPLINGS_PER_TASK
+
+class ShardStore(object):
+	"""
+	Shared directory where the samplings of an analysis are split into shards
+	that are run by independent workers, in other processes or hosts, and merged once completed.
+
+	Layout:
+	  plan.json                the analysis parameters and the null distributions to sample
+	  backgrounds/N.npy        the background of every slice
+	  pending/ID.json          shards not claimed yet
+	  running/ID.json.WORKER   shards claimed by a worker
+	  samples/ID.npy           the estimations of the completed shards
+
+	Shards are claimed renaming them from pending to running, so every shard is run by a single worker.
+	"""
+
+	PLAN = "plan.json"
+
+	def __init__(self, path):
+		self.path = path
+
+		self.params = None
+		self.distributions = {}
+
+		self._num_backgrounds = 0
+
+	def _path(self, *names):
+		return os.path.join(self.path, *names)
+
+	def _write(self, path, save):
+		"""
+		Writes a file with a hidden temporary name and renames it once completed
+		"""
+
+		fd, tmp_path = tempfile.mkstemp(prefix=".", dir=os.path.dirname(path))
+		try:
+			with os.fdopen(fd, "wb") as f:
+				save(f)
+			os.rename(tmp_path, path)
+		except:
+			os.remove(tmp_path)
+			raise
+
+	def create(self, params):
+		"""
+		Initializes an empty plan
+		:param params: the analysis parameters that have to match when merging
+		"""
+
+		if os.path.exists(self._path(self.PLAN)):
+			raise Exception("There is already a plan in {0}".format(self.path))
+
+		for name in ["backgrounds", "pending", "running", "samples"]:
+			path = self._path(name)
+			if not os.path.exists(path):
+				os.makedirs(path)
+
+		self.params = params
+		self.distributions = {}
+
+	def add_background(self, background):
+		"""
+		:return: the background path relative to the store
+		"""
+
+		path = os.path.join("backgrounds", "{0}.npy".format(self._num_backgrounds))
+		self._num_backgrounds += 1
+
+		self._write(self._path(path), lambda f: np.save(f, np.ascontiguousarray(background)))
+
+		return path
+
+	def add_distribution(self, slice_name, background_digest, background_path, method_name, mut_count,
+						 num_samplings, shard_size, seed=None):
+		"""
+		Splits the samplings of a null distribution into pending shards of at most shard_size samplings
+		:return: the number of shards
+		"""
+
+		shard_ids = []
+		for offset in xrange(0, num_samplings, shard_size):
+			shard = dict(
+				id="{0}-{1}-{2}".format(len(self.distributions), mut_count, offset),
+				background=background_path,
+				method=method_name,
+				mut_count=mut_count,
+				offset=offset,
+				count=min(shard_size, num_samplings - offset),
+				seed=seed)
+
+			self._write(self._path("pending", "{0}.json".format(shard["id"])), lambda f: json.dump(shard, f))
+
+			shard_ids += [shard["id"]]
+
+		self.distributions["{0}:{1}".format(slice_name, mut_count)] = dict(
+			background_digest=background_digest, shards=shard_ids)
+
+		return len(shard_ids)
+
+	def save(self):
+		plan = dict(params=self.params, distributions=self.distributions)
+		self._write(self._path(self.PLAN), lambda f: json.dump(plan, f))
+
+	def load(self):
+		path = self._path(self.PLAN)
+		if not os.path.exists(path):
+			raise Exception("Shards plan not found: {0}".format(path))
+
+		with open(path) as f:
+			plan = json.load(f)
+
+		self.params = plan["params"]
+		self.distributions = plan["distributions"]
+
+	def claim(self, worker):
+		"""
+		Claims a pending shard
+		:return: (shard, running_path) or None when there are no more pending shards
+		"""
+
+		for name in sorted(os.listdir(self._path("pending"))):
+			if name.startswith(".") or not name.endswith(".json"):
+				continue
+
+			running_path = self._path("running", "{0}.{1}".format(name, worker))
+			try:
+				os.rename(self._path("pending", name), running_path)
+			except OSError:
+				# Claimed by another worker
+				continue
+
+			with open(running_path) as f:
+				return json.load(f), running_path
+
+		return None
+
+	def complete(self, shard, running_path, estimations):
+		self._write(self._path("samples", "{0}.npy".format(shard["id"])), lambda f: np.save(f, estimations))
+		os.remove(running_path)
+
+	def requeue(self):
+		"""
+		Moves the claimed shards back to pending, i.e. after a worker failure
+		:return: the number of shards requeued
+		"""
+
+		count = 0
+		for name in os.listdir(self._path("running")):
+			if name.startswith("."):
+				continue
+			shard_name = name[:name.index(".json") + len(".json")]
+			os.rename(self._path("running", name), self._path("pending", shard_name))
+			count += 1
+		return count
+
+	def status(self):
+		"""
+		:return: (pending, running, completed) number of shards
+		"""
+
+		count = lambda name: len([n for n in os.listdir(self._path(name)) if not n.startswith(".")])
+		return count("pending"), count("running"), count("samples")
+
+	def samples(self, slice_name, background_digest, mut_count):
+		"""
+		Merges the estimations of the shards of a null distribution
+		"""
+
+		key = "{0}:{1}".format(slice_name, mut_count)
+		if key not in self.distributions:
+			raise Exception("Null distribution not planned for {0} with {1} mutations".format(slice_name, mut_count))
+
+		distribution = self.distributions[key]
+		if distribution["background_digest"] != background_digest:
+			raise Exception("The background of {0} does not match the planned one".format(slice_name))
+
+		estimations = []
+		for shard_id in distribution["shards"]:
+			path = self._path("samples", "{0}.npy".format(shard_id))
+			if not os.path.exists(path):
+				raise Exception("Shard not completed: {0}".format(shard_id))
+			estimations += [np.load(path)]
+
+		return np.concatenate(estimations)
+
+def run_shard(store, shard):
+	"""
+	Computes the estimations of a shard with the same tasks and random streams than a local analysis
+	"""
+
+	method = create_method(shard["method"])
+	background_path = store._path(shard["background"])
+	mut_count, offset, count, seed = shard["mut_count"], shard["offset"], shard["count"], shard["seed"]
+
+	estimations = []
+	for start in xrange(0, count, SAMPLINGS_PER_TASK):
+		task_seed = seed + [offset + start] if seed is not None else None
+		params = (method, background_path, mut_count, min(SAMPLINGS_PER_TASK, count - start), task_seed)
+		estimations += [sampling(params)]
+
+	return np.concatenate(estimations)
+
+def run_worker(path, worker=None):
+	"""
+	Runs pending shards until there are no more
+	:param worker: the worker name, by default the host name and the process id
+	:return: the number of shards run
+	"""
+
+	if worker is None:
+		worker = "{0}-{1}".format(socket.gethostname(), os.getpid())
+
+	store = ShardStore(path)
+
+	count = 0
+	while True:
+		claimed = store.claim(worker)
+		if claimed is None:
+			break
+
+		shard, running_path = claimed
+		store.complete(shard, running_path, run_shard(store, shard))
+		count += 1
+
+	return count
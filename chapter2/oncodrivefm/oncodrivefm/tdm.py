@@ -1,73 +1,269 @@
-from matrix import Matrix
+import gzip
 
-def load_matrix(path):
-	# First step is to know which rows/columns/slices there are.
-	with open(path) as f:
-		first_data_line=0
+import numpy as np
+
+from matrix import Matrix, SparseMatrix
+
+# Approximate number of bytes parsed at once
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# Tokens representing missing values
+NULL_VALUES = ["", "-", "NA", "na", "NaN", "nan", "None", "null"]
+
+# Factor by which the buffers grow when the values don't fit
+GROWTH_FACTOR = 1.25
+
+def _open(path):
+	if path.endswith(".gz"):
+		return gzip.open(path, "rb")
+	return open(path)
+
+def _read_header(f):
+	"""
+	Skips the comments and returns the header fields or None if the file is empty
+	"""
+
+	line = f.readline()
+	while len(line) > 0 and line.startswith("#"):
 		line = f.readline()
-		while len(line) > 0 and line.startswith("#"):
-			first_data_line += 1
-			line = f.readline()
+
+	if len(line) == 0:
+		return None
+
+	return line.rstrip("\n").split("\t")
+
+def _read_chunks(f, num_names, num_values):
+	"""
+	Reads the data lines by chunks
+	:param f: the file positioned after the header
+	:param num_names: the number of name columns at the beginning of each line
+	:param num_values: the number of value columns
+	:return: iterator of ([names_0, ..., names_n], [value_tokens]) for each chunk
+	"""
+
+	width = num_names + num_values
+
+	while True:
+		lines = f.readlines(CHUNK_SIZE)
+		if len(lines) == 0:
+			break
+
+		names = [[] for i in xrange(num_names)]
+		tokens = []
+		for line in lines:
+			if line.startswith("#"):
+				continue
+
+			r = line.rstrip("\n").split("\t")
+			if len(r) < num_names + 1:
+				if len(r) == 1 and len(r[0]) == 0:
+					continue
+				raise Exception("Malformed row, at least {0} columns are required: {1}".format(
+					num_names + 1, line.rstrip("\n")))
+
+			if len(r) < width:
+				r += [""] * (width - len(r))
+
+			for i in xrange(num_names):
+				names[i] += [r[i]]
+			tokens += r[num_names:width]
+
+		yield names, tokens
+
+def parse_values(tokens):
+	"""
+	Converts a list of value tokens into an array of floats, missing and malformed values are NaN
+	"""
+
+	values = np.array(tokens)
+	if values.size == 0:
+		return np.empty(0)
+
+	values[np.in1d(values, NULL_VALUES)] = "nan"
+
+	try:
+		return values.astype(np.float64)
+	except ValueError:
+		pass
+
+	parsed = np.empty(values.size)
+	for i, x in enumerate(values):
+		try:
+			parsed[i] = float(x)
+		except ValueError:
+			parsed[i] = np.nan
+	return parsed
+
+def name_indices(names, name_index, index_names):
+	"""
+	Returns the indices of the names, registering the new ones
+	"""
+
+	indices = np.empty(len(names), dtype=np.int64)
+	for i, name in enumerate(names):
+		index = name_index.get(name)
+		if index is None:
+			index = name_index[name] = len(index_names)
+			index_names += [name]
+		indices[i] = index
+	return indices
+
+def _capacity(capacity, required):
+	if required <= capacity:
+		return capacity
+	return max(required, int(capacity * GROWTH_FACTOR))
+
+def _append(buf, size, values):
+	"""
+	Copies the values at the position size of a buffer that grows geometrically along the first axis
+	:return: the buffer, resized in place if required
+	"""
+
+	end = size + values.shape[0]
+	if end > buf.shape[0]:
+		buf.resize((_capacity(buf.shape[0], end),) + buf.shape[1:], refcheck=False)
+	buf[size:end] = values
+	return buf
+
+def _reshape_slices(buf, num_slices, shape, new_shape):
+	"""
+	Changes in place the number of rows and columns of a flat [slices, rows, cols] buffer.
+	The values that fit in the new shape are kept and the new ones are NaN.
+	:return: the buffer, resized in place if required
+	"""
+
+	rows, cols = shape
+	new_rows, new_cols = new_shape
+	size = num_slices * new_rows * new_cols
+
+	if size > buf.size:
+		buf.resize(size, refcheck=False)
+
+	# the blocks move forward when growing and backwards when shrinking, so they are moved in the order
+	# that never overwrites the ones still not moved
+	keep_rows, keep_cols = min(rows, new_rows), min(cols, new_cols)
+	if cols == new_cols:
+		blocks = [(s * rows * cols, s * new_rows * cols, keep_rows * cols) for s in xrange(num_slices)]
+	else:
+		blocks = [((s * rows + r) * cols, (s * new_rows + r) * new_cols, keep_cols)
+				  for s in xrange(num_slices) for r in xrange(keep_rows)]
+
+	if size > num_slices * rows * cols:
+		blocks.reverse()
+
+	for src, dst, length in blocks:
+		if src != dst:
+			buf[dst:dst + length] = buf[src:src + length]
+
+	data = buf[:size].reshape((num_slices, new_rows, new_cols))
+	data[:, keep_rows:, :] = np.nan
+	data[:, :keep_rows, keep_cols:] = np.nan
+	del data
+
+	if size < buf.size:
+		buf.resize(size, refcheck=False)
+
+	return buf
+
+def load_matrix(path, sparse=False):
+	"""
+	Loads a matrix in TDM format (column, row, slice values ...) in a single pass.
+	Files ending with .gz are decompressed on the fly.
+	The values of every chunk are copied into buffers that grow as new rows and columns are found.
+	:param sparse: whether to load it as a SparseMatrix, that only keeps the valid values
+	"""
+
+	with _open(path) as f:
+		hdr = _read_header(f)
 
 		# If the file is empty
-		if len(line) == 0:
-			return Matrix(0, 0, 0)
+		if hdr is None:
+			return SparseMatrix(0, 0, 0) if sparse else Matrix(0, 0, 0)
 
-		# Parse header
-		first_data_line += 1
-		hdr = line.rstrip("\n").split("\t")
 		if len(hdr) < 3:
 			raise Exception("Malformed header, at least 3 columns are required")
 
 		slice_names = hdr[2:]
+		num_slices = len(slice_names)
 
-		row_indices = {}
-		col_indices = {}
+		row_index, row_names = {}, []
+		col_index, col_names = {}, []
 
-		for line in f:
-			if line.startswith("#"):
+		# the coordinates and values of the sparse matrix, or the flat [slices, rows, cols] data of the dense one
+		size = 0
+		rows_buf = np.empty(0, dtype=np.int64)
+		cols_buf = np.empty(0, dtype=np.int64)
+		values_buf = np.empty((0, num_slices))
+
+		data = np.empty(0)
+		shape = (0, 0)
+
+		for (col_chunk, row_chunk), tokens in _read_chunks(f, 2, num_slices):
+			cols = name_indices(col_chunk, col_index, col_names)
+			rows = name_indices(row_chunk, row_index, row_names)
+			values = parse_values(tokens).reshape((-1, num_slices))
+			del tokens
+
+			if sparse:
+				rows_buf = _append(rows_buf, size, rows)
+				cols_buf = _append(cols_buf, size, cols)
+				values_buf = _append(values_buf, size, values)
+				size += values.shape[0]
 				continue
 
-			r = line.rstrip("\n").split("\t")
-			if len(r) < 3:
-				raise Exception("Malformed row, at least 3 columns are required: {0}".format(line.rstrip("\n")))
+			new_shape = (_capacity(shape[0], len(row_names)), _capacity(shape[1], len(col_names)))
+			if new_shape != shape:
+				data = _reshape_slices(data, num_slices, shape, new_shape)
+				shape = new_shape
 
-			col_name, row_name = r[0:2]
+			data.reshape((num_slices,) + shape)[:, rows, cols] = values.T
 
-			if row_name not in row_indices:
-				row_indices[row_name] = len(row_indices)
-			if col_name not in col_indices:
-				col_indices[col_name] = len(col_indices)
+	if sparse:
+		mat = SparseMatrix(num_rows=len(row_names), num_cols=len(col_names), num_slices=num_slices,
+			row_names=row_names, col_names=col_names, slice_names=slice_names)
 
-	row_names = [None] * len(row_indices)
-	for name, index in row_indices.items():
-		row_names[index] = name
+		for slice in xrange(num_slices):
+			mat.set_slice_values(slice, rows_buf[:size], cols_buf[:size], values_buf[:size, slice])
 
-	col_names = [None] * len(col_indices)
-	for name, index in col_indices.items():
-		col_names[index] = name
+		return mat
 
-	# Then initialize the Matrix and load the data
-	mat = Matrix(num_rows=len(row_names), num_cols=len(col_names), num_slices=len(slice_names),
-		row_names=row_names, col_names=col_names, slice_names=slice_names)
+	data = _reshape_slices(data, num_slices, shape, (len(row_names), len(col_names)))
 
-	with open(path) as f:
-		# Discard headers
-		while first_data_line > 0:
-			f.readline()
-			first_data_line -= 1
+	return Matrix(num_rows=len(row_names), num_cols=len(col_names), num_slices=num_slices,
+		row_names=row_names, col_names=col_names, slice_names=slice_names,
+		data=data.reshape((num_slices, len(row_names), len(col_names))))
 
-		for line in f:
-			r = line.rstrip("\n").split("\t")
-			col_name, row_name = r[0:2]
-			fields = r[2:]
-			d = [None] * len(fields)
-			for i, x in enumerate(fields):
-				try:
-					d[i] = float(x)
-				except:
-					pass
-
-				mat.set_slices(row_name, col_name, d)
-
-	return mat
+def load_plain_matrix(path, slice_name):
+	"""
+	Loads a plain matrix (row, column values ...) as a matrix with a single slice.
+	Files ending with .gz are decompressed on the fly.
+	"""
+
+	with _open(path) as f:
+		hdr = _read_header(f)
+
+		# If the file is empty
+		if hdr is None:
+			return Matrix(0, 0, 0)
+
+		if len(hdr) < 2:
+			raise Exception("Malformed header, at least 2 columns are required")
+
+		col_names = hdr[1:]
+		num_cols = len(col_names)
+
+		row_names = []
+		data = np.empty((0, num_cols))
+
+		for (row_chunk,), tokens in _read_chunks(f, 1, num_cols):
+			data = _append(data, len(row_names), parse_values(tokens).reshape((-1, num_cols)))
+			row_names += row_chunk
+
+	if len(set(row_names)) != len(row_names):
+		raise Exception("Duplicated row names found in {0}".format(path))
+
+	data.resize((len(row_names), num_cols), refcheck=False)
+
+	return Matrix(num_rows=len(row_names), num_cols=num_cols, num_slices=1,
+		row_names=row_names, col_names=col_names, slice_names=[slice_name],
+		data=data.reshape((1, len(row_names), num_cols)))
@@ -32,7 +32,9 @@ setup(
 			#'oncodrivefm-genes = oncodrivefm.deprecated.command:genes',
 			#'oncodrivefm-pathways = oncodrivefm.deprecated.command:pathways',
 			'oncodrivefm-compute = oncodrivefm.command.compute:main',
-			'oncodrivefm-combine = oncodrivefm.command.combine:main'
+			'oncodrivefm-combine = oncodrivefm.command.combine:main',
+			'oncodrivefm-convert = oncodrivefm.command.convert:main',
+			'oncodrivefm-worker = oncodrivefm.command.worker:main'
 		]
 	},
 
@@ -1,24 +1,249 @@
+import os
+import gzip
+import shutil
+import tempfile
 import unittest as ut
 
+import numpy as np
+from scipy import stats
+from statsmodels.sandbox.stats.multicomp import multipletests
+
+from oncodrivefm import tdm
+from oncodrivefm import binmatrix
+from oncodrivefm.analysis import OncodriveFmAnalysis
+from oncodrivefm.mapping import MatrixMapping
+from oncodrivefm.matrix import Matrix
+from oncodrivefm.method.base import PVALUE_EPSILON, fdr_bh
+from oncodrivefm.method.factory import create_method
+from oncodrivefm.shards import ShardStore, run_worker
+
+# Helpers -------------------------------------------------------------------------------------------------------------
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "CLL.tdm")
+
+def load_reference_matrix(path):
+	"""
+	Parses a TDM file line by line as the loader did before reading it by chunks
+	:return: (row_names, col_names, slice_names, [slices, rows, cols] data)
+	"""
+
+	with open(path) as f:
+		lines = [line.rstrip("\n").split("\t") for line in f if not line.startswith("#")]
+
+	slice_names = lines[0][2:]
+
+	row_index, col_index = {}, {}
+	for fields in lines[1:]:
+		col_name, row_name = fields[0:2]
+		row_index.setdefault(row_name, len(row_index))
+		col_index.setdefault(col_name, len(col_index))
+
+	data = np.empty((len(slice_names), len(row_index), len(col_index)))
+	data[:] = np.nan
+	for fields in lines[1:]:
+		for slice, value in enumerate(fields[2:]):
+			try:
+				data[slice, row_index[fields[1]], col_index[fields[0]]] = float(value)
+			except ValueError:
+				pass
+
+	names = lambda index: sorted(index, key=index.get)
+
+	return names(row_index), names(col_index), slice_names, data
+
+class MatrixAssertions(object):
+	def assertMatrixEqual(self, matrix, row_names, col_names, slice_names, data):
+		self.assertEqual((matrix.row_names, matrix.col_names, matrix.slice_names), (row_names, col_names, slice_names))
+		for slice in xrange(len(slice_names)):
+			np.testing.assert_array_equal(matrix.dense_slice(slice), data[slice])
+
 # Test mapping --------------------------------------------------------------------------------------------------------
 
-# TODO test mapping
+class MappingTests(ut.TestCase):
+	def test_group_rows(self):
+		matrix = Matrix(4, 1, 1, row_names=["A", "B", "C", "D"], col_names=["S"], slice_names=["X"])
+		mapping = MatrixMapping(matrix, dict(G1=["C", "A", "UNKNOWN"], G2=[], G3=["D"]))
+
+		rows = dict((name, mapping.group_rows[mapping.group_indptr[i]:mapping.group_indptr[i + 1]].tolist())
+					for i, name in enumerate(mapping.group_names))
+		self.assertEqual(rows, dict(G1=[2, 0], G2=[], G3=[3]))
 
 # Test matrix and tdm -------------------------------------------------------------------------------------------------
 
-# TODO test matrix and tdm
+class TdmTests(ut.TestCase, MatrixAssertions):
+	def setUp(self):
+		self.path = tempfile.mkdtemp(prefix="oncodrivefm-tests-")
+		self.expected = load_reference_matrix(DATA_PATH)
+
+	def tearDown(self):
+		shutil.rmtree(self.path)
+
+	def test_load_matrix(self):
+		for sparse in [False, True]:
+			self.assertMatrixEqual(tdm.load_matrix(DATA_PATH, sparse=sparse), *self.expected)
+
+	def test_load_matrix_chunks(self):
+		# Small chunks make the buffers grow several times
+		chunk_size = tdm.CHUNK_SIZE
+		tdm.CHUNK_SIZE = 512
+		try:
+			for sparse in [False, True]:
+				self.assertMatrixEqual(tdm.load_matrix(DATA_PATH, sparse=sparse), *self.expected)
+		finally:
+			tdm.CHUNK_SIZE = chunk_size
+
+	def test_load_gzip_matrix(self):
+		path = os.path.join(self.path, "data.tdm.gz")
+		with open(DATA_PATH) as src:
+			f = gzip.open(path, "wb")
+			f.write(src.read())
+			f.close()
+
+		self.assertMatrixEqual(tdm.load_matrix(path), *self.expected)
+
+	def test_load_plain_matrix(self):
+		row_names, col_names, slice_names, data = self.expected
+
+		path = os.path.join(self.path, "data.tsv")
+		with open(path, "w") as f:
+			f.write("\t".join(["ID"] + col_names) + "\n")
+			for row_name, values in zip(row_names, data[0]):
+				f.write("\t".join([row_name] + ["NA" if np.isnan(v) else repr(v) for v in values]) + "\n")
+
+		self.assertMatrixEqual(tdm.load_plain_matrix(path, "SIFT"), row_names, col_names, ["SIFT"], data[:1])
+
+	def test_binary_matrix(self):
+		row_names, col_names, slice_names, data = self.expected
+		path = os.path.join(self.path, "data" + binmatrix.EXTENSION)
+
+		for sparse in [False, True]:
+			binmatrix.save_matrix(tdm.load_matrix(DATA_PATH, sparse=sparse), path, params=[("source", "CLL")])
+			self.assertTrue(binmatrix.is_binary_matrix(path))
+			self.assertEqual(binmatrix.load_params(path), dict(source="CLL"))
+			self.assertMatrixEqual(binmatrix.load_matrix(path), *self.expected)
+
+		binmatrix.save_matrix(tdm.load_matrix(DATA_PATH), path, dtype="float32")
+		matrix = binmatrix.load_matrix(path)
+		self.assertEqual(matrix.dtype, np.float32)
+		self.assertMatrixEqual(matrix, row_names, col_names, slice_names, data.astype(np.float32))
+
+		self.assertFalse(binmatrix.is_binary_matrix(DATA_PATH))
 
 # Test methods --------------------------------------------------------------------------------------------------------
 
-# TODO test methods
+class MethodsTests(ut.TestCase):
+	def test_empirical_compare(self):
+		rs = np.random.RandomState(1)
+		samples = rs.rand(1000)
+		observed = np.array([0.0, 0.5, 0.999, 2.0, np.nan])
+
+		pvalues = create_method("mean-empirical").compare(observed, samples)
+
+		counts = [np.count_nonzero(samples >= v) if not np.isnan(v) else 0 for v in observed]
+		expected = [max(count / float(samples.size), PVALUE_EPSILON) for count in counts]
+		np.testing.assert_array_equal(pvalues, expected)
+
+	def test_fdr_bh(self):
+		pvalues = np.array([0.01, 0.04, np.nan, 0.03, 0.5, 0.04, 0.001])
+		valid = ~np.isnan(pvalues)
+
+		qvalues = fdr_bh(pvalues)
+
+		self.assertTrue(np.isnan(qvalues[2]))
+		np.testing.assert_allclose(qvalues[valid], multipletests(pvalues[valid], method="fdr_bh")[1])
+
+	def test_empirical_combine(self):
+		results = np.array([[0.01, 0.2, np.nan], [np.nan, np.nan, np.nan], [0.5, 0.04, 0.3]])
+
+		pvalues, qvalues = create_method("mean-empirical").combine(results)
+
+		self.assertTrue(np.isnan(pvalues[1]))
+		self.assertAlmostEqual(pvalues[0], stats.combine_pvalues([0.01, 0.2], method="fisher")[1])
+		self.assertAlmostEqual(pvalues[2], stats.combine_pvalues([0.5, 0.04, 0.3], method="fisher")[1])
 
 # Test analysis -------------------------------------------------------------------------------------------------------
 
-# TODO test analysis
+METHOD = "mean-empirical"
+
+class AnalysisTests(ut.TestCase):
+	@classmethod
+	def setUpClass(cls):
+		cls.matrix = tdm.load_matrix(DATA_PATH)
+		cls.mapping = MatrixMapping(cls.matrix, dict((name, [name]) for name in cls.matrix.row_names))
+		cls.slices = range(cls.matrix.num_slices)
+
+	def setUp(self):
+		self.path = tempfile.mkdtemp(prefix="oncodrivefm-tests-")
+
+	def tearDown(self):
+		shutil.rmtree(self.path)
+
+	def analysis(self, **kwargs):
+		params = dict(num_samplings=2000, mut_threshold=2, num_cores=1, seed=7)
+		params.update(kwargs)
+		return OncodriveFmAnalysis("oncodrivefm.tests", **params)
+
+	def compute(self, matrix=None, **kwargs):
+		return self.analysis(**kwargs).compute(matrix or self.matrix, self.mapping, METHOD, self.slices)
+
+	def test_cores(self):
+		results = self.compute()
+		self.assertTrue(np.count_nonzero(~np.isnan(results)) > 0)
+		np.testing.assert_array_equal(self.compute(num_cores=3), results)
+
+	def test_adaptive_cores(self):
+		results = self.compute(num_samplings=8000, adaptive_exceedances=10)
+		np.testing.assert_array_equal(self.compute(num_samplings=8000, adaptive_exceedances=10, num_cores=3), results)
+
+	def test_sparse(self):
+		np.testing.assert_array_equal(self.compute(matrix=tdm.load_matrix(DATA_PATH, sparse=True)), self.compute())
+
+	def test_cache(self):
+		cache_path = os.path.join(self.path, "cache")
+		results = self.compute(cache_path=cache_path)
+
+		analysis = self.analysis(cache_path=cache_path)
+		hits = []
+		cache_get = analysis.cache.get
+		def get(key):
+			estimations = cache_get(key)
+			hits.append(estimations is not None)
+			return estimations
+		analysis.cache.get = get
+
+		np.testing.assert_array_equal(analysis.compute(self.matrix, self.mapping, METHOD, self.slices), results)
+		self.assertTrue(len(hits) > 0 and all(hits))
+
+	def test_stream_results(self):
+		results = self.compute()
+
+		streamed = {}
+		def slice_completed(slice_results_index, slice_results):
+			streamed[slice_results_index] = slice_results
+
+		self.assertIsNone(self.analysis().compute(self.matrix, self.mapping, METHOD, self.slices,
+												  slice_completed, keep_results=False))
+		np.testing.assert_array_equal(np.array([streamed[i] for i in self.slices]), results)
+
+	def test_shards(self):
+		results = self.compute()
+
+		shards_path = os.path.join(self.path, "shards")
+		num_shards = self.analysis().plan(ShardStore(shards_path), self.matrix, self.mapping, METHOD, self.slices,
+										  shard_size=1000)
+		self.assertEqual(run_worker(shards_path, worker="w1"), num_shards)
+
+		store = ShardStore(shards_path)
+		self.assertEqual(store.status(), (0, 0, num_shards))
+		np.testing.assert_array_equal(self.analysis().reduce(store, self.matrix, self.mapping, METHOD, self.slices),
+									  results)
+
+		self.assertRaises(Exception, self.analysis(seed=8).reduce, ShardStore(shards_path),
+						  self.matrix, self.mapping, METHOD, self.slices)
 
 # Test commands -------------------------------------------------------------------------------------------------------
 
 # TODO test commands
 
 if __name__ == "__main__":
-	ut.main()
\ No newline at end of file
+	ut.main()
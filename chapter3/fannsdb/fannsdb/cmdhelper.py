@@ -3,6 +3,7 @@ import errno
 
 from bgcore import logging as bglogging
 from fannsdb.db.sqlitedb import FannsSQLiteDb
+from fannsdb.db.columnar import FannsColumnarDb
 from fannsdb.db.mongodb import FannsMongoDb
 
 
@@ -57,7 +58,11 @@ class DbTrait(object):
 
 		self.logger.info("Opening database {} ...".format(os.path.basename(self.args.db_path)))
 
-		db = FannsSQLiteDb(self.args.db_path)
+		# columnar databases are directories
+		if os.path.isdir(self.args.db_path):
+			db = FannsColumnarDb(self.args.db_path)
+		else:
+			db = FannsSQLiteDb(self.args.db_path)
 		db.open()
 
 		if not db.is_initialized():
@@ -0,0 +1,540 @@
+import os
+import os.path
+import json
+import itertools
+from datetime import datetime
+
+import numpy as np
+
+from fannsdb.db import FannsDb
+from fannsdb.db.sqlitedb import FannsSQLiteDb, code_ranges, \
+	CHR, CHR_LIST, CHR_INDEX, STRANDS, STRAND_INDEX, BASES, BASE_INDEX, AA, AA_INDEX, DATE_FMT, DB_VERSION
+
+# Value of the missing ids and codes in the integer columns
+NULL_ID = -1
+
+# Number of rows scanned at once when there is no index for the filters
+SCAN_BLOCK_SIZE = 1 << 16
+
+# Number of rows converted into dictionaries at once
+ROWS_BLOCK_SIZE = 4096
+
+def column_path(path, name):
+	return os.path.join(path, "{}.npy".format(name))
+
+def scores_path(path, predictor):
+	return column_path(path, "scores_{}".format(predictor))
+
+def ids_path(path, var_name):
+	return os.path.join(path, "ids_{}.json".format(var_name))
+
+def map_path(path, id):
+	return os.path.join(path, "ann_{}.json".format(id))
+
+def column_stats(values):
+	"""
+	Calculates the statistics of a scores column without loading it entirely into memory
+	:return: (min, max, count) where min and max are None if there are no scores
+	"""
+
+	vmin = vmax = None
+	count = 0
+	for start in xrange(0, values.shape[0], SCAN_BLOCK_SIZE * 16):
+		block = values[start:start + SCAN_BLOCK_SIZE * 16]
+		block = block[~np.isnan(block)]
+		if block.size == 0:
+			continue
+
+		count += block.size
+		bmin, bmax = _scores_list(np.array([block.min(), block.max()]))
+		vmin = bmin if vmin is None else min(vmin, bmin)
+		vmax = bmax if vmax is None else max(vmax, bmax)
+
+	return vmin, vmax, count
+
+def _scores_list(values):
+	"""
+	Converts scores into python floats. The single precision scores are converted through their shortest
+	representation, so 0.1 is read as 0.1 and not as 0.10000000149.
+	"""
+
+	if values.dtype == np.float32:
+		return [float(v) for v in values.astype(str)]
+	return values.tolist()
+
+def _search_ranges(keys, ranges):
+	"""
+	Returns the positions of the sorted keys inside the ranges
+	"""
+
+	positions = [np.arange(np.searchsorted(keys, lo, side="left"), np.searchsorted(keys, hi, side="right"))
+				 for lo, hi in ranges]
+
+	return np.concatenate(positions) if len(positions) > 0 else np.empty(0, dtype=np.int64)
+
+def _in_ranges(codes, ranges, ref_mask, alt_mask, ref_shift):
+	"""
+	Returns which codes are inside the planned ranges
+	"""
+
+	keep = np.zeros(codes.shape, dtype=bool)
+	for lo, hi in ranges:
+		keep |= (codes >= lo) & (codes <= hi)
+
+	mask = (1 << ref_shift) - 1
+	if ref_mask is not None:
+		keep &= ((ref_mask >> ((codes >> ref_shift) & mask)) & 1) != 0
+	if alt_mask is not None:
+		keep &= ((alt_mask >> (codes & mask)) & 1) != 0
+
+	return keep
+
+class FannsColumnarDb(FannsDb):
+	"""
+	Read-only database where the scores are stored as numpy columns that are memory-mapped
+	and searched with binary search. It is created from another database with fannsdb.ops.columnar.
+
+	Layout:
+	  meta.json              version, predictors and maps
+	  ids_TYPE.json          {name : id} for transcripts and proteins
+	  ann_ID.json            [[source id, value]] for every map
+	  NAME.npy               id, dna_code, transcript_id, prot_code and protein_id
+	                         for every row, sorted by dna_code and transcript_id
+	  prot_key.npy           protein_id << 32 | prot_code of every row with a protein, sorted
+	  prot_rows.npy          the row of every prot_key
+	  scores_PREDICTOR.npy   the scores of a predictor for every row, NaN when missing.
+	                         Double precision unless exported with single_precision
+
+	The ids and codes have the types of COLUMN_TYPES, the prot_rows are 32 bits when possible.
+	"""
+
+	META = "meta.json"
+
+	MAPS_ARG = MAPS_KEY = "annotations"
+
+	COLUMNS = ["id", "dna_code", "transcript_id", "prot_code", "protein_id"]
+
+	# The ids of the transcripts and proteins and the protein codes fit in 32 bits
+	COLUMN_TYPES = dict(id=np.int64, dna_code=np.int64, transcript_id=np.int32, prot_code=np.int32,
+						protein_id=np.int32)
+
+	SCORES_TYPE = np.float64
+
+	# Type of the scores exported with single_precision, it rounds them
+	SINGLE_SCORES_TYPE = np.float32
+
+	ALL_FIELDS = FannsSQLiteDb.ALL_FIELDS
+	DNA_FIELDS = FannsSQLiteDb.DNA_FIELDS
+	PROTEIN_FIELDS = FannsSQLiteDb.PROTEIN_FIELDS
+
+	ALL_FILTERS = FannsSQLiteDb.ALL_FILTERS
+	DNA_FILTERS = FannsSQLiteDb.DNA_FILTERS
+	DNA_REQ_FILTERS = FannsSQLiteDb.DNA_REQ_FILTERS
+	PROTEIN_FILTERS = FannsSQLiteDb.PROTEIN_FILTERS
+	PROTEIN_REQ_FILTERS = FannsSQLiteDb.PROTEIN_REQ_FILTERS
+
+	def __init__(self, path):
+		self.path = path
+
+		self.__meta = None
+		self.__columns = None
+		self.__scores = None
+		self.__prot_key = None
+		self.__prot_rows = None
+
+		self.__ids = None
+		self.__names = None
+		self.__map_values = None
+		self.__map_sources = None
+
+		self.__predictors_by_id = None
+		self.__maps_by_id = None
+
+	def __load_column(self, path):
+		# plain arrays over the memory-mapped file avoid the overhead of memmap slicing
+		return np.asarray(np.load(path, mmap_mode="r"))
+
+	def __read_only(self):
+		raise Exception("The columnar database is read-only: {}".format(self.path))
+
+	def open(self, create=False):
+		if create:
+			raise Exception("Columnar databases are created from another database with export_columnar")
+
+		meta_path = os.path.join(self.path, self.META)
+		if not os.path.exists(meta_path):
+			raise Exception("Database not found: {}".format(self.path))
+
+		with open(meta_path) as f:
+			self.__meta = json.load(f)
+
+		db_version = self.__meta["db_version"]
+		if db_version != DB_VERSION:
+			raise Exception("Database version {} is incompatible, required {}".format(db_version, DB_VERSION))
+
+		self.db_version = db_version
+		self.creation_time = datetime.strptime(self.__meta["creation_time"], DATE_FMT)
+
+		self.__columns = dict([(name, self.__load_column(column_path(self.path, name))) for name in self.COLUMNS])
+		self.__prot_key = self.__load_column(column_path(self.path, "prot_key"))
+		self.__prot_rows = self.__load_column(column_path(self.path, "prot_rows"))
+		self.__scores = {}
+
+		self.__ids = {}
+		self.__names = {}
+		for var_name in ["transcript", "protein"]:
+			with open(ids_path(self.path, var_name)) as f:
+				ids = json.load(f)
+			self.__ids[var_name] = ids
+			self.__names[var_name] = dict([(id, name) for name, id in ids.items()])
+
+		self.__map_values = {}
+		self.__map_sources = {}
+
+		self.__predictors_by_id = dict([(p["id"], p) for p in self.__meta["predictors"]])
+		self.__maps_by_id = dict([(m["id"], m) for m in self.__meta["maps"]])
+
+	def create(self):
+		self.__read_only()
+
+	def create_indices(self):
+		self.__read_only()
+
+	def drop_indices(self):
+		self.__read_only()
+
+	def commit(self):
+		pass
+
+	def rollback(self):
+		pass
+
+	def close(self):
+		self.__columns = self.__scores = None
+		self.__prot_key = self.__prot_rows = None
+
+	def set_bulk_mode(self, enabled=True):
+		pass
+
+	def is_initialized(self):
+		return self.__meta.get("initialized", False)
+
+	def set_initialized(self, init=True):
+		self.__read_only()
+
+	@property
+	def metadata(self):
+		return dict(db_version=self.db_version, creation_time=self.__meta["creation_time"],
+					initialized=1 if self.is_initialized() else 0)
+
+	@property
+	def num_rows(self):
+		return self.__columns["id"].shape[0]
+
+	def add_predictor(self, id, type, source=None):
+		self.__read_only()
+
+	def predictors(self, id=None, type=None):
+		predictors = self.__meta["predictors"]
+		if id is None and type is None:
+			return predictors
+		elif id is None and type is not None:
+			return [p for p in predictors if p["type"] == type]
+
+		p = self.__predictors_by_id.get(id)
+		return p if p is not None and (type is None or p["type"] == type) else None
+
+	def update_predictors(self, predictors=None):
+		"""
+		Calculates the statistics of the predictors from the memory-mapped columns.
+		They are not persisted as the database is read-only.
+		"""
+
+		if predictors is None:
+			predictors = self.predictors()
+		elif isinstance(predictors, basestring):
+			predictors = [self.predictors(id=predictors)]
+		else:
+			predictors = [self.predictors(id=p) for p in predictors]
+
+		for predictor in predictors:
+			predictor["min"], predictor["max"], predictor["count"] = column_stats(self.__predictor_scores(predictor["id"]))
+
+	def add_map(self, id, name, type, priority=0):
+		self.__read_only()
+
+	def add_map_item(self, id, source, value):
+		self.__read_only()
+
+	def remove_map(self, id):
+		self.__read_only()
+
+	def maps(self, id=None, type=None):
+		maps = self.__meta["maps"]
+		if id is None and type is None:
+			return maps
+		elif id is None and type is not None:
+			return [m for m in maps if m["type"] == type]
+
+		m = self.__maps_by_id.get(id)
+		return m if m is not None and (type is None or m["type"] == type) else None
+
+	def __load_map(self, id):
+		values = {}
+		sources = {}
+		with open(map_path(self.path, id)) as f:
+			for source_id, value in json.load(f):
+				values.setdefault(source_id, []).append(value)
+				sources.setdefault(value, []).append(source_id)
+		self.__map_values[id] = values
+		self.__map_sources[id] = sources
+
+	def __map_item_values(self, id):
+		if id not in self.__map_values:
+			self.__load_map(id)
+		return self.__map_values[id]
+
+	def __annotation_to_ids(self, type, name):
+		for m in sorted(self.maps(type=type), key=lambda m: m["priority"]):
+			if m["priority"] <= 0:
+				continue
+			if m["id"] not in self.__map_sources:
+				self.__load_map(m["id"])
+			ids = self.__map_sources[m["id"]].get(name, [])
+			if len(ids) > 0:
+				return ids
+		return []
+
+	def __var_ids(self, var_name, prefix, names):
+		if not isinstance(names, list):
+			names = [names]
+
+		ids = set()
+		for name in names:
+			if not name.startswith(prefix):
+				ids.update(self.__annotation_to_ids(var_name, name))
+			elif name in self.__ids[var_name]:
+				# Unknown names are skipped, NULL_ID would match the rows without transcript or protein
+				ids.add(self.__ids[var_name][name])
+
+		return sorted(ids)
+
+	def __predictor_scores(self, predictor):
+		if predictor not in self.__scores:
+			self.__scores[predictor] = self.__load_column(scores_path(self.path, predictor))
+		return self.__scores[predictor]
+
+	def add_snv(self, *args, **kwargs):
+		self.__read_only()
+
+	def add_snvs(self, snvs, predictors=None):
+		self.__read_only()
+
+	def update_scores(self, rowid, scores):
+		self.__read_only()
+
+	def update_scores_bulk(self, scores, predictors=None):
+		self.__read_only()
+
+	def __as_list(self, value):
+		if isinstance(value, list):
+			return value
+		else:
+			return [value]
+
+	def __dna_code_ranges(self, chr, strand, start, ref, alt):
+		try:
+			prefixes = [CHR_INDEX[chrom] << 33 | STRAND_INDEX[strand_value] << 32 | start << 4
+						for chrom in self.__as_list(chr) for strand_value in self.__as_list(strand)]
+			refs = [BASE_INDEX[base] for base in self.__as_list(ref)]
+			alts = [BASE_INDEX[base] for base in self.__as_list(alt)]
+		except:
+			raise Exception("Wrong DNA coordinate: {}:{}:{}:{}>{}".format(chr, strand, start, ref, alt))
+
+		return code_ranges(prefixes, 2, refs, alts, len(BASES))
+
+	def __protein_code_ranges(self, aa_pos, aa_ref, aa_alt):
+		try:
+			refs = [AA_INDEX[aa] for aa in self.__as_list(aa_ref)]
+			alts = [AA_INDEX[aa] for aa in self.__as_list(aa_alt)]
+		except:
+			raise Exception("Wrong protein change: {}:{}>{}".format(aa_pos, aa_ref, aa_alt))
+
+		return code_ranges([aa_pos << 10], 5, refs, alts, len(AA))
+
+	def __row_blocks(self, **kwargs):
+		"""
+		Iterates the rows matching the filters by blocks. The coordinates are searched in the sorted columns
+		and the rest of filters are checked on the candidate rows.
+		:return: iterator of arrays of row indices
+		"""
+
+		filters = {}
+		for k, v in kwargs.items():
+			if k not in self.ALL_FILTERS:
+				raise Exception("Unknown filter: {}".format(k))
+
+			if v is None:
+				continue
+
+			if isinstance(v, list):
+				v_len = len(v)
+				if v_len == 0 or (v_len == 1 and v[0] is None):
+					continue
+
+				if v_len == 1:
+					v = v[0]
+
+			filters[k] = v
+
+		keys = set(filters.keys())
+
+		columns = self.__columns
+
+		# Every condition returns which of the rows are kept
+		conditions = []
+		candidates = None
+
+		if "transcript" in keys:
+			transcript_ids = self.__var_ids("transcript", "ENST", filters["transcript"])
+			if len(transcript_ids) == 0:
+				return
+			conditions += [lambda rows: np.in1d(columns["transcript_id"][rows], transcript_ids)]
+
+		protein_ids = None
+		if "protein" in keys:
+			protein_ids = self.__var_ids("protein", "ENSP", filters["protein"])
+			if len(protein_ids) == 0:
+				return
+
+		dna_code_fields = keys & self.DNA_FILTERS
+		if len(dna_code_fields) > 0:
+			if "start" not in dna_code_fields:
+				raise Exception("Missing required filters: {}".format(self.DNA_REQ_FILTERS))
+
+			dna_ranges = self.__dna_code_ranges(filters.get("chr", CHR_LIST), filters.get("strand", STRANDS),
+												filters["start"], filters.get("ref", BASES), filters.get("alt", BASES))
+
+			candidates = _search_ranges(columns["dna_code"], dna_ranges[0])
+			conditions += [lambda rows: _in_ranges(columns["dna_code"][rows], *(dna_ranges + (2,)))]
+
+		protein_code_fields = keys & self.PROTEIN_FILTERS
+		prot_ranges = None
+		if len(protein_code_fields) > 0:
+			if "aa_pos" not in protein_code_fields:
+				raise Exception("Missing required filters: {}".format(self.PROTEIN_REQ_FILTERS))
+
+			prot_ranges = self.__protein_code_ranges(filters["aa_pos"], filters.get("aa_ref", AA),
+													 filters.get("aa_alt", AA))
+
+			conditions += [lambda rows: _in_ranges(columns["prot_code"][rows], *(prot_ranges + (5,)))]
+
+		if protein_ids is not None:
+			if candidates is None:
+				# rows sorted by protein and change
+				change_ranges = prot_ranges[0] if prot_ranges is not None else [(0, (1 << 32) - 1)]
+				key_ranges = [(protein_id << 32 | lo, protein_id << 32 | hi)
+							  for protein_id in protein_ids for lo, hi in change_ranges]
+				candidates = np.asarray(self.__prot_rows[_search_ranges(self.__prot_key, key_ranges)])
+			else:
+				conditions += [lambda rows: np.in1d(columns["protein_id"][rows], protein_ids)]
+
+		if candidates is not None:
+			blocks = (candidates[i:i + SCAN_BLOCK_SIZE] for i in xrange(0, candidates.size, SCAN_BLOCK_SIZE))
+		else:
+			blocks = (np.arange(i, min(i + SCAN_BLOCK_SIZE, self.num_rows))
+						for i in xrange(0, self.num_rows, SCAN_BLOCK_SIZE))
+
+		for rows in blocks:
+			for condition in conditions:
+				rows = rows[condition(rows)]
+			if rows.size > 0:
+				yield rows
+
+	def __rows_data(self, rows, fields, predictors, annotations):
+		"""
+		Converts a block of rows into dictionaries
+		"""
+
+		select_dna_code = len(fields & self.DNA_FIELDS) > 0
+		select_prot_code = len(fields & self.PROTEIN_FIELDS) > 0
+		select_transcript_name = "transcript" in fields
+		select_protein_name = select_prot_code or "protein" in fields
+
+		# python lists are much faster than numpy scalars to build the dictionaries
+		ids, dna_codes, transcript_ids, prot_codes, protein_ids = [self.__columns[name][rows].tolist()
+																   for name in self.COLUMNS]
+		scores = [_scores_list(self.__predictor_scores(predictor)[rows]) for predictor in predictors]
+
+		ann_values = [(ann_id, self.maps(id=ann_id)["type"], self.__map_item_values(ann_id)) for ann_id in annotations]
+
+		transcript_names = self.__names["transcript"]
+		protein_names = self.__names["protein"]
+
+		for i in xrange(len(ids)):
+			transcript_id = transcript_ids[i]
+			protein_id = protein_ids[i]
+
+			data = dict(id=ids[i])
+			if select_dna_code:
+				pos = dna_codes[i]
+				data.update(dict(
+					chr=CHR[(pos >> 33) & 0x1F], strand=STRANDS[(pos >> 32) & 0x01], start=(pos >> 4) & 0x0FFFFFFF,
+					ref=BASES[(pos >> 2) & 0x03], alt=BASES[pos & 0x03]))
+
+			if select_prot_code:
+				pos = prot_codes[i]
+				if pos != NULL_ID:
+					data.update(dict(aa_pos=pos >> 10, aa_ref=AA[(pos >> 5) & 0x1F], aa_alt=AA[pos & 0x1F]))
+				else:
+					data.update(dict(aa_pos=None, aa_ref=None, aa_alt=None))
+
+			if select_transcript_name:
+				data["transcript"] = transcript_names.get(transcript_id)
+
+			if select_protein_name:
+				data["protein"] = protein_names.get(protein_id)
+
+			row_scores = {}
+			for predictor, values in zip(predictors, scores):
+				value = values[i]
+				row_scores[predictor] = value if value == value else None
+			data["scores"] = row_scores
+
+			if len(ann_values) == 0:
+				data["annotations"] = {}
+				yield data
+				continue
+
+			# one row for every combination of annotation values, the same than a join
+			var_ids = dict(transcript=transcript_id, protein=protein_id)
+			ann_lists = [values.get(var_ids[ann_type], [None]) for ann_id, ann_type, values in ann_values]
+			for ann_combination in itertools.product(*ann_lists):
+				row = dict(data)
+				row["annotations"] = dict(zip(annotations, ann_combination))
+				yield row
+
+	def query_scores(self, fields=None, predictors=None, annotations=None, **filters):
+		"""
+		:param fields: The fields to retrieve
+		:param predictors: the list of predictors to select
+		:param annotations: the list of annotations to join
+		:param filters: chr, start, ref, alt, strand, transcript, protein, aa_pos, aa_ref, aa_alt
+		"""
+
+		fields = set(fields) if fields is not None else self.ALL_FIELDS
+		if fields > self.ALL_FIELDS:
+			raise Exception("Invalid select fields: {}".format(fields - self.ALL_FIELDS))
+
+		predictors = [pred_id for pred_id in (predictors or []) if pred_id in self.__predictors_by_id]
+		annotations = [ann_id for ann_id in (annotations or []) if ann_id in self.__maps_by_id]
+
+		for rows in self.__row_blocks(**filters):
+			for start in xrange(0, rows.size, ROWS_BLOCK_SIZE):
+				for data in self.__rows_data(rows[start:start + ROWS_BLOCK_SIZE], fields, predictors, annotations):
+					yield data
+
+	def snvs(self):
+		for data in self.query_scores(fields=self.DNA_FIELDS):
+			del data["scores"], data["annotations"]
+			yield data
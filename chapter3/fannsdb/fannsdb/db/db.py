@@ -5,6 +5,10 @@ class FannsDb(object):
 	TRANSCRIPT_MAP_TYPE = "transcript"
 	PROTEIN_MAP_TYPE = "protein"
 
+	# query_scores argument selecting the maps and the key of their values in the rows
+	MAPS_ARG = "maps"
+	MAPS_KEY = "xrefs"
+
 	def open(self, create=False):
 		raise NotImplemented()
 
@@ -26,6 +30,9 @@ class FannsDb(object):
 	def close(self):
 		raise NotImplemented()
 
+	def set_bulk_mode(self, enabled=True):
+		raise NotImplemented()
+
 	def is_initialized(self):
 		raise NotImplemented()
 
@@ -60,5 +67,25 @@ class FannsDb(object):
 	def query_scores(self, fields=None, predictors=None, annotations=None, **filters):
 		raise NotImplemented()
 
+	def query_scores_bulk(self, queries, fields=None, predictors=None, maps=None):
+		"""
+		Queries the scores for a batch of filters. Backends can resolve the whole batch at once.
+		:param queries: list of filters as accepted by query_scores
+		:param maps: the list of maps which values are retrieved in the MAPS_KEY of the rows
+		:return: iterator of (query index, row) in input order
+		"""
+
+		for index, filters in enumerate(queries):
+			params = dict(filters)
+			params[self.MAPS_ARG] = maps
+			for row in self.query_scores(fields=fields, predictors=predictors, **params):
+				yield index, row
+
+	def add_snvs(self, snvs, predictors=None):
+		raise NotImplemented()
+
 	def update_scores(self, docid, scores):
 		raise NotImplemented()
+
+	def update_scores_bulk(self, scores, predictors=None):
+		raise NotImplemented()
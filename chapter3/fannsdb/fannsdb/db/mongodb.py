@@ -1,11 +1,19 @@
 from bson.son import SON
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING
+from pymongo.errors import OperationFailure
 import pymongo.uri_parser
 
 from fannsdb.db import FannsDb
+from fannsdb.utils import LruCache
 
 from fannsdb.columns import COORD_COLUMNS
 
+# Number of positions queried at once with $in by query_scores_bulk
+QUERY_CHUNK_SIZE = 1000
+
+# Maximum number of xrefs resolved into ensembl ids kept in memory
+XREF_CACHE_SIZE = 100000
+
 class FannsMongoDb(FannsDb):
 
 	FIELD_TO_KEY = dict(
@@ -14,6 +22,16 @@ class FannsMongoDb(FannsDb):
 
 	KEY_TO_FIELD = dict([(k, f) for f, k in FIELD_TO_KEY.items()])
 
+	GENOME_FIELDS = ["chr", "start", "ref", "alt", "transcript", "strand"]
+	PROTEIN_FIELDS = ["protein", "aa_pos", "aa_ref", "aa_alt"]
+
+	# position key and the key that partitions the positions for the bulk queries
+	POSITION_KEYS = [("g.s", "g.c"), ("p.p", "p.n")]
+
+	INDICES = dict(
+		genome=[("g.c", ASCENDING), ("g.s", ASCENDING)],
+		protein=[("p.n", ASCENDING), ("p.p", ASCENDING)])
+
 	IDPREFIX = {
 		FannsDb.TRANSCRIPT_MAP_TYPE : "ENST",
 		FannsDb.PROTEIN_MAP_TYPE : "ENSP"
@@ -49,6 +67,7 @@ class FannsMongoDb(FannsDb):
 		self.__maps_by_id = None
 
 		self.__xrefs_cache = {}
+		self.__ids_cache = LruCache(XREF_CACHE_SIZE)
 
 	def open(self, create=False):
 		pass
@@ -57,12 +76,15 @@ class FannsMongoDb(FannsDb):
 		pass
 
 	def create_indices(self):
-		pass #self._db.scores.ensure_index([])
+		for name, keys in self.INDICES.items():
+			self._db.scores.ensure_index(keys, name=name)
 
 	def drop_indices(self):
-		#self._db.drop_index("genome")
-		#self._db.drop_index("protein")
-		pass
+		for name in self.INDICES.keys():
+			try:
+				self._db.scores.drop_index(name)
+			except OperationFailure:
+				pass # index not found
 
 	def commit(self):
 		pass
@@ -70,6 +92,9 @@ class FannsMongoDb(FannsDb):
 	def rollback(self):
 		pass
 
+	def set_bulk_mode(self, enabled=True):
+		pass # the bulk operations are always unordered
+
 	def close(self):
 		pass
 
@@ -110,6 +135,7 @@ class FannsMongoDb(FannsDb):
 
 	def __clean_map_cache(self, map_id):
 		self.__maps = self.__maps_fast = self.__maps_by_id = None
+		self.__ids_cache.clear()
 
 		for mid, name in self.__xrefs_cache.keys():
 			if mid == map_id:
@@ -133,6 +159,7 @@ class FannsMongoDb(FannsDb):
 	def add_map_item(self, map_id, source, value):
 		type = self.maps(id=map_id)["type"]
 		self._db.maps[map_id].update({"_id" : value}, { "$addToSet" : {"x" : source}}, upsert=True)
+		self.__ids_cache.clear()
 
 	def remove_map(self, map_id):
 		self._db.maps.remove({"_id" : map_id})
@@ -160,12 +187,20 @@ class FannsMongoDb(FannsDb):
 		if self.__maps is None:
 			self.__load_maps_cache()
 
+		key = (type, xref)
+		ids = self.__ids_cache.get(key)
+		if ids is not None:
+			return ids
+
 		ids = []
 		for m in self.__maps_fast[type]:
-			x = self._db.maps[m["id"]].find_one({"_id" : xref}, {"x" : 1}) # TODO cache map items
+			x = self._db.maps[m["id"]].find_one({"_id" : xref}, {"x" : 1})
 			if x is not None and len(x) > 0:
 				ids = x["x"]
 				break
+
+		self.__ids_cache.put(key, ids)
+
 		return ids
 
 	def map_xrefs(self, type, xrefs):
@@ -184,7 +219,7 @@ class FannsMongoDb(FannsDb):
 		elif isinstance(xrefs, list):
 			ids = set()
 			for xref in xrefs:
-				if xrefs.startswith(prefix):
+				if xref.startswith(prefix):
 					ids.add(xref)
 				else:
 					ids.update(self.map_xref(type, xref))
@@ -242,8 +277,8 @@ class FannsMongoDb(FannsDb):
 
 		predictors = [] if predictors is None else predictors
 		
-		fields = fields or [c.lower() for c in COORD_COLUMNS]
-		fields = [(self.FIELD_TO_KEY[field], 1) for field in fields if field in self.FIELD_TO_KEY]
+		keys = self.__field_keys(fields)
+		fields = [(key, 1) for key in keys]
 		fields += [("s." + pred, 1) for pred in predictors]
 		fields = dict(fields)
 
@@ -252,31 +287,170 @@ class FannsMongoDb(FannsDb):
 			return
 
 		for d in self._db.scores.find(query, fields):
-			r = [("id", d["_id"])]
-			if "g" in d:
-				r += [(self.KEY_TO_FIELD["g." + k], v) for k, v in d["g"].items()]
-			if "p" in d:
-				r += [(self.KEY_TO_FIELD["p." + k], v) for k, v in d["p"].items()]
-			r = dict(r)
-
-			if predictors is not None:
-				s = d.get("s") or {}
-				r["scores"] = dict([(p, s[p] if p in s else None) for p in predictors])
-
-			if maps is not None:
-				r["xrefs"] = xrefs = dict()
-				for map_id in maps:
-					if map_id not in self.__maps_by_id:
-						continue
-					map_info = self.__maps_by_id[map_id]
-					if map_info["type"] == self.TRANSCRIPT_MAP_TYPE:
-						src_id = d["g"]["t"]
-					else:
-						src_id = d["p"]["n"]
-
-					xrefs[map_id] = self.get_xrefs(map_id, src_id)
-
-			yield r
+			yield self.__doc_row(d, keys, predictors, maps)
+
+	def __field_keys(self, fields):
+		fields = fields or [c.lower() for c in COORD_COLUMNS]
+		return set([self.FIELD_TO_KEY[field] for field in fields if field in self.FIELD_TO_KEY])
+
+	@staticmethod
+	def __doc_value(d, key):
+		part, name = key.split(".")
+		return (d.get(part) or {}).get(name)
+
+	def __doc_row(self, d, keys, predictors, maps):
+		"""
+		Converts a scores document into a dictionary with the fields of the keys
+		"""
+
+		r = [("id", d["_id"])]
+		for part in ["g", "p"]:
+			if part in d:
+				r += [(self.KEY_TO_FIELD[part + "." + k], v) for k, v in d[part].items() if part + "." + k in keys]
+		r = dict(r)
+
+		if predictors is not None:
+			s = d.get("s") or {}
+			r["scores"] = dict([(p, s[p] if p in s else None) for p in predictors])
+
+		if maps is not None:
+			r["xrefs"] = xrefs = dict()
+			for map_id in maps:
+				if map_id not in self.__maps_by_id:
+					continue
+				map_info = self.__maps_by_id[map_id]
+				if map_info["type"] == self.TRANSCRIPT_MAP_TYPE:
+					src_id = d["g"]["t"]
+				else:
+					src_id = d["p"]["n"]
+
+				xrefs[map_id] = self.get_xrefs(map_id, src_id)
+
+		return r
+
+	def __query_group(self, query):
+		"""
+		Splits a query by position into (partition, position key, position, residual conditions).
+		Returns None for the queries that can not be grouped.
+		"""
+
+		for pos_key, part_key in self.POSITION_KEYS:
+			pos = query.get(pos_key)
+			if not isinstance(pos, (int, long)):
+				continue
+
+			part = query.get(part_key)
+			if isinstance(part, (dict, list)):
+				return None
+
+			residual = []
+			for key, value in query.items():
+				if key in (pos_key, part_key):
+					continue
+				if isinstance(value, list) or (isinstance(value, dict) and value.keys() != ["$in"]):
+					return None
+				residual += [(key, value)]
+
+			partition = ((part_key, part),) if part is not None else ()
+
+			return partition, pos_key, pos, residual
+
+		return None
+
+	@staticmethod
+	def __match(value, cond):
+		if isinstance(cond, dict):
+			return value in cond["$in"]
+		return value == cond
+
+	def query_scores_bulk(self, queries, fields=None, predictors=None, maps=None, chunk_size=QUERY_CHUNK_SIZE):
+		"""
+		Queries the scores for a batch of filters. The queries by position are grouped by chromosome or protein
+		and resolved with a single $in query for every chunk of positions, the rest are queried one by one.
+
+		:param queries: list of filters as accepted by query_scores
+		:param fields: The fields to retrieve
+		:param predictors: the list of predictors to select
+		:param maps: the list of maps which xrefs are retrieved
+		:param chunk_size: Number of positions queried at once
+		:return: iterator of (query index, row) in input order
+		"""
+
+		if self.__maps is None:
+			self.__load_maps_cache()
+
+		predictors = [] if predictors is None else predictors
+
+		keys = self.__field_keys(fields)
+
+		results = [[] for filters in queries]
+		groups = {}
+		for index, filters in enumerate(queries):
+			query = self.__query_from_filters(filters)
+			if query is None:
+				continue
+
+			group = self.__query_group(query)
+			if group is None:
+				results[index] = list(self.query_scores(fields=fields, predictors=predictors, maps=maps, **filters))
+				continue
+
+			partition, pos_key, pos, residual = group
+			groups.setdefault((partition, pos_key), {}).setdefault(pos, []).append((index, residual))
+
+		# the residual conditions and the xrefs require the coordinates
+		projection = dict([("g", 1), ("p", 1)] + [("s." + pred, 1) for pred in predictors])
+
+		for (partition, pos_key), positions in groups.items():
+			sorted_positions = sorted(positions.keys())
+			for i in xrange(0, len(sorted_positions), chunk_size):
+				query = dict(partition)
+				query[pos_key] = {"$in" : sorted_positions[i:i + chunk_size]}
+
+				for d in self._db.scores.find(query, projection):
+					for index, residual in positions[self.__doc_value(d, pos_key)]:
+						if all(self.__match(self.__doc_value(d, key), cond) for key, cond in residual):
+							results[index] += [self.__doc_row(d, keys, predictors, maps)]
+
+		for index, rows in enumerate(results):
+			for row in rows:
+				yield index, row
+
+	def __snv_doc(self, snv, predictors):
+		doc = SON()
+		for part, fields in [("g", self.GENOME_FIELDS), ("p", self.PROTEIN_FIELDS)]:
+			values = SON([(self.FIELD_TO_KEY[field][2:], snv[field]) for field in fields if snv.get(field) is not None])
+			if len(values) > 0:
+				doc[part] = values
+
+		scores = snv.get("scores") or {}
+		scores = SON([(p, scores[p]) for p in predictors if scores.get(p) is not None])
+		if len(scores) > 0:
+			doc["s"] = scores
+
+		return doc
+
+	def add_snvs(self, snvs, predictors=None):
+		"""
+		Adds a batch of SNVs with an unordered bulk operation.
+		:param snvs: iterable of dictionaries with chr, strand, start, ref, alt, transcript,
+		             protein, aa_pos, aa_ref, aa_alt, scores
+		:param predictors: the predictors which scores are inserted, by default the scores of the first SNV
+		:return: the number of SNVs added
+		"""
+
+		bulk = self._db.scores.initialize_unordered_bulk_op()
+		count = 0
+		for snv in snvs:
+			if predictors is None:
+				predictors = sorted((snv.get("scores") or {}).keys())
+			bulk.insert(self.__snv_doc(snv, predictors))
+			count += 1
+
+		if count == 0:
+			return 0
+
+		return bulk.execute()["nInserted"]
 
 	def update_scores(self, scores, id=None, **filters):
 		if id is not None:
@@ -289,4 +463,26 @@ class FannsMongoDb(FannsDb):
 		scores = dict([("s." + key, value) for key, value in scores.items()])
 		
 		self._db.scores.update(query, {"$set" : scores}, multi=True)
+
+	def update_scores_bulk(self, scores, predictors=None):
+		"""
+		Merges the scores for a batch of documents with an unordered bulk operation.
+		:param scores: iterable of (document id, {predictor : score})
+		:param predictors: the predictors to update, by default the ones of the first document.
+		                   Missing scores are set to null.
+		:return: the number of documents updated
+		"""
+
+		bulk = self._db.scores.initialize_unordered_bulk_op()
+		count = 0
+		for docid, doc_scores in scores:
+			if predictors is None:
+				predictors = sorted(doc_scores.keys())
+			bulk.find({"_id" : docid}).update_one({"$set" : dict([("s." + p, doc_scores.get(p)) for p in predictors])})
+			count += 1
+
+		if count == 0 or len(predictors) == 0:
+			return 0
+
+		return bulk.execute()["nMatched"]
 		
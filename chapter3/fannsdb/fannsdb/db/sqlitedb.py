@@ -1,9 +1,11 @@
 import os
 import re
+import heapq
 import sqlite3
 from datetime import datetime
 
 from fannsdb.db import FannsDb
+from fannsdb.utils import LruCache
 
 CHR = ["", "1", "2", "3", "4", "5", "6", "7", "8", "9", "10",
 	"11", "12", "13", "14", "15", "16", "17", "18", "19", "20",
@@ -35,6 +37,61 @@ DATE_FMT = "%Y-%m-%d %H:%M:%S"
 
 DB_VERSION = "01"
 
+# Bit masks allowing all the ref and alt values
+DNA_ALL_MASK = (1 << len(BASES)) - 1
+PROT_ALL_MASK = (1 << len(AA)) - 1
+
+# Maximum number of rows of the query_scores results kept in memory. Disabled by default,
+# it only pays off when the same queries are repeated, i.e. annotating mutations one by one
+QUERY_CACHE_SIZE = 0
+
+# Maximum number of annotation names resolved into transcripts or proteins kept in memory
+ANNOTATION_CACHE_SIZE = 10000
+
+# Page cache size in KB used while in bulk mode
+BULK_CACHE_SIZE = 512 * 1024
+
+def code_ranges(prefixes, ref_shift, refs, alts, num_values):
+	"""
+	Plans the ranges of codes to scan for all the combinations of prefix | ref << ref_shift | alt.
+	All the changes sharing a prefix are contiguous, so a single range is needed for every prefix,
+	and the rows in the range with a ref or alt that were not requested are filtered with a bit mask.
+
+	:param prefixes: the codes without the ref and alt bits
+	:param refs: the indices of the ref values
+	:param alts: the indices of the alt values
+	:param num_values: the number of possible ref and alt values
+	:return: (ranges, ref_mask, alt_mask) where ranges are sorted and non overlapping (lo, hi) tuples
+	         and the masks have a bit set for every allowed value or are None when the ranges are exact
+	"""
+
+	refs = sorted(set(refs))
+	alts = sorted(set(alts))
+
+	refs_contiguous = refs[-1] - refs[0] + 1 == len(refs)
+	alts_contiguous = alts[-1] - alts[0] + 1 == len(alts)
+
+	ref_mask = None
+	if not refs_contiguous:
+		ref_mask = sum(1 << ref for ref in refs)
+
+	# When there are several refs the range includes all the alts between them
+	alt_mask = None
+	if not alts_contiguous or (len(refs) > 1 and len(alts) < num_values):
+		alt_mask = sum(1 << alt for alt in alts)
+
+	lo = refs[0] << ref_shift | alts[0]
+	hi = refs[-1] << ref_shift | alts[-1]
+
+	ranges = []
+	for prefix in sorted(set(prefixes)):
+		if len(ranges) > 0 and ranges[-1][1] + 1 >= prefix | lo:
+			ranges[-1] = (ranges[-1][0], prefix | hi)
+		else:
+			ranges += [(prefix | lo, prefix | hi)]
+
+	return ranges, ref_mask, alt_mask
+
 ENST = re.compile(r"^ENST[0-9]+$")
 ENSP = re.compile(r"^ENSP[0-9]+$")
 
@@ -42,6 +99,8 @@ class FannsSQLiteDb(FannsDb):
 	DNA_COORD = "dna"
 	PROTEIN_COORD = "protein"
 
+	MAPS_ARG = MAPS_KEY = "annotations"
+
 	DNA_FILTER = DNA_COORD
 	PROTEIN_FILTER = PROTEIN_COORD
 
@@ -62,17 +121,28 @@ class FannsSQLiteDb(FannsDb):
 	PROTEIN_FILTERS = set(["aa_pos", "aa_ref", "aa_alt"])
 	PROTEIN_REQ_FILTERS = set(["aa_pos"])
 
-	def __init__(self, path):
+	def __init__(self, path, query_cache_size=QUERY_CACHE_SIZE, annotation_cache_size=ANNOTATION_CACHE_SIZE):
+		"""
+		:param query_cache_size: maximum number of rows of the query_scores results cached, 0 to disable it
+		:param annotation_cache_size: maximum number of annotation names resolved into ids cached
+		"""
+
 		self.path = path
 
 		self.__conn = None
 		
 		self.__id_cache = {}
+		self.__id_names = {}
 		self.__predictors = None
 		self.__predictors_by_id = None
 		self.__maps = None
 		self.__maps_by_id = None
 
+		self.__bulk_tables = False
+
+		self.__query_cache = LruCache(query_cache_size, sizeof=lambda rows: len(rows) + 1)
+		self.__annotation_cache = LruCache(annotation_cache_size)
+
 	def open(self, create=False):
 		if not create and not os.path.exists(self.path):
 			raise Exception("Database not found: {}".format(self.path))
@@ -135,6 +205,7 @@ class FannsSQLiteDb(FannsDb):
 			var_id = c.lastrowid
 
 			self.__id_cache[var_name][value] = var_id
+			self.__id_names.setdefault(var_name, {})[var_id] = value
 
 			return var_id
 
@@ -142,9 +213,12 @@ class FannsSQLiteDb(FannsDb):
 
 	def __load_id_cache(self, c, var_name):
 		cache = {}
+		names = {}
 		for id, name in c.execute("SELECT {0}_id, {0}_name FROM id_{0}".format(var_name)):
 			cache[name] = id
+			names[id] = name
 		self.__id_cache[var_name] = cache
+		self.__id_names[var_name] = names
 		
 	def create(self):
 		c = self.__conn.cursor()
@@ -201,24 +275,66 @@ class FannsSQLiteDb(FannsDb):
 		self.__conn.commit()
 
 	def drop_indices(self):
+		"""
+		Drops the indices that are not required while loading.
+		The unique index on the genomic coordinates is kept, it rejects the SNVs already loaded.
+		"""
+
 		c = self.__conn.cursor()
-		c.executescript("""
-			DROP INDEX IF EXISTS scores_by_dna;
-			DROP INDEX IF EXISTS scores_by_prot;
-		""")
+		c.execute("DROP INDEX IF EXISTS scores_by_prot")
 		c.close()
 		self.__conn.commit()
 
+	def set_bulk_mode(self, enabled=True):
+		"""
+		Relaxes the durability while loading large amounts of data.
+		The database can be corrupted if the process is killed while in bulk mode.
+		It has to be called outside of a transaction, after commit or rollback.
+		"""
+
+		if enabled:
+			pragmas = ["synchronous=OFF", "journal_mode=MEMORY", "temp_store=MEMORY",
+					   "cache_size=-{}".format(BULK_CACHE_SIZE)]
+		else:
+			pragmas = ["synchronous=FULL", "journal_mode=DELETE", "cache_size=-2000"]
+
+		# executescript would commit any pending transaction
+		c = self.__conn.cursor()
+		try:
+			for pragma in pragmas:
+				c.execute("PRAGMA {}".format(pragma))
+		finally:
+			c.close()
+
 	def commit(self):
 		self.__conn.commit()
 
 	def rollback(self):
 		self.__conn.rollback()
+		self.__invalidate_caches()
+
+		# The ids of the transcripts and proteins inserted since the last commit are not valid anymore
+		c = self.__conn.cursor()
+		self.__load_id_cache(c, "transcript")
+		self.__load_id_cache(c, "protein")
+		c.close()
+
+	def __invalidate_caches(self):
+		self.__query_cache.clear()
+		self.__annotation_cache.clear()
+
+	def cache_stats(self):
+		"""
+		:return: the statistics of the query_scores and annotation caches: hits, misses, evictions, entries, size
+		"""
+
+		return dict(queries=self.__query_cache.stats, annotations=self.__annotation_cache.stats)
 
 	def close(self):
 		if self.__conn is not None:
 			self.__conn.close()
 			self.__conn = None
+			self.__bulk_tables = False
 		
 	def __dna_code(self, chr, strand, start, ref, alt):
 		pos = CHR_INDEX[chr] << 33 | STRAND_INDEX[strand] << 32 | start << 4 | BASE_INDEX[ref] << 2 | BASE_INDEX[alt]
@@ -262,6 +378,8 @@ class FannsSQLiteDb(FannsDb):
 		if isinstance(source, basestring):
 			source = [source]
 
+		self.__invalidate_caches()
+
 		c = self.__conn.cursor()
 		try:
 			c.execute("INSERT INTO predictors (id, type) VALUES (?,?)", (id, type))
@@ -331,6 +449,8 @@ class FannsSQLiteDb(FannsDb):
 			self.__maps_by_id[row["id"]] = a
 
 	def add_map(self, id, name, type, priority=0):
+		self.__invalidate_caches()
+
 		c = self.__conn.cursor()
 		
 		try:
@@ -358,6 +478,8 @@ class FannsSQLiteDb(FannsDb):
 		c.close()
 
 	def add_map_item(self, id, source, value):
+		self.__invalidate_caches()
+
 		c = self.__conn.cursor()
 		try:
 			type = self.maps(id=id)["type"]
@@ -369,6 +491,8 @@ class FannsSQLiteDb(FannsDb):
 			c.close()
 
 	def remove_map(self, id):
+		self.__invalidate_caches()
+
 		c = self.__conn.cursor()
 		try:
 			c.execute("DELETE FROM annotations WHERE id=?", (id, ))
@@ -391,44 +515,44 @@ class FannsSQLiteDb(FannsDb):
 			m = self.__maps_by_id.get("id")
 			return m if m is not None and m["type"] == type else None
 
-	def __annotation_to_transcripts(self, name):
-		c = self.__conn.cursor()
-		transcripts = []
-		c.execute("""
-			SELECT id, type FROM annotations
-			WHERE type = '{}' AND priority > 0
-			ORDER BY priority""".format(self.TRANSCRIPT_ANN_TYPE))
-		for ann_id, ann_type in c.fetchall():
-			c.execute("""
-				SELECT {type}_id FROM ann_{id}
-				WHERE ann_{id} = ?""".format(id=ann_id, type=ann_type), (name, ))
-			transcripts = [row[0] for row in c.fetchall()]
-			if len(transcripts) > 0:
-				break
-		c.close()
-		return transcripts
+	def __annotation_to_ids(self, type, name):
+		"""
+		Resolves an annotation name into transcript or protein ids with the first map of the type, by priority,
+		where it is found. The resolutions are cached.
+		"""
 
-	def __annotation_to_proteins(self, name):
+		key = (type, name)
+		ids = self.__annotation_cache.get(key)
+		if ids is not None:
+			return ids
+
+		ids = []
 		c = self.__conn.cursor()
-		proteins = []
-		c.execute("""
-			SELECT id, type FROM annotations
-			WHERE type = '{}' AND priority > 0
-			ORDER BY priority""".format(self.PROTEIN_ANN_TYPE))
-		for ann_id, ann_type in c.fetchall():
+		try:
 			c.execute("""
-				SELECT {type}_id FROM ann_{id}
-				WHERE ann_{id} = ?""".format(id=ann_id, type=ann_type), (name, ))
-			proteins = [row[0] for row in c.fetchall()]
-			if len(proteins) > 0:
-				break
-		c.close()
-		return proteins
+				SELECT id, type FROM annotations
+				WHERE type = ? AND priority > 0
+				ORDER BY priority""", (type, ))
+			for ann_id, ann_type in c.fetchall():
+				c.execute("""
+					SELECT {type}_id FROM ann_{id}
+					WHERE ann_{id} = ?""".format(id=ann_id, type=ann_type), (name, ))
+				ids = [row[0] for row in c.fetchall()]
+				if len(ids) > 0:
+					break
+		finally:
+			c.close()
+
+		self.__annotation_cache.put(key, ids)
+
+		return ids
 
 	def add_snv(self, chr, strand, start, ref, alt, transcript=None,
 				protein=None, aa_pos=None, aa_ref=None, aa_alt=None,
 				scores=None):
 
+		self.__invalidate_caches()
+
 		c = self.__conn.cursor()
 		try:
 			if not (chr in CHR_INDEX and strand in STRAND_INDEX and ref in BASE_INDEX and alt in BASE_INDEX\
@@ -469,6 +593,60 @@ class FannsSQLiteDb(FannsDb):
 
 		return None
 
+	def add_snvs(self, snvs, predictors=None):
+		"""
+		Adds a batch of SNVs with a single statement.
+		:param snvs: iterable of dictionaries with the add_snv arguments
+		:param predictors: the predictors which scores are inserted, by default the scores of the first SNV
+		:return: the number of SNVs added
+		"""
+
+		self.__invalidate_caches()
+
+		c = self.__conn.cursor()
+		try:
+			get_id = self.__get_id
+
+			params = []
+			for snv in snvs:
+				chr, strand, start, ref, alt = snv["chr"], snv["strand"], snv["start"], snv["ref"], snv["alt"]
+				aa_pos, aa_ref, aa_alt = snv.get("aa_pos") or 0, snv.get("aa_ref"), snv.get("aa_alt")
+
+				# The codes are inlined, wrong values are detected by the index lookups
+				try:
+					dna_code = (CHR_INDEX[chr] << 33 | STRAND_INDEX[strand] << 32 | start << 4
+								| BASE_INDEX[ref] << 2 | BASE_INDEX[alt])
+					prot_code = aa_pos << 10 | AA_INDEX[aa_ref] << 5 | AA_INDEX[aa_alt]
+				except KeyError:
+					raise Exception("Wrong chr/strand/ref/alt/prot_ref/prot_alt: {} {} {} {} {} {}".format(chr, strand, ref, alt, aa_ref, aa_alt))
+
+				scores = snv.get("scores") or {}
+				if predictors is None:
+					predictors = sorted(scores.keys())
+
+				row = [dna_code, get_id(c, "transcript", snv.get("transcript")),
+					   prot_code, get_id(c, "protein", snv.get("protein"))]
+				row.extend([scores.get(p) for p in predictors])
+				params.append(row)
+
+			if len(params) == 0:
+				return 0
+
+			sql = ["INSERT INTO scores (dna_code, transcript_id, prot_code, protein_id"]
+			sql += [", {}".format(p) for p in predictors]
+			sql += [") VALUES (?,?,?,?"]
+			sql += [",?"] * len(predictors)
+			sql += [")"]
+
+			c.executemany("".join(sql), params)
+
+			return len(params)
+
+		except sqlite3.IntegrityError:
+			raise Exception("An SNV of the batch was already added")
+		finally:
+			c.close()
+
 	def snvs(self):
 		c = self.__conn.cursor()
 		for row in c.execute("SELECT DISTINCT id, dna_code FROM scores"):
@@ -476,6 +654,54 @@ class FannsSQLiteDb(FannsDb):
 			yield dict(id=row["id"], chr=chr, strand=strand, start=start, ref=ref, alt=alt)
 		c.close()
 
+	def count_scores(self):
+		c = self.__conn.cursor()
+		try:
+			c.execute("SELECT COUNT(*) FROM scores")
+			return c.fetchone()[0]
+		finally:
+			c.close()
+
+	def scores_rows(self, predictors=None):
+		"""
+		Iterates the raw scores rows sorted by dna_code and transcript_id
+		:param predictors: the predictors to retrieve, by default all of them
+		:return: iterator of (id, dna_code, transcript_id, prot_code, protein_id, score_1, ..., score_n)
+		"""
+
+		if predictors is None:
+			predictors = [p["id"] for p in self.predictors()]
+
+		c = self.__conn.cursor()
+		try:
+			c.execute("SELECT id, dna_code, transcript_id, prot_code, protein_id{} FROM scores"
+					  " ORDER BY dna_code, transcript_id".format("".join([", {}".format(p) for p in predictors])))
+			for row in c:
+				yield tuple(row)
+		finally:
+			c.close()
+
+	def ids(self, var_name):
+		"""
+		:param var_name: transcript or protein
+		:return: {name : id}
+		"""
+
+		return dict(self.__id_cache.get(var_name, {}))
+
+	def map_items(self, id):
+		"""
+		:return: iterator of (source id, value)
+		"""
+
+		type = self.maps(id=id)["type"]
+		c = self.__conn.cursor()
+		try:
+			for row in c.execute("SELECT {type}_id, ann_{id} FROM ann_{id}".format(id=id, type=type)):
+				yield tuple(row)
+		finally:
+			c.close()
+
 	def __transcript_ids(self, transcripts):
 		if transcripts is None:
 			return []
@@ -486,7 +712,7 @@ class FannsSQLiteDb(FannsDb):
 		ids = set()
 		for transcript in transcripts:
 			if not transcript.startswith("ENST"):
-				ids.update(self.__annotation_to_transcripts(transcript))
+				ids.update(self.__annotation_to_ids(self.TRANSCRIPT_MAP_TYPE, transcript))
 				continue
 
 			#OPTIMIZATION c = self.__conn.cursor()
@@ -508,7 +734,7 @@ class FannsSQLiteDb(FannsDb):
 		ids = set()
 		for protein in proteins:
 			if not protein.startswith("ENSP"):
-				ids.update(self.__annotation_to_proteins(protein))
+				ids.update(self.__annotation_to_ids(self.PROTEIN_MAP_TYPE, protein))
 				continue
 
 			#OPTIMIZATION c = self.__conn.cursor()
@@ -526,22 +752,78 @@ class FannsSQLiteDb(FannsDb):
 		else:
 			return [value]
 
-	def __transcripts_sql(self, fields=None, predictors=None, annotations=None, **kwargs):
+	def __dna_code_ranges(self, chr, strand, start, ref, alt):
 		"""
-		Returns the SQL query for scores
+		Plans the dna code ranges for all the combinations of the coordinates, each one can be a value or a list
+		:return: (ranges, ref_mask, alt_mask)
+		"""
+
+		try:
+			prefixes = [CHR_INDEX[chrom] << 33 | STRAND_INDEX[strand_value] << 32 | start << 4
+						for chrom in self.__as_list(chr) for strand_value in self.__as_list(strand)]
+			refs = [BASE_INDEX[base] for base in self.__as_list(ref)]
+			alts = [BASE_INDEX[base] for base in self.__as_list(alt)]
+		except:
+			raise Exception("Wrong DNA coordinate: {}:{}:{}:{}>{}".format(chr, strand, start, ref, alt))
+
+		return code_ranges(prefixes, 2, refs, alts, len(BASES))
+
+	def __protein_code_ranges(self, aa_pos, aa_ref, aa_alt):
+		"""
+		Plans the protein code ranges for all the combinations of the changes, each one can be a value or a list
+		:return: (ranges, ref_mask, alt_mask)
+		"""
+
+		if aa_pos is None:
+			aa_pos = 0
+
+		try:
+			refs = [AA_INDEX[aa] for aa in self.__as_list(aa_ref)]
+			alts = [AA_INDEX[aa] for aa in self.__as_list(aa_alt)]
+		except:
+			raise Exception("Wrong protein change: {}:{}>{}".format(aa_pos, aa_ref, aa_alt))
+
+		return code_ranges([aa_pos << 10], 5, refs, alts, len(AA))
+
+	def __ranges_sql(self, column, ranges, ref_mask, alt_mask, ref_shift):
+		"""
+		Returns the condition for a column to be in the planned ranges
+		:return: (sql, params)
+		"""
+
+		sql = []
+		params = []
+		for lo, hi in ranges:
+			if lo == hi:
+				sql += ["{} = ?".format(column)]
+				params += [lo]
+			else:
+				sql += ["{} BETWEEN ? AND ?".format(column)]
+				params += [lo, hi]
+
+		sql = ["({})".format(" OR ".join(sql))]
+
+		mask = (1 << ref_shift) - 1
+		if ref_mask is not None:
+			sql += ["(? >> (({} >> {}) & {})) & 1".format(column, ref_shift, mask)]
+			params += [ref_mask]
+		if alt_mask is not None:
+			sql += ["(? >> ({} & {})) & 1".format(column, mask)]
+			params += [alt_mask]
+
+		return " AND ".join(sql), params
+
+	def __select_sql(self, fields, predictors=None, annotations=None, columns=None, source="scores s"):
+		"""
+		Returns the SELECT and FROM clauses for scores
 		:param fields: The required fields.
 		:param predictors: the list of predictors to select
 		:param annotations: the list of annotations to join
-		:param **kwargs: chr, start, ref, alt, strand, transcript_id, protein_id, aa_pos, aa_ref, aa_alt
-		:return: The SQL query
+		:param columns: extra columns to select before the scores ones
+		:param source: the FROM source, the scores table has to be aliased as s
+		:return: The list of SQL fragments
 		"""
 
-		if fields is None:
-			fields = self.ALL_FIELDS
-		else:
-			if fields > self.ALL_FIELDS:
-				raise Exception("Invalid select fields: {}".format(fields - self.ALL_FIELDS))
-
 		if self.__predictors is None:
 			self.__cache_predictors()
 
@@ -557,22 +839,26 @@ class FannsSQLiteDb(FannsDb):
 		select_dna_code = len(fields & self.DNA_FIELDS) > 0
 		select_prot_code = len(fields & self.PROTEIN_FIELDS) > 0
 		select_transcript_name = "transcript" in fields
-		select_protein_name = "protein" in fields
+		select_protein_name = select_prot_code or "protein" in fields
 
 		#join_protein_name = "protein_id" in kwargs or self.PROTEIN_ANN_TYPE in ann_types
 		#join_transcript_name = "transcript_id" in kwargs
 
 		# select coordinates
 
-		sql = ["SELECT id"]
+		sql = ["SELECT "]
+		if columns is not None:
+			sql += [", ".join(columns), ", "]
+		sql += ["s.id"]
 		if select_dna_code:
 			sql += [", dna_code"]
 		if select_prot_code:
 			sql += [", prot_code"]
+		# the names are taken from the ids cache instead of joining the ids tables
 		if select_transcript_name:
-			sql += [", transcript_name"]
+			sql += [", s.transcript_id"]
 		if select_protein_name:
-			sql += [", protein_name"]
+			sql += [", s.protein_id"]
 
 		# select annotations
 
@@ -584,14 +870,7 @@ class FannsSQLiteDb(FannsDb):
 
 		# from
 
-		sql += [" FROM scores s"]
-
-		# join coordinates
-
-		if select_transcript_name:
-			sql += [" JOIN id_transcript t ON (s.transcript_id = t.transcript_id)"]
-		if select_protein_name:
-			sql += [" JOIN id_protein p ON (s.protein_id = p.protein_id)"]
+		sql += [" FROM ", source]
 
 		# join annotations
 
@@ -600,6 +879,26 @@ class FannsSQLiteDb(FannsDb):
 			sql += [" LEFT JOIN ann_{ann} {i} ON (s.{type}_id = {i}.{type}_id)".format(
 						i="a{}".format(i), ann=ann_id, type=ann_type)]
 
+		return sql
+
+	def __transcripts_sql(self, fields=None, predictors=None, annotations=None, **kwargs):
+		"""
+		Returns the SQL query for scores
+		:param fields: The required fields.
+		:param predictors: the list of predictors to select
+		:param annotations: the list of annotations to join
+		:param **kwargs: chr, start, ref, alt, strand, transcript_id, protein_id, aa_pos, aa_ref, aa_alt
+		:return: The SQL query
+		"""
+
+		if fields is None:
+			fields = self.ALL_FIELDS
+		else:
+			if fields > self.ALL_FIELDS:
+				raise Exception("Invalid select fields: {}".format(fields - self.ALL_FIELDS))
+
+		sql = self.__select_sql(fields, predictors, annotations)
+
 		params = []
 		if len(kwargs) > 0:
 			filters = {}
@@ -633,7 +932,10 @@ class FannsSQLiteDb(FannsDb):
 				filters[k] = v
 
 			keys = set(filters.keys())
-			
+
+			# coordinates are resolved into code ranges
+			conditions = []
+
 			dna_code_fields = keys & self.DNA_FILTERS
 			if len(dna_code_fields) > 0:
 				missing_dna_code_fields = self.DNA_FILTERS - dna_code_fields
@@ -651,26 +953,13 @@ class FannsSQLiteDb(FannsDb):
 					elif field == "strand":
 						filters["strand"] = STRANDS
 
-				start = filters["start"]
-				dna_codes = []
-				for chrom in self.__as_list(filters["chr"]):
-					for ref in self.__as_list(filters["ref"]):
-						for alt in self.__as_list(filters["alt"]):
-							for strand in self.__as_list(filters["strand"]):
-								try:
-									dna_codes += [self.__dna_code(chrom, strand, start, ref, alt)]
-								except:
-									raise Exception("Wrong DNA coordinate: {}:{}:{}:{}>{}".format(chrom, strand, start, ref, alt))
-									#pass # DANGEROUS pass
+				ranges, ref_mask, alt_mask = self.__dna_code_ranges(filters["chr"], filters["strand"], filters["start"],
+																	filters["ref"], filters["alt"])
 
 				for key in self.DNA_FILTERS:
 					del filters[key]
-				
-				num_dna_codes = len(dna_codes)
-				if num_dna_codes == 1:
-					filters["dna_code"] = dna_codes[0]
-				elif num_dna_codes > 1:
-					filters["dna_code"] = dna_codes
+
+				conditions += [self.__ranges_sql("s.dna_code", ranges, ref_mask, alt_mask, 2)]
 
 			protein_code_fields = keys & self.PROTEIN_FILTERS
 			if len(protein_code_fields) > 0:
@@ -685,21 +974,14 @@ class FannsSQLiteDb(FannsDb):
 					elif field == "aa_alt":
 						filters["aa_alt"] = AA
 
-				aa_pos = filters["aa_pos"]
-				protein_codes = []
-				for aa_ref in self.__as_list(filters["aa_ref"]):
-					for aa_alt in self.__as_list(filters["aa_alt"]):
-						protein_codes += [self.__protein_code(aa_pos, aa_ref, aa_alt)]
+				ranges, ref_mask, alt_mask = self.__protein_code_ranges(
+						filters["aa_pos"], filters["aa_ref"], filters["aa_alt"])
 
 				for key in self.PROTEIN_FILTERS:
 					if key in filters:
 						del filters[key]
-				
-				num_protein_codes = len(protein_codes)
-				if num_protein_codes == 1:
-					filters["prot_code"] = protein_codes[0]
-				elif num_protein_codes > 1:
-					filters["prot_code"] = protein_codes
+
+				conditions += [self.__ranges_sql("s.prot_code", ranges, ref_mask, alt_mask, 5)]
 			
 			sql += [" WHERE"]
 			first_condition = True
@@ -716,22 +998,76 @@ class FannsSQLiteDb(FannsDb):
 					sql += [" {} = ?".format(k)]
 					params += [v]
 
+			for condition_sql, condition_params in conditions:
+				if first_condition:
+					first_condition = False
+				else:
+					sql += [" AND"]
+
+				sql += [" ", condition_sql]
+				params += condition_params
+
 		return "".join(sql), params
 
+	def __row_data(self, row, fields, predictors=None, annotations=None):
+		"""
+		Converts a scores row into a dictionary
+		"""
+
+		select_dna_code = len(fields & self.DNA_FIELDS) > 0
+		select_prot_code = len(fields & self.PROTEIN_FIELDS) > 0
+		select_transcript_name = "transcript" in fields
+		select_protein_name = select_prot_code or "protein" in fields
+
+		data = dict(id=row["id"])
+		if select_dna_code:
+			chr, strand, start, ref, alt = self.__expand_dna_code(row["dna_code"])
+			data.update(dict(chr=chr, strand=strand, start=start, ref=ref, alt=alt))
+
+		if select_prot_code:
+			aa_pos, aa_ref, aa_alt = self.__expand_prot_code(row["prot_code"])
+			data.update(dict(aa_pos=aa_pos, aa_ref=aa_ref, aa_alt=aa_alt))
+
+		if select_transcript_name:
+			data["transcript"] = self.__id_names["transcript"].get(row["transcript_id"])
+
+		if select_protein_name:
+			data["protein"] = self.__id_names["protein"].get(row["protein_id"])
+
+		scores = {}
+		if predictors is not None:
+			for predictor in predictors:
+				scores[predictor] = row[str(predictor)]
+		data["scores"] = scores
+
+		ann = {}
+		if annotations is not None:
+			for ann_id in annotations:
+				ann[ann_id] = row["ann_{}".format(ann_id)]
+		data["annotations"] = ann
+
+		return data
+
 	def query_scores(self, fields=None, predictors=None, annotations=None, **filters):
 		"""
 		:param fields: The fields to retrieve
 		:param predictors: the list of predictors to select
 		:param annotations: the list of annotations to join
 		:param filters: chr, start, end, ref, alt, strand, transcript, protein, aa_pos, aa_ref, aa_alt
+		:return: the rows, the ones without transcript or protein have them as None
 		"""
 
 		fields = set(fields) if fields is not None else self.ALL_FIELDS
 
-		select_dna_code = len(fields & self.DNA_FIELDS) > 0
-		select_prot_code = len(fields & self.PROTEIN_FIELDS) > 0
-		select_transcript_name = "transcript" in fields
-		select_protein_name = select_prot_code or "protein" in fields
+		max_rows = self.__query_cache.max_size
+		if max_rows > 0:
+			key = self.__query_key(fields, predictors, annotations, filters)
+			rows = self.__query_cache.get(key)
+			if rows is not None:
+				# copies so the callers can not modify the cached rows
+				for row in rows:
+					yield self.__copy_row(row)
+				return
 
 		sql, params = self.__transcripts_sql(fields=fields, predictors=predictors, annotations=annotations,
 											**filters)
@@ -739,38 +1075,199 @@ class FannsSQLiteDb(FannsDb):
 		if sql is None:
 			return
 
+		# the results are only cached when fully consumed and small enough
+		rows = [] if max_rows > 0 else None
+
 		c = self.__conn.cursor()
 		try:
 			c.execute(sql, params)
 			for row in c:
-				data = dict(id=row["id"])
-				if select_dna_code:
-					chr, strand, start, ref, alt = self.__expand_dna_code(row["dna_code"])
-					data.update(dict(chr=chr, strand=strand, start=start, ref=ref, alt=alt))
+				data = self.__row_data(row, fields, predictors, annotations)
+				if rows is not None:
+					if len(rows) < max_rows:
+						rows += [self.__copy_row(data)]
+					else:
+						rows = None
+				yield data
+		finally:
+			c.close()
 
-				if select_prot_code:
-					aa_pos, aa_ref, aa_alt = self.__expand_prot_code(row["prot_code"])
-					data.update(dict(aa_pos=aa_pos, aa_ref=aa_ref, aa_alt=aa_alt))
+		if rows is not None:
+			self.__query_cache.put(key, rows)
+
+	@staticmethod
+	def __query_key(fields, predictors, annotations, filters):
+		filter_items = []
+		for name, value in sorted(filters.items()):
+			if isinstance(value, (list, tuple, set)):
+				value = tuple(value)
+			filter_items += [(name, value)]
+
+		return (tuple(sorted(fields)),
+				tuple(predictors) if predictors is not None else None,
+				tuple(annotations) if annotations is not None else None,
+				tuple(filter_items))
+
+	@staticmethod
+	def __copy_row(row):
+		row = dict(row)
+		for name in ["scores", "annotations"]:
+			if name in row:
+				row[name] = dict(row[name])
+		return row
+
+	def __create_bulk_tables(self, c):
+		if self.__bulk_tables:
+			return
 
-				if select_transcript_name:
-					data["transcript"]=row["transcript_name"]
+		c.executescript("""
+			CREATE TEMP TABLE IF NOT EXISTS bulk_dna (
+				qid 		INTEGER,
+				dna_lo 		INTEGER,
+				dna_hi 		INTEGER,
+				ref_mask 	INTEGER,
+				alt_mask 	INTEGER);
+
+			CREATE TEMP TABLE IF NOT EXISTS bulk_prot (
+				qid 			INTEGER,
+				q_protein_id 	INTEGER,
+				prot_lo 		INTEGER,
+				prot_hi 		INTEGER,
+				ref_mask 		INTEGER,
+				alt_mask 		INTEGER);
+		""")
 
-				if select_protein_name:
-					data["protein"]=row["protein_name"]
+		self.__bulk_tables = True
 
-				scores = {}
-				if predictors is not None:
-					for predictor in predictors:
-						scores[predictor] = row[str(predictor)]
-				data["scores"] = scores
+	def query_scores_bulk(self, queries, fields=None, predictors=None, maps=None):
+		"""
+		Queries the scores for a batch of mutations. The batch is loaded into temporary tables
+		and resolved with a single indexed join for the genomic coordinates and another one for the protein ones.
+		The results have to be consumed before the next call.
 
-				ann = {}
-				if annotations is not None:
-					for ann_id in annotations:
-						ann[ann_id] = row["ann_{}".format(ann_id)]
-				data["annotations"] = ann
+		:param queries: list of filters: chr, start, ref, alt, strand for genomic coordinates
+		                or protein, aa_pos, aa_ref, aa_alt for protein coordinates
+		:param fields: The fields to retrieve
+		:param predictors: the list of predictors to select
+		:param maps: the list of annotations to join
+		:return: iterator of (query index, row) in input order
+		"""
 
-				yield data
+		annotations = maps
+
+		fields = set(fields) if fields is not None else self.ALL_FIELDS
+		if fields > self.ALL_FIELDS:
+			raise Exception("Invalid select fields: {}".format(fields - self.ALL_FIELDS))
+
+		dna_rows = []
+		prot_rows = []
+		for qid, filters in enumerate(queries):
+			filters = dict((k, v) for k, v in filters.items() if v is not None)
+
+			keys = set(filters.keys())
+			if len(keys - self.DNA_FILTERS - self.PROTEIN_FILTERS - set(["protein"])) > 0:
+				raise Exception("Unsupported bulk filters: {}".format(
+					keys - self.DNA_FILTERS - self.PROTEIN_FILTERS - set(["protein"])))
+
+			# The masks of the ranges that don't need filtering allow all the values
+
+			if "start" in keys:
+				ranges, ref_mask, alt_mask = self.__dna_code_ranges(
+						filters.get("chr", CHR_LIST), filters.get("strand", STRANDS),
+						filters["start"], filters.get("ref", BASES), filters.get("alt", BASES))
+				ref_mask = ref_mask if ref_mask is not None else DNA_ALL_MASK
+				alt_mask = alt_mask if alt_mask is not None else DNA_ALL_MASK
+				for dna_lo, dna_hi in ranges:
+					dna_rows += [(qid, dna_lo, dna_hi, ref_mask, alt_mask)]
+
+			elif "aa_pos" in keys and "protein" in keys:
+				ranges, ref_mask, alt_mask = self.__protein_code_ranges(
+						filters["aa_pos"], filters.get("aa_ref", AA), filters.get("aa_alt", AA))
+				ref_mask = ref_mask if ref_mask is not None else PROT_ALL_MASK
+				alt_mask = alt_mask if alt_mask is not None else PROT_ALL_MASK
+				for protein_id in self.__protein_ids(filters["protein"]):
+					for prot_lo, prot_hi in ranges:
+						prot_rows += [(qid, protein_id, prot_lo, prot_hi, ref_mask, alt_mask)]
+
+			else:
+				raise Exception("Missing required filters: start or protein and aa_pos")
+
+		c = self.__conn.cursor()
+		try:
+			self.__create_bulk_tables(c)
+			c.execute("DELETE FROM bulk_dna")
+			c.execute("DELETE FROM bulk_prot")
+			c.executemany("INSERT INTO bulk_dna (qid, dna_lo, dna_hi, ref_mask, alt_mask)"
+						  " VALUES (?,?,?,?,?)", dna_rows)
+			c.executemany("INSERT INTO bulk_prot (qid, q_protein_id, prot_lo, prot_hi, ref_mask, alt_mask)"
+						  " VALUES (?,?,?,?,?,?)", prot_rows)
+		finally:
+			c.close()
+
+		# CROSS JOIN forces the batch to be the outer loop, so every query is an index range scan on scores
+
+		dna_sql = self.__select_sql(fields, predictors, annotations, columns=["q.qid"],
+				source="bulk_dna q CROSS JOIN scores s ON (s.dna_code BETWEEN q.dna_lo AND q.dna_hi"
+					   " AND (q.ref_mask >> ((s.dna_code >> 2) & 3)) & 1"
+					   " AND (q.alt_mask >> (s.dna_code & 3)) & 1)")
+
+		prot_sql = self.__select_sql(fields, predictors, annotations, columns=["q.qid"],
+				source="bulk_prot q CROSS JOIN scores s"
+					   " ON (s.protein_id = q.q_protein_id AND s.prot_code BETWEEN q.prot_lo AND q.prot_hi"
+					   " AND (q.ref_mask >> ((s.prot_code >> 5) & 31)) & 1"
+					   " AND (q.alt_mask >> (s.prot_code & 31)) & 1)")
+
+		def query_rows(sql, num_rows):
+			if num_rows == 0:
+				return
+
+			c = self.__conn.cursor()
+			try:
+				c.execute("".join(sql + [" ORDER BY q.qid, s.id"]))
+				for row in c:
+					yield row["qid"], row["id"], self.__row_data(row, fields, predictors, annotations)
+			finally:
+				c.close()
+
+		for qid, rowid, data in heapq.merge(query_rows(dna_sql, len(dna_rows)), query_rows(prot_sql, len(prot_rows))):
+			yield qid, data
+
+	def update_scores_bulk(self, scores, predictors=None):
+		"""
+		Merges the scores for a batch of rows. The batch is loaded into a temporary table
+		and merged into the scores table with a single statement.
+		:param scores: iterable of (rowid, {predictor : score})
+		:param predictors: the predictors to update, by default the ones of the first row.
+		                   Missing scores are set to NULL.
+		:return: the number of rows updated
+		"""
+
+		self.__invalidate_caches()
+
+		params = []
+		for rowid, row_scores in scores:
+			if predictors is None:
+				predictors = sorted(row_scores.keys())
+			params += [[rowid] + [row_scores.get(p) for p in predictors]]
+
+		if len(params) == 0 or len(predictors) == 0:
+			return 0
+
+		c = self.__conn.cursor()
+		try:
+			c.execute("DROP TABLE IF EXISTS temp.bulk_scores")
+			c.execute("CREATE TEMP TABLE bulk_scores (id INTEGER PRIMARY KEY, {})".format(
+				", ".join(["{} REAL".format(p) for p in predictors])))
+
+			c.executemany("INSERT OR REPLACE INTO bulk_scores VALUES ({})".format(
+				",".join(["?"] * (len(predictors) + 1))), params)
+
+			# Every row of the batch is located by rowid in scores
+			c.execute("UPDATE scores SET {} WHERE id IN (SELECT id FROM bulk_scores)".format(
+				", ".join(["{0} = (SELECT b.{0} FROM bulk_scores b WHERE b.id = scores.id)".format(p)
+						   for p in predictors])))
+
+			return c.rowcount
 		finally:
 			c.close()
 
@@ -783,6 +1280,8 @@ class FannsSQLiteDb(FannsDb):
 		if len(scores) == 0:
 			return
 
+		self.__invalidate_caches()
+
 		c = self.__conn.cursor()
 
 		sql = ["UPDATE scores SET "]
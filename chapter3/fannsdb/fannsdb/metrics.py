@@ -1,9 +1,16 @@
 import random
+import multiprocessing as mp
 import numpy as np
 import pandas as pd
 from sklearn.metrics import matthews_corrcoef, accuracy_score, f1_score, precision_score, recall_score, roc_curve, auc, confusion_matrix
 import matplotlib.pyplot as plt
 
+# Number of undersampling samples evaluated by every task
+SAMPLES_PER_TASK = 64
+
+# Approximate number of random keys drawn at once to sample the negatives
+SAMPLING_BLOCK_SIZE = 1 << 22
+
 # metric functions
 
 tp = lambda y_true, y_pred, tp, fp, fn, tn: tp
@@ -21,7 +28,9 @@ spc = lambda y_true, y_pred, tp, fp, fn, tn: np.float64(tn) / (fp + tn)
 #ppv = lambda y_true, y_pred, tp, fp, fn, tn: precision_score(y_true, y_pred)
 ppv = lambda y_true, y_pred, tp, fp, fn, tn: np.float64(tp) / (tp + fp)
 
-f1 = lambda y_true, y_pred, tp, fp, fn, tn: f1_score(y_true, y_pred)
+#f1 = lambda y_true, y_pred, tp, fp, fn, tn: f1_score(y_true, y_pred)
+# the positive class of y_true is at cm[1,1], the same than f1_score
+f1 = lambda y_true, y_pred, tp, fp, fn, tn: np.float64(2 * tn) / (2 * tn + fp + fn)
 
 #acc = lambda y_true, y_pred, tp, fp, fn, tn: accuracy_score(y_true, y_pred)
 acc = lambda y_true, y_pred, tp, fp, fn, tn: np.float64(tp + tn) / np.float64(
@@ -47,25 +56,50 @@ score_fn = {
 
 # performance calculation
 
-def calc_perf(y_true, tset, cutoffs, perf, scores):
-    
-    tp = fp = fn = tn = np.nan
-
-    #req_cm = len(set(scores) & set(["TPR", "SPC", "PPV", "ACC", "MCC"])) > 0    
-	
-    for i, cutoff in enumerate(cutoffs):
-        y_pred = np.array(tset >= cutoff, dtype=np.int8)
-    	
-        #if req_cm:
-        cm = confusion_matrix(y_true, y_pred)
-        tp, fp, fn, tn = cm[0,0], cm[0,1], cm[1,0], cm[1,1]
-    
+def above_counts(values, cutoffs):
+    """
+    Counts the values >= every cutoff sorting the values only once.
+    NaN values are never above a cutoff.
+    """
+
+    values = np.asarray(values, dtype=np.float64)
+    values = np.sort(values[~np.isnan(values)])
+    return values.size - np.searchsorted(values, cutoffs, side="left")
+
+def confusion_counts(pos_above, neg_above, num_pos, num_neg):
+    """
+    Calculates the confusion matrix of y_pred = value >= cutoff for all the cutoffs at once.
+    They follow the order of confusion_matrix(y_true, y_pred): tp = cm[0,0], fp = cm[0,1], fn = cm[1,0], tn = cm[1,1]
+    :param pos_above: the number of positives above every cutoff
+    :param neg_above: the number of negatives above every cutoff
+    :return: (tp, fp, fn, tn) arrays with the counts for every cutoff
+    """
+
+    return num_neg - neg_above, neg_above, num_pos - pos_above, pos_above
+
+def counts_perf(tp, fp, fn, tn, perf, scores):
+    """
+    Calculates the scores for all the cutoffs from the confusion matrix counts
+    """
+
+    with np.errstate(divide="ignore", invalid="ignore"):
         for j, score in enumerate(scores):
-            v = score_fn[score](y_true, y_pred, tp, fp, fn, tn)
-            perf[i,j] = v if np.isfinite(v) else 0.0
+            v = score_fn[score](None, None, tp, fp, fn, tn)
+            perf[...,j] = np.where(np.isfinite(v), v, 0.0)
 
     return perf
 
+def calc_perf(y_true, tset, cutoffs, perf, scores):
+    y_true = np.asarray(y_true) != 0
+    values = np.asarray(tset, dtype=np.float64)
+
+    pos_above = above_counts(values[y_true], cutoffs)
+    neg_above = above_counts(values[~y_true], cutoffs)
+
+    tp, fp, fn, tn = confusion_counts(pos_above, neg_above, np.count_nonzero(y_true), np.count_nonzero(~y_true))
+
+    return counts_perf(tp, fp, fn, tn, perf, scores)
+
 def balanced_perf(pos, neg, cutoffs, scores, **kwargs):
     num_pos = len(pos.index)
     num_neg = len(neg.index)
@@ -88,7 +122,71 @@ def balanced_perf(pos, neg, cutoffs, scores, **kwargs):
     
     return (perf, roc, auc_value)
 
-def undersampling_perf(pos, neg, cutoffs, scores, num_samples=None, **kwargs):
+def _sample_ranks(rs, num_samples, n, k):
+    """
+    Draws k different ranks out of n for every sample.
+    :return: a (num_samples, k) matrix with the ranks of every sample sorted
+    """
+
+    if k * 4 > n:
+        keys = rs.random_sample((num_samples, n))
+        return np.sort(np.argpartition(keys, k - 1, axis=1)[:, :k], axis=1)
+
+    # when k is small compared to n it is much faster to draw with replacement and draw again the duplicated ones
+    ranks = rs.randint(0, n, size=(num_samples, k))
+    while True:
+        ranks.sort(axis=1)
+        dup = np.zeros(ranks.shape, dtype=bool)
+        dup[:, 1:] = ranks[:, 1:] == ranks[:, :-1]
+        num_dup = np.count_nonzero(dup)
+        if num_dup == 0:
+            return ranks
+        ranks[dup] = rs.randint(0, n, size=num_dup)
+
+def _undersampling_task(params):
+    """
+    Evaluates a number of undersampling samples by blocks. The negatives of every sample are drawn
+    as ranks of the sorted negatives, and the ranks of all the samples of a block are searched at once.
+    :return: (the sum of the perf of the samples, the ranks of the negatives of the last sample)
+    """
+
+    pos_above, neg_below, num_valid_neg, num_neg, num_pos, scores, num_samples, seed = params
+
+    rs = np.random.RandomState(seed)
+
+    num_cutoffs = neg_below.shape[0]
+    perf_sum = np.zeros((num_cutoffs, len(scores)))
+
+    block_samples = max(1, SAMPLING_BLOCK_SIZE // (num_neg if num_pos * 4 > num_neg else num_pos))
+
+    ranks = None
+    for start in xrange(0, num_samples, block_samples):
+        count = min(block_samples, num_samples - start)
+
+        ranks = _sample_ranks(rs, count, num_neg, num_pos)
+
+        # the ranks of every sample are shifted to search all the samples in a single sorted array
+        offsets = np.arange(count)[:, np.newaxis] * num_neg
+        ranks_flat = (ranks + offsets).ravel()
+        neg_above = (np.searchsorted(ranks_flat, num_valid_neg + offsets)
+                        - np.searchsorted(ranks_flat, neg_below + offsets))
+
+        tp, fp, fn, tn = confusion_counts(pos_above, neg_above, num_pos, num_pos)
+        perf = counts_perf(tp, fp, fn, tn, np.empty((count, num_cutoffs, len(scores))), scores)
+        perf_sum += perf.sum(axis=0)
+
+    return perf_sum, ranks[-1]
+
+def undersampling_perf(pos, neg, cutoffs, scores, num_samples=None, num_cores=1, seed=None, **kwargs):
+    """
+    Calculates the mean performance of balanced samples of the negatives.
+
+    :param num_samples: the number of samples, at most the number of partitions of the negatives
+    :param num_cores: the number of processes evaluating the samples
+    :param seed: the seed of the samples, by default one from the random module.
+                 The samples are the same for any number of cores.
+    """
+
     num_pos = len(pos.index)
     num_neg = len(neg.index)
     num_perf = len(scores)
@@ -101,19 +199,42 @@ def undersampling_perf(pos, neg, cutoffs, scores, num_samples=None, **kwargs):
     
     #print("{} / {} = {} -> {}".format(num_neg, num_pos, num_partitions, num_samples))
 
-    tset = np.zeros(num_pos * 2, np.int8)
-    perf = np.empty((cutoffs.shape[0], num_perf, num_samples))
-    for s in xrange(num_samples):
-        nix = random.sample(neg.index, num_pos)
-        neg_sample = neg.ix[nix]
-        tset = pd.concat([pos, neg_sample])
-        calc_perf(y_true, tset, cutoffs, perf[:,:,s], scores)
-        #neg = neg.drop(nix)
+    if seed is None:
+        seed = random.randint(0, 2**31 - 1)
+
+    # positives are the same for all the samples
+    pos_above = above_counts(pos, cutoffs)
+
+    # negatives are sorted once, so the negatives of a sample above a cutoff are the ones with a higher rank
+    neg_values = np.asarray(neg, dtype=np.float64)
+    neg_order = np.argsort(neg_values, kind="mergesort")
+    num_valid_neg = np.count_nonzero(~np.isnan(neg_values))
+    neg_below = np.searchsorted(neg_values[neg_order][:num_valid_neg], cutoffs, side="left")
+
+    tasks = [(pos_above, neg_below, num_valid_neg, num_neg, num_pos, scores,
+              min(SAMPLES_PER_TASK, num_samples - start), [seed, start])
+             for start in xrange(0, num_samples, SAMPLES_PER_TASK)]
+
+    if num_cores > 1 and len(tasks) > 1:
+        pool = mp.Pool(min(num_cores, len(tasks)))
+        try:
+            results = pool.map(_undersampling_task, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(_undersampling_task, tasks)
+
+    perf = sum([perf_sum for perf_sum, last_ranks in results]) / num_samples
+
+    # the ROC curve is calculated for the last sample
+    last_ranks = results[-1][1]
+    tset = pd.concat([pos, neg.iloc[neg_order[last_ranks]]])
 	
     fpr, tpr, thresholds = roc_curve(y_true, tset)
     auc_value = auc(fpr, tpr)
 
-    perf = pd.DataFrame(perf.mean(axis=2), columns=scores, index=cutoffs)
+    perf = pd.DataFrame(perf, columns=scores, index=cutoffs)
     roc = pd.DataFrame({"FPR" : fpr, "TPR" : tpr, "thresholds" : thresholds})
     
     return (perf, roc, auc_value)
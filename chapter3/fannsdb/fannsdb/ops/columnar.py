@@ -0,0 +1,124 @@
+import os
+import json
+import logging
+from datetime import datetime
+
+import numpy as np
+
+from fannsdb.db.columnar import FannsColumnarDb, NULL_ID, column_path, scores_path, ids_path, map_path, column_stats
+from fannsdb.db.sqlitedb import DATE_FMT, DB_VERSION
+from fannsdb.utils import RatedProgress
+
+# Number of rows converted into columns at once
+BATCH_SIZE = 100000
+
+def export_columnar(db, path, predictors=None, batch_size=BATCH_SIZE, single_precision=False, logger=None):
+	"""
+	Exports the scores of a database into a columnar database that can be opened with FannsColumnarDb.
+
+	:param db: FannsSQLiteDb interface.
+	:param path: The directory of the columnar database. It can not exist.
+	:param predictors: The predictors to export. By default all of them.
+	:param batch_size: Number of rows converted at once.
+	:param single_precision: Store the scores in 32 bits. It halves their size but they are rounded.
+	:param logger: Logger to use. If not specified a new one is created.
+	:return: the number of rows exported
+	"""
+
+	if logger is None:
+		logger = logging.getLogger("fannsdb.columnar")
+
+	if os.path.exists(path):
+		raise Exception("The path already exists: {}".format(path))
+
+	if predictors is None:
+		predictors = [p["id"] for p in db.predictors()]
+
+	os.makedirs(path)
+
+	num_rows = db.count_scores()
+
+	columns = [np.lib.format.open_memmap(column_path(path, name), mode="w+",
+										 dtype=FannsColumnarDb.COLUMN_TYPES[name], shape=(num_rows,))
+			   for name in FannsColumnarDb.COLUMNS]
+
+	scores_type = FannsColumnarDb.SINGLE_SCORES_TYPE if single_precision else FannsColumnarDb.SCORES_TYPE
+	scores = [np.lib.format.open_memmap(scores_path(path, predictor), mode="w+",
+										dtype=scores_type, shape=(num_rows,))
+			  for predictor in predictors]
+
+	logger.info("Exporting {} rows ...".format(num_rows))
+
+	progress = RatedProgress(logger, name="rows")
+
+	def write_batch(start, batch):
+		batch_columns = zip(*batch)
+		end = start + len(batch)
+		for column, values in zip(columns, batch_columns):
+			column[start:end] = [NULL_ID if v is None else v for v in values]
+		for column, values in zip(scores, batch_columns[len(columns):]):
+			column[start:end] = np.array(values, dtype=np.float64)
+		progress.update(len(batch))
+
+	# the rows come sorted by dna_code and transcript_id
+	start = 0
+	batch = []
+	for row in db.scores_rows(predictors):
+		batch += [row]
+		if len(batch) >= batch_size:
+			write_batch(start, batch)
+			start += len(batch)
+			batch = []
+
+	if len(batch) > 0:
+		write_batch(start, batch)
+		start += len(batch)
+
+	progress.log_totals()
+
+	if start != num_rows:
+		raise Exception("The database has changed while exporting: {} rows expected but {} found".format(num_rows, start))
+
+	logger.info("Creating the protein index ...")
+
+	prot_code, protein_id = columns[3], columns[4]
+	prot_rows = np.nonzero((prot_code != NULL_ID) & (protein_id != NULL_ID))[0]
+	prot_key = protein_id[prot_rows].astype(np.int64) << 32 | prot_code[prot_rows]
+	order = np.argsort(prot_key, kind="mergesort")
+	np.save(column_path(path, "prot_key"), prot_key[order])
+	rows_type = np.int32 if num_rows <= np.iinfo(np.int32).max else np.int64
+	np.save(column_path(path, "prot_rows"), prot_rows[order].astype(rows_type))
+
+	logger.info("Updating predictors ...")
+
+	predictors_meta = []
+	for predictor, values in zip(predictors, scores):
+		p = dict(db.predictors(id=predictor))
+		p["min"], p["max"], p["count"] = column_stats(values)
+		predictors_meta += [p]
+
+	for column in columns + scores:
+		column.flush()
+
+	for var_name in ["transcript", "protein"]:
+		with open(ids_path(path, var_name), "w") as f:
+			json.dump(db.ids(var_name), f)
+
+	maps_meta = []
+	for m in db.maps():
+		maps_meta += [dict(m)]
+		with open(map_path(path, m["id"]), "w") as f:
+			json.dump(list(db.map_items(m["id"])), f)
+
+	meta = dict(
+		db_version=DB_VERSION,
+		creation_time=datetime.now().strftime(DATE_FMT),
+		initialized=True,
+		predictors=predictors_meta,
+		maps=maps_meta)
+
+	# written at the end so an interrupted export can not be opened
+	with open(os.path.join(path, FannsColumnarDb.META), "w") as f:
+		json.dump(meta, f, indent=2)
+
+	return num_rows
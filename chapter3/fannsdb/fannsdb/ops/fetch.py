@@ -2,6 +2,8 @@
 
 import os
 import logging
+import multiprocessing as mp
+from collections import deque
 from datetime import datetime as dt
 
 from bgcore import tsv
@@ -16,7 +18,120 @@ STATE_MUTATION = "mutation"
 STATE_HITS = "hits"
 STATE_FAILS = "fails"
 
-def fetch_iter(db, muts_path, maps=None, predictors=None, muts_header=False, state=None, logger=None):
+# Number of mutations queried at once
+BATCH_SIZE = 1000
+
+def _mutation_query(logger, mut):
+
+	if mut.coord == Mutation.GENOMIC:
+		if logger.isEnabledFor(logging.DEBUG):
+			logger.debug("  Querying {} {} {} {} {} {} {} ...".format(
+				mut.chr, mut.start, mut.end or "*", mut.ref or "*", mut.alt, mut.strand or "*", mut.identifier or "*"))
+
+		return dict(chr=mut.chr, start=mut.start, ref=mut.ref, alt=mut.alt, strand=mut.strand)
+
+	elif mut.coord == Mutation.PROTEIN:
+		if logger.isEnabledFor(logging.DEBUG):
+			logger.debug("  Querying {} {} {} {} {} ...".format(
+				mut.protein, mut.start, mut.ref or "*", mut.alt, mut.identifier or "*"))
+
+		return dict(protein=mut.protein, aa_pos=mut.start, aa_ref=mut.ref, aa_alt=mut.alt)
+
+	else:
+		logger.warn("Unknown coordinates system: {}".format(mut.line))
+
+	return None
+
+def _read_chunks(f, chunk_size):
+	"""
+	Reads the mutation lines by chunks of (line_num, line)
+	"""
+
+	chunk = []
+	for line_num, line in enumerate(f, start=1):
+		line = line.rstrip(" \n\r")
+		if len(line) == 0 or line.startswith("#"):
+			continue
+
+		chunk += [(line_num, line)]
+		if len(chunk) >= chunk_size:
+			yield chunk
+			chunk = []
+
+	if len(chunk) > 0:
+		yield chunk
+
+def _fetch_chunk(db, chunk, maps, predictors, logger):
+	"""
+	Parses and queries a chunk of mutation lines
+	:param chunk: list of (line_num, line)
+	:return: (results, queried, hits, fails) where results is the list of (line_num, line, mut, row) in input order
+	"""
+
+	mutparser = DnaAndProtMutationParser()
+
+	batch = []
+	fails = 0
+	for line_num, line in chunk:
+		try:
+			mut = mutparser.parse(line)
+		except PrematureEnd:
+			logger.error("Missing fields at line {}".format(line_num))
+			fails += 1
+			continue
+		except UnexpectedToken as ex:
+			logger.error("Unexpected field '{}' at line {}".format(ex.args[0], line_num))
+			fails += 1
+			continue
+
+		query = _mutation_query(logger, mut)
+		if query is None:
+			fails += 1
+			continue
+
+		batch += [(line_num, line, mut, query)]
+
+	results = []
+	hits = set()
+	if len(batch) > 0:
+		for index, row in db.query_scores_bulk([query for line_num, line, mut, query in batch],
+											   predictors=predictors, maps=maps):
+			line_num, line, mut, query = batch[index]
+			results += [(line_num, line, mut, row)]
+			hits.add(index)
+
+	fails += len(batch) - len(hits)
+
+	return results, len(batch), len(hits), fails
+
+# The database connection and parameters of a worker process
+_worker = None
+
+def _init_worker(open_db, maps, predictors, logger):
+	global _worker
+	_worker = (open_db(), maps, predictors, logger)
+
+def _fetch_worker_chunk(chunk):
+	db, maps, predictors, logger = _worker
+	return _fetch_chunk(db, chunk, maps, predictors, logger)
+
+def _ordered_results(pool, chunks, max_pending):
+	"""
+	Sends the chunks to the workers and yields the results in input order,
+	with at most max_pending chunks read ahead
+	"""
+
+	pending = deque()
+	for chunk in chunks:
+		pending.append(pool.apply_async(_fetch_worker_chunk, (chunk,)))
+		if len(pending) >= max_pending:
+			yield pending.popleft().get()
+
+	while len(pending) > 0:
+		yield pending.popleft().get()
+
+def fetch_iter(db, muts_path, maps=None, predictors=None, muts_header=False, state=None, logger=None,
+			   batch_size=BATCH_SIZE, num_workers=1, open_db=None):
 	"""
 	Iterator that fetches scores from the database from the mutations in a file.
 	
@@ -27,35 +142,18 @@ def fetch_iter(db, muts_path, maps=None, predictors=None, muts_header=False, sta
 	:param muts_header: Whether the muts_path has a header or not.
 	:param state: The state of the iteration: hits, fails.
 	:param logger: Logger to use. If not specified a new one is created.
+	:param batch_size: Number of mutations queried at once with query_scores_bulk.
+	:param num_workers: Number of processes parsing and querying chunks of batch_size mutations.
+	                    The rows are yielded in input order.
+	:param open_db: Function returning a new opened FannsDb, called once by every worker. Required for num_workers > 1.
 	"""
 
-	def query_mutation(logger, db, mut, maps, predictors):
-
-		if mut.coord == Mutation.GENOMIC:
-			if logger.isEnabledFor(logging.DEBUG):
-				logger.debug("  Querying {} {} {} {} {} {} {} ...".format(
-					mut.chr, mut.start, mut.end or "*", mut.ref or "*", mut.alt, mut.strand or "*", mut.identifier or "*"))
-
-			for row in db.query_scores(chr=mut.chr, start=mut.start,
-											ref=mut.ref, alt=mut.alt, strand=mut.strand,
-											predictors=predictors, maps=maps):
-				yield row
-
-		elif mut.coord == Mutation.PROTEIN:
-			if logger.isEnabledFor(logging.DEBUG):
-				logger.debug("  Querying {} {} {} {} {} ...".format(
-					mut.protein, mut.start, mut.ref or "*", mut.alt, mut.identifier or "*"))
-
-			for row in db.query_scores(protein=mut.protein, aa_pos=mut.start, aa_ref=mut.ref, aa_alt=mut.alt,
-											predictors=predictors, maps=maps):
-				yield row
-
-		else:
-			logger.warn("Unknown coordinates system: {}".format(mut.line))
-
 	if logger is None:
 		logger = logging.getLogger("fannsdb.fetch")
 
+	if num_workers > 1 and open_db is None:
+		raise Exception("A function to open the database in every worker is required to fetch with several workers")
+
 	state = state if state is not None else {}
 	state[STATE_HITS] = state[STATE_FAILS] = 0
 	maps = maps if maps is not None else []
@@ -69,40 +167,33 @@ def fetch_iter(db, muts_path, maps=None, predictors=None, muts_header=False, sta
 		if muts_header:
 			tsv.skip_comments_and_empty(f) # this returns the first non empty nor comment line (the header)
 
-		mutparser = DnaAndProtMutationParser()
-		for line_num, line in enumerate(f, start=1):
-			line = line.rstrip(" \n\r")
-			if len(line) == 0 or line.startswith("#"):
-				continue
-
-			try:
-				mut = mutparser.parse(line)
-			except PrematureEnd:
-				logger.error("Missing fields at line {}".format(line_num))
-				state[STATE_FAILS] += 1
-				continue
-			except UnexpectedToken as ex:
-				logger.error("Unexpected field '{}' at line {}".format(ex.args[0], line_num))
-				state[STATE_FAILS] += 1
-				continue
-
-			state.update({
-				STATE_LINE_NUM : line_num,
-				STATE_LINE : line,
-				STATE_MUTATION : mut})
-
-			exists = False
-			for row in query_mutation(logger, db, mut, maps, predictors):
-				exists = True
-
-				yield row
-
-			progress.update()
-
-			if exists:
-				state[STATE_HITS] += 1
-			else:
-				state[STATE_FAILS] += 1
+		chunks = _read_chunks(f, batch_size)
+
+		pool = None
+		if num_workers > 1:
+			pool = mp.Pool(num_workers, initializer=_init_worker, initargs=(open_db, maps, predictors, logger))
+			results = _ordered_results(pool, chunks, num_workers * 2)
+		else:
+			results = (_fetch_chunk(db, chunk, maps, predictors, logger) for chunk in chunks)
+
+		try:
+			for chunk_results, queried, hits, fails in results:
+				for line_num, line, mut, row in chunk_results:
+					state.update({
+						STATE_LINE_NUM : line_num,
+						STATE_LINE : line,
+						STATE_MUTATION : mut})
+
+					yield row
+
+				progress.update(queried)
+
+				state[STATE_HITS] += hits
+				state[STATE_FAILS] += fails
+		finally:
+			if pool is not None:
+				pool.terminate()
+				pool.join()
 
 	progress.log_totals()
 
@@ -111,7 +202,8 @@ def fetch_iter(db, muts_path, maps=None, predictors=None, muts_header=False, sta
 
 
 def fetch(db, muts_path, out_path, params=None, columns=None, maps=None, predictors=None,
-		  labels=None, calc_labels=None, muts_header=False, logger=None):
+		  labels=None, calc_labels=None, muts_header=False, logger=None, batch_size=BATCH_SIZE,
+		  num_workers=1, open_db=None):
 	
 	params = params or {}
 	columns = columns or [c.lower() for c in COORD_COLUMNS]
@@ -133,14 +225,15 @@ def fetch(db, muts_path, out_path, params=None, columns=None, maps=None, predict
 		tsv.write_line(wf, "ID", *[c.upper() for c in columns] + [m.upper() for m in maps] + predictors + labels)
 	
 		for row in fetch_iter(db, muts_path, maps=maps, predictors=predictors,
-							  muts_header=muts_header, state=state, logger=logger):
+							  muts_header=muts_header, state=state, logger=logger, batch_size=batch_size,
+							  num_workers=num_workers, open_db=open_db):
 			
 			if calc_labels is not None:
 				labels = calc_labels(row) or {}
 			else:
 				labels = {}
 	
-			xrefs = row["xrefs"]
+			xrefs = row[db.MAPS_KEY]
 			scores = row["scores"]
 
 			tsv.write_line(wf, state[STATE_MUTATION].identifier,
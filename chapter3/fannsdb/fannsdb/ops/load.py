@@ -0,0 +1,146 @@
+import sys
+import logging
+
+from fannsdb.utils import RatedProgress
+
+# Number of records sent to the database at once
+BATCH_SIZE = 10000
+
+# Number of records loaded between commits
+COMMIT_SIZE = 1000000
+
+def _batches(records, batch_size):
+	batch = []
+	for record in records:
+		batch += [record]
+		if len(batch) >= batch_size:
+			yield batch
+			batch = []
+	if len(batch) > 0:
+		yield batch
+
+def _rollback(db, logger):
+	"""
+	Rolls back the uncommitted records after a failure and returns the exception to raise
+	"""
+
+	exc_info = sys.exc_info()
+	logger.error("Loading failed, the records since the last commit are discarded")
+	db.rollback()
+	return exc_info
+
+def load_snvs(db, snvs, predictors=None, batch_size=BATCH_SIZE, commit_size=COMMIT_SIZE,
+			  create_indices=True, update_predictors=True, logger=None):
+	"""
+	Bulk import of SNVs. The indices are dropped while loading and created at the end.
+	On failure the SNVs since the last commit are discarded and the indices are restored.
+
+	:param db: FannsDb interface.
+	:param snvs: iterable of dictionaries with the add_snv arguments: chr, strand, start, ref, alt, transcript,
+	             protein, aa_pos, aa_ref, aa_alt, scores.
+	:param predictors: The predictors which scores are loaded. They have to exist.
+	:param batch_size: Number of SNVs inserted at once.
+	:param commit_size: Number of SNVs loaded between commits.
+	:param create_indices: Create the indices once loaded.
+	:param update_predictors: Update the predictors statistics once loaded.
+	:param logger: Logger to use. If not specified a new one is created.
+	:return: the number of SNVs loaded
+	"""
+
+	if logger is None:
+		logger = logging.getLogger("fannsdb.load")
+
+	progress = RatedProgress(logger, name="SNVs")
+
+	db.set_bulk_mode(True)
+	indices_dropped = False
+	try:
+		logger.info("Dropping indices ...")
+		db.drop_indices()
+		indices_dropped = True
+
+		logger.info("Loading SNVs ...")
+
+		uncommitted = 0
+		for batch in _batches(snvs, batch_size):
+			count = db.add_snvs(batch, predictors)
+			progress.update(count)
+
+			uncommitted += count
+			if uncommitted >= commit_size:
+				db.commit()
+				uncommitted = 0
+
+		db.commit()
+
+		progress.log_totals()
+
+		if update_predictors:
+			logger.info("Updating predictors ...")
+			db.update_predictors(predictors)
+			db.commit()
+
+		if create_indices:
+			logger.info("Creating indices ...")
+			db.create_indices()
+	except:
+		exc_info = _rollback(db, logger)
+		if indices_dropped:
+			logger.info("Restoring indices ...")
+			db.create_indices()
+		raise exc_info[0], exc_info[1], exc_info[2]
+	finally:
+		db.set_bulk_mode(False)
+
+	return progress.total_count
+
+def load_scores(db, scores, predictors=None, batch_size=BATCH_SIZE, commit_size=COMMIT_SIZE,
+				update_predictors=True, logger=None):
+	"""
+	Bulk merge of scores into existing SNVs, i.e. after adding a new predictor.
+	On failure the scores since the last commit are discarded.
+
+	:param db: FannsDb interface.
+	:param scores: iterable of (row id, {predictor : score}).
+	:param predictors: The predictors to update. They have to exist.
+	:param batch_size: Number of rows merged at once.
+	:param commit_size: Number of rows merged between commits.
+	:param update_predictors: Update the predictors statistics once merged.
+	:param logger: Logger to use. If not specified a new one is created.
+	:return: the number of rows merged
+	"""
+
+	if logger is None:
+		logger = logging.getLogger("fannsdb.load")
+
+	progress = RatedProgress(logger, name="scores")
+
+	db.set_bulk_mode(True)
+	try:
+		logger.info("Merging scores ...")
+
+		uncommitted = 0
+		for batch in _batches(scores, batch_size):
+			db.update_scores_bulk(batch, predictors)
+			progress.update(len(batch))
+
+			uncommitted += len(batch)
+			if uncommitted >= commit_size:
+				db.commit()
+				uncommitted = 0
+
+		db.commit()
+
+		progress.log_totals()
+
+		if update_predictors:
+			logger.info("Updating predictors ...")
+			db.update_predictors(predictors)
+			db.commit()
+	except:
+		exc_info = _rollback(db, logger)
+		raise exc_info[0], exc_info[1], exc_info[2]
+	finally:
+		db.set_bulk_mode(False)
+
+	return progress.total_count
@@ -1,5 +1,6 @@
 import time
 from datetime import timedelta
+from collections import OrderedDict
 
 SUFFIXES = ['K', 'M', 'G', 'T', 'P', 'E', 'Z', 'Y']
 
@@ -53,4 +54,74 @@ class RatedProgress(object):
 
 	@property
 	def elapsed_time(self):
-		return timedelta(seconds=time.time() - self.total_start_time)
\ No newline at end of file
+		return timedelta(seconds=time.time() - self.total_start_time)
+
+class LruCache(object):
+	"""
+	Bounded cache that discards the least recently used values first.
+	The size of every value is given by sizeof and the total size is kept under max_size.
+	"""
+
+	def __init__(self, max_size, sizeof=None):
+		self.max_size = max_size
+		self.sizeof = sizeof or (lambda value: 1)
+
+		self.__items = OrderedDict()
+		self.size = 0
+
+		self.hits = self.misses = self.evictions = 0
+
+	def __len__(self):
+		return len(self.__items)
+
+	def __contains__(self, key):
+		return key in self.__items
+
+	def get(self, key, default=None):
+		try:
+			value, size = self.__items.pop(key)
+		except KeyError:
+			self.misses += 1
+			return default
+
+		# reinserted as the most recently used
+		self.__items[key] = (value, size)
+		self.hits += 1
+		return value
+
+	def put(self, key, value):
+		"""
+		Adds a value discarding the least recently used ones if required.
+		Values bigger than the cache are not added.
+		"""
+
+		if key in self.__items:
+			self.size -= self.__items.pop(key)[1]
+
+		size = self.sizeof(value)
+		if size > self.max_size:
+			return
+
+		self.__items[key] = (value, size)
+		self.size += size
+
+		while self.size > self.max_size:
+			key, (value, size) = self.__items.popitem(last=False)
+			self.size -= size
+			self.evictions += 1
+
+	def clear(self):
+		"""
+		Discards all the values, the statistics are kept
+		"""
+
+		self.__items.clear()
+		self.size = 0
+
+	@property
+	def stats(self):
+		requests = self.hits + self.misses
+		return dict(
+			hits=self.hits, misses=self.misses, evictions=self.evictions,
+			hit_ratio=float(self.hits) / requests if requests > 0 else 0.0,
+			entries=len(self.__items), size=self.size, max_size=self.max_size)
@@ -0,0 +1,506 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import itertools
+import unittest as ut
+from functools import partial
+
+import numpy as np
+import pandas as pd
+from sklearn.metrics import confusion_matrix
+
+try:
+	import mongomock
+except ImportError:
+	mongomock = None
+
+from fannsdb.db.sqlitedb import FannsSQLiteDb, code_ranges
+from fannsdb.db.mongodb import FannsMongoDb
+from fannsdb.db.columnar import FannsColumnarDb
+from fannsdb.ops.columnar import export_columnar
+from fannsdb.ops.fetch import fetch
+from fannsdb.ops.load import load_snvs
+from fannsdb import metrics
+
+# Helpers -------------------------------------------------------------------------------------------------------------
+
+SNVS = [
+	dict(chr="1", strand="+", start=100, ref="A", alt="C", transcript="ENST00001", protein="ENSP00001",
+		 aa_pos=10, aa_ref="K", aa_alt="T", scores=dict(SIFT=0.1, PPH2=0.9)),
+	dict(chr="1", strand="+", start=100, ref="A", alt="G", transcript="ENST00001", protein="ENSP00001",
+		 aa_pos=10, aa_ref="K", aa_alt="E", scores=dict(SIFT=0.2, PPH2=0.8)),
+	dict(chr="1", strand="+", start=100, ref="A", alt="G", transcript="ENST00002", protein="ENSP00002",
+		 aa_pos=25, aa_ref="K", aa_alt="E", scores=dict(SIFT=0.3, PPH2=None)),
+	dict(chr="2", strand="-", start=2000, ref="T", alt="A", transcript="ENST00003", protein="ENSP00003",
+		 aa_pos=300, aa_ref="V", aa_alt="D", scores=dict(SIFT=0.4, PPH2=0.6)),
+	dict(chr="X", strand="+", start=5000, ref="G", alt="T", transcript="ENST00004", protein="ENSP00004",
+		 aa_pos=7, aa_ref="W", aa_alt="C", scores=dict(SIFT=0.5, PPH2=0.5))]
+
+MUTATIONS = [
+	"1\t100\tA\tG",
+	"1\t100\tA\tC",
+	"ENSP00003\tV300D",
+	"2\t2000\tT\tC",
+	"not a mutation",
+	"X\t5000\tG\tT",
+	"ENSP00001\tK10E"]
+
+def create_sqlite_db(path):
+	db = FannsSQLiteDb(path)
+	db.open(create=True)
+	db.add_predictor("SIFT", FannsSQLiteDb.SOURCE_PREDICTOR_TYPE)
+	db.add_predictor("PPH2", FannsSQLiteDb.SOURCE_PREDICTOR_TYPE)
+	db.add_map("symbol", "Symbol", FannsSQLiteDb.TRANSCRIPT_MAP_TYPE)
+	db.add_map_item("symbol", "ENST00001", "GENE1")
+	db.add_map_item("symbol", "ENST00003", "GENE3")
+	db.add_snvs(SNVS, ["SIFT", "PPH2"])
+	db.create_indices()
+	db.set_initialized()
+	db.commit()
+	return db
+
+def open_db(cls, path):
+	db = cls(path)
+	db.open()
+	return db
+
+def read_rows(path):
+	with open(path) as f:
+		return [line.rstrip("\n").split("\t") for line in f if not line.startswith("#")]
+
+# Test fetch ----------------------------------------------------------------------------------------------------------
+
+class FetchTests(ut.TestCase):
+	def setUp(self):
+		self.path = tempfile.mkdtemp(prefix="fannsdb-tests-")
+		self.db_path = os.path.join(self.path, "scores.db")
+		self.db = create_sqlite_db(self.db_path)
+
+		self.muts_path = os.path.join(self.path, "muts.tsv")
+		with open(self.muts_path, "w") as f:
+			f.write("\n".join(MUTATIONS) + "\n")
+
+	def tearDown(self):
+		self.db.close()
+		shutil.rmtree(self.path)
+
+	def fetch(self, db=None, **kwargs):
+		out_path = os.path.join(self.path, "out.tsv")
+		state = fetch(db or self.db, self.muts_path, out_path, columns=["chr", "start", "transcript", "aa_pos"],
+					  maps=["symbol"], predictors=["SIFT", "PPH2"], **kwargs)
+		return state, read_rows(out_path)
+
+	def test_fetch_sqlite(self):
+		state, rows = self.fetch(batch_size=3)
+
+		self.assertEqual(state, dict(hits=5, fails=2))
+		self.assertEqual(rows[0], ["ID", "CHR", "START", "TRANSCRIPT", "AA_POS", "SYMBOL", "SIFT", "PPH2"])
+		self.assertEqual(rows[1:], [
+			["", "1", "100", "ENST00001", "10", "GENE1", "0.2", "0.8"],
+			["", "1", "100", "ENST00002", "25", "", "0.3", ""],
+			["", "1", "100", "ENST00001", "10", "GENE1", "0.1", "0.9"],
+			["", "2", "2000", "ENST00003", "300", "GENE3", "0.4", "0.6"],
+			["", "X", "5000", "ENST00004", "7", "", "0.5", "0.5"],
+			["", "1", "100", "ENST00001", "10", "GENE1", "0.2", "0.8"]])
+
+	def test_fetch_workers_sqlite(self):
+		expected = self.fetch(batch_size=2)
+		self.assertEqual(self.fetch(batch_size=2, num_workers=2, open_db=partial(open_db, FannsSQLiteDb, self.db_path)),
+						 expected)
+
+	def test_fetch_workers_columnar(self):
+		columnar_path = os.path.join(self.path, "scores.columnar")
+		export_columnar(self.db, columnar_path)
+
+		db = open_db(FannsColumnarDb, columnar_path)
+		try:
+			expected = self.fetch(db=db, batch_size=2)
+			self.assertEqual(expected, self.fetch(batch_size=2))
+			self.assertEqual(self.fetch(db=db, batch_size=2, num_workers=2,
+										open_db=partial(open_db, FannsColumnarDb, columnar_path)), expected)
+		finally:
+			db.close()
+
+# Test code ranges ---------------------------------------------------------------------------------------------------
+
+# The amino acid change of every base change of the code ranges fixture
+BASE_AA = dict(A="K", C="T", G="E", T="M")
+
+def code_ranges_snvs():
+	snvs = []
+	for index, (chr, strand, start) in enumerate([("1", "+", 100), ("1", "-", 100), ("1", "+", 101), ("2", "+", 100)]):
+		for ref, alt in itertools.permutations(sorted(BASE_AA), 2):
+			snvs += [dict(chr=chr, strand=strand, start=start, ref=ref, alt=alt,
+						  transcript="ENST1{}".format(index), protein="ENSP1{}".format(index),
+						  aa_pos=start, aa_ref=BASE_AA[ref], aa_alt=BASE_AA[alt], scores=dict(SIFT=0.5))]
+	return snvs
+
+CODE_RANGES_FILTERS = [
+	dict(chr="1", start=100),
+	dict(chr="1", start=100, strand="-"),
+	dict(chr="1", start=100, ref="C"),
+	dict(chr="1", start=100, alt="G"),
+	dict(chr="1", start=100, ref=["A", "G"], alt=["C", "T"]),
+	dict(chr="1", start=100, strand="+", ref=["A", "T"]),
+	dict(chr=["1", "2"], start=100, alt=["A", "T"]),
+	dict(start=100, ref="G", alt="A"),
+	dict(chr="1", start=101, strand=["+", "-"], ref="G", alt=["A", "C", "T"]),
+	dict(chr="1", start=102),
+	dict(protein="ENSP10", aa_pos=100),
+	dict(protein="ENSP10", aa_pos=100, aa_ref="K"),
+	dict(protein="ENSP12", aa_pos=101, aa_alt=["E", "M"]),
+	dict(protein="ENSP11", aa_pos=100, aa_ref=["K", "M"], aa_alt="T"),
+	dict(protein="ENSP10", aa_pos=101)]
+
+CODE_RANGES_FIELDS = ["chr", "strand", "start", "ref", "alt", "protein", "aa_pos", "aa_ref", "aa_alt"]
+
+def filter_snvs(snvs, filters):
+	as_list = lambda value: value if isinstance(value, list) else [value]
+	return sorted(tuple(snv[field] for field in CODE_RANGES_FIELDS) for snv in snvs
+				  if all(snv[key] in as_list(value) for key, value in filters.items()))
+
+class CodeRangesTests(ut.TestCase):
+	def setUp(self):
+		self.path = tempfile.mkdtemp(prefix="fannsdb-tests-")
+		self.snvs = code_ranges_snvs()
+
+		self.db = FannsSQLiteDb(os.path.join(self.path, "scores.db"))
+		self.db.open(create=True)
+		self.db.add_predictor("SIFT", FannsSQLiteDb.SOURCE_PREDICTOR_TYPE)
+		self.db.add_snvs(self.snvs, ["SIFT"])
+		self.db.create_indices()
+		self.db.set_initialized()
+		self.db.commit()
+
+	def tearDown(self):
+		self.db.close()
+		shutil.rmtree(self.path)
+
+	def rows(self, rows):
+		return sorted(tuple(row[field] for field in CODE_RANGES_FIELDS) for row in rows)
+
+	def test_code_ranges(self):
+		subsets = [list(values) for size in range(1, 5) for values in itertools.combinations(range(4), size)]
+		for prefixes in [[0], [16, 32], [64, 16, 48]]:
+			for refs in subsets:
+				for alts in subsets:
+					ranges, ref_mask, alt_mask = code_ranges(prefixes, 2, refs, alts, 4)
+
+					self.assertEqual(ranges, sorted(ranges))
+					self.assertTrue(all(hi < lo for (_, hi), (lo, _) in zip(ranges, ranges[1:])))
+
+					planned = set(code for lo, hi in ranges for code in xrange(lo, hi + 1)
+								  if (ref_mask is None or ref_mask >> (code >> 2 & 3) & 1)
+								  and (alt_mask is None or alt_mask >> (code & 3) & 1))
+					self.assertEqual(planned, set(prefix | ref << 2 | alt
+												  for prefix in prefixes for ref in refs for alt in alts))
+
+	def test_query_scores(self):
+		columnar_path = os.path.join(self.path, "scores.columnar")
+		export_columnar(self.db, columnar_path)
+		columnar = open_db(FannsColumnarDb, columnar_path)
+		try:
+			for filters in CODE_RANGES_FILTERS:
+				expected = filter_snvs(self.snvs, filters)
+				self.assertEqual(self.rows(self.db.query_scores(**filters)), expected, filters)
+				self.assertEqual(self.rows(columnar.query_scores(**filters)), expected, filters)
+		finally:
+			columnar.close()
+
+	def test_query_scores_bulk(self):
+		rows = [[] for filters in CODE_RANGES_FILTERS]
+		for index, row in self.db.query_scores_bulk(CODE_RANGES_FILTERS):
+			rows[index] += [row]
+
+		for filters, query_rows in zip(CODE_RANGES_FILTERS, rows):
+			self.assertEqual(self.rows(query_rows), filter_snvs(self.snvs, filters), filters)
+
+# Test columnar ------------------------------------------------------------------------------------------------------
+
+class ColumnarTests(ut.TestCase):
+	def setUp(self):
+		self.path = tempfile.mkdtemp(prefix="fannsdb-tests-")
+		self.db = create_sqlite_db(os.path.join(self.path, "scores.db"))
+
+		# An SNV without transcript nor protein, its scores can not be represented in single precision
+		self.db.add_snvs([dict(chr="1", strand="+", start=100, ref="A", alt="T", aa_pos=10, aa_ref="K", aa_alt="M",
+							   scores=dict(SIFT=0.123456789012345, PPH2=0.987654321))], ["SIFT", "PPH2"])
+		self.db.update_predictors()
+		self.db.commit()
+
+		self.columnar = self.export()
+
+	def export(self, **kwargs):
+		columnar_path = os.path.join(self.path, "scores-{}.columnar".format(len(os.listdir(self.path))))
+		export_columnar(self.db, columnar_path, **kwargs)
+		return open_db(FannsColumnarDb, columnar_path)
+
+	def tearDown(self):
+		self.columnar.close()
+		self.db.close()
+		shutil.rmtree(self.path)
+
+	def query(self, db, **filters):
+		return sorted((row["id"], row["transcript"], row["protein"])
+					  for row in db.query_scores(predictors=["SIFT", "PPH2"], **filters))
+
+	def test_unknown_names(self):
+		for filters in [
+				dict(chr="1", start=100, transcript="ENST404"),
+				dict(chr="1", start=100, transcript=["ENST404", "UNKNOWN"]),
+				dict(protein="ENSP404", aa_pos=10),
+				dict(protein=["ENSP404"], aa_pos=10)]:
+			self.assertEqual(self.query(self.columnar, **filters), [])
+			self.assertEqual(self.query(self.db, **filters), [])
+
+		filters = dict(chr="1", start=100, transcript=["ENST404", "ENST00002"])
+		self.assertEqual(self.query(self.columnar, **filters), self.query(self.db, **filters))
+		self.assertEqual(len(self.query(self.columnar, **filters)), 1)
+
+	def test_null_names(self):
+		# The rows without transcript nor protein are returned, with None names
+		for db in [self.db, self.columnar]:
+			self.assertEqual(self.query(db, chr="1", start=100, alt="T"), [(6, None, None)])
+			self.assertEqual(self.query(db, protein="ENSP00001", aa_pos=10), [(1, "ENST00001", "ENSP00001"),
+																			  (2, "ENST00001", "ENSP00001")])
+			self.assertEqual(sorted(row["id"] for row in db.query_scores(fields=["transcript"], chr="1", start=100)),
+							 [1, 2, 3, 6])
+
+	def scores(self, db, **filters):
+		return sorted((row["id"], row["scores"]) for row in db.query_scores(predictors=["SIFT", "PPH2"], **filters))
+
+	def stats(self, db):
+		return [(p["id"], p["min"], p["max"], p["count"]) for p in db.predictors()]
+
+	def test_scores(self):
+		for filters in [dict(chr="1", start=100), dict(chr="2", start=2000), dict(protein="ENSP00001", aa_pos=10)]:
+			self.assertEqual(self.scores(self.columnar, **filters), self.scores(self.db, **filters))
+
+		self.assertEqual(self.scores(self.columnar, chr="1", start=100, alt="T"),
+						 [(6, dict(SIFT=0.123456789012345, PPH2=0.987654321))])
+		self.assertEqual(self.stats(self.columnar), self.stats(self.db))
+
+	def test_single_precision_scores(self):
+		columnar = self.export(single_precision=True)
+		try:
+			self.assertEqual(self.scores(columnar, chr="1", start=100, alt="T"),
+							 [(6, dict(SIFT=0.12345679, PPH2=0.9876543))])
+			self.assertEqual(self.stats(columnar), [("SIFT", 0.1, 0.5, 6), ("PPH2", 0.5, 0.9876543, 5)])
+		finally:
+			columnar.close()
+
+# Test query cache ---------------------------------------------------------------------------------------------------
+
+class QueryCacheTests(ut.TestCase):
+	def setUp(self):
+		self.path = tempfile.mkdtemp(prefix="fannsdb-tests-")
+		self.db_path = os.path.join(self.path, "scores.db")
+		create_sqlite_db(self.db_path).close()
+
+		self.db = FannsSQLiteDb(self.db_path, query_cache_size=100)
+		self.db.open()
+
+	def tearDown(self):
+		self.db.close()
+		shutil.rmtree(self.path)
+
+	def query(self, db=None):
+		return sorted((row["alt"], row["scores"]["SIFT"])
+					  for row in (db or self.db).query_scores(predictors=["SIFT"], chr="1", start=100, transcript="ENST00001"))
+
+	def hits(self):
+		return self.db.cache_stats()["queries"]["hits"]
+
+	def test_disabled_by_default(self):
+		db = open_db(FannsSQLiteDb, self.db_path)
+		try:
+			self.assertEqual(self.query(db), self.query(db))
+			self.assertEqual(db.cache_stats()["queries"]["entries"], 0)
+		finally:
+			db.close()
+
+	def test_invalidation(self):
+		expected = [("C", 0.1), ("G", 0.2)]
+		self.assertEqual(self.query(), expected)
+		self.assertEqual(self.query(), expected)
+		self.assertEqual(self.hits(), 1)
+
+		self.db.add_snvs([dict(SNVS[0], alt="T", aa_alt="M", scores=dict(SIFT=0.6))], ["SIFT"])
+		expected += [("T", 0.6)]
+		self.assertEqual(self.query(), expected)
+
+		rowid = self.db.query_scores(chr="1", start=100, alt="T").next()["id"]
+		self.db.update_scores(rowid, dict(SIFT=0.8))
+		expected[-1] = ("T", 0.8)
+		self.assertEqual(self.query(), expected)
+
+		self.db.rollback()
+		self.assertEqual(self.query(), expected[:2])
+		self.assertEqual(self.query(), expected[:2])
+		self.assertEqual(self.hits(), 2)
+
+# Test load -----------------------------------------------------------------------------------------------------------
+
+class LoadTests(ut.TestCase):
+	def setUp(self):
+		self.path = tempfile.mkdtemp(prefix="fannsdb-tests-")
+		self.db_path = os.path.join(self.path, "scores.db")
+		self.db = create_sqlite_db(self.db_path)
+
+	def tearDown(self):
+		self.db.close()
+		shutil.rmtree(self.path)
+
+	def snvs(self, starts):
+		return [dict(chr="3", strand="+", start=start, ref="A", alt="C", transcript="ENST00005", protein="ENSP00005",
+					 aa_pos=start, aa_ref="K", aa_alt="T", scores=dict(SIFT=0.5)) for start in starts]
+
+	def indices(self):
+		conn = sqlite3.connect(self.db_path)
+		try:
+			return sorted(name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'"
+														 " AND tbl_name = 'scores'"))
+		finally:
+			conn.close()
+
+	def test_load(self):
+		self.assertEqual(load_snvs(self.db, self.snvs(range(1, 11)), ["SIFT"], batch_size=3), 10)
+		self.assertEqual(self.db.count_scores(), len(SNVS) + 10)
+		self.assertEqual(self.indices(), ["scores_by_dna", "scores_by_prot"])
+
+	def test_load_failure_rolls_back(self):
+		snvs = self.snvs(range(1, 6)) + [dict(self.snvs([6])[0], ref="Z")]
+		self.assertRaises(Exception, load_snvs, self.db, snvs, ["SIFT"], batch_size=2)
+		self.assertEqual(self.db.count_scores(), len(SNVS))
+		self.assertEqual(self.indices(), ["scores_by_dna", "scores_by_prot"])
+
+		# The ids of the transcript and protein rolled back are given again
+		other = dict(self.snvs([20])[0], transcript="ENSTB", protein="ENSPB")
+		self.assertEqual(load_snvs(self.db, [other] + self.snvs([21]), ["SIFT"]), 2)
+		self.assertEqual([(row["transcript"], row["protein"]) for start in [20, 21]
+						  for row in self.db.query_scores(chr="3", start=start)],
+						 [("ENSTB", "ENSPB"), ("ENST00005", "ENSP00005")])
+
+	def test_load_duplicates(self):
+		self.assertRaises(Exception, load_snvs, self.db, self.snvs([1, 2]) + [SNVS[0]], ["SIFT"])
+		self.assertEqual(self.db.count_scores(), len(SNVS))
+		self.assertRaises(Exception, load_snvs, self.db, self.snvs([1, 2, 1]), ["SIFT"], batch_size=2)
+		self.assertEqual(self.db.count_scores(), len(SNVS))
+		self.assertEqual(self.indices(), ["scores_by_dna", "scores_by_prot"])
+
+# Test mongodb --------------------------------------------------------------------------------------------------------
+
+@ut.skipIf(mongomock is None, "mongomock is not installed")
+class MongoDbTests(ut.TestCase):
+	def setUp(self):
+		self.db = FannsMongoDb(conn=mongomock.MongoClient())
+		self.db.add_map("symbol", "Symbol", FannsMongoDb.TRANSCRIPT_MAP_TYPE, priority=1)
+		self.db.add_map_item("symbol", "ENST00001", "GENE1")
+		self.db.add_map_item("symbol", "ENST00002", "GENE1")
+		self.db.add_map_item("symbol", "ENST00003", "GENE3")
+
+	def test_add_snvs(self):
+		self.assertEqual(self.db.add_snvs([]), 0)
+		self.assertEqual(self.db.add_snvs(SNVS, ["SIFT"]), len(SNVS))
+
+		d = self.db._db.scores.find_one({"g.t" : "ENST00003"})
+		self.assertEqual(d["g"], dict(c="2", d="-", s=2000, r="T", a="A", t="ENST00003"))
+		self.assertEqual(d["p"], dict(n="ENSP00003", p=300, r="V", a="D"))
+		self.assertEqual(d["s"], dict(SIFT=0.4))
+
+	def test_update_scores_bulk(self):
+		self.db.add_snvs(SNVS)
+		ids = [d["_id"] for d in self.db._db.scores.find({"g.s" : 100}, {"_id" : 1})]
+
+		self.assertEqual(self.db.update_scores_bulk([]), 0)
+		self.assertEqual(self.db.update_scores_bulk([(docid, dict(MA=1.5, SIFT=0.0)) for docid in ids], ["MA"]), 3)
+		self.assertEqual(self.db.update_scores_bulk([(ids[0], dict(SIFT=0.7))], ["SIFT", "PPH2"]), 1)
+
+		scores = [d["s"] for d in self.db._db.scores.find({"g.s" : 100}, sort=[("_id", 1)])]
+		self.assertEqual(scores[0], dict(SIFT=0.7, PPH2=None, MA=1.5))
+		self.assertEqual([s["MA"] for s in scores], [1.5] * 3)
+		self.assertEqual(scores[1]["SIFT"], 0.2)
+
+	def test_query_scores_bulk(self):
+		self.db.add_snvs(SNVS)
+
+		queries = [
+			dict(chr="1", start=100, ref="A", alt="G", strand="+"),
+			dict(chr="1", start=100, alt="C"),
+			dict(start=100, ref="A"),
+			dict(chr="1", start=100, transcript="GENE1"),
+			dict(chr="1", start=100, transcript="ENST00002"),
+			dict(chr="2", start=2000, strand="+"),
+			dict(chr="X", start=5000, ref=None, alt=None),
+			dict(chr="1", start=101),
+			dict(chr="1", start=100, transcript="UNKNOWN"),
+			dict(protein="ENSP00001", aa_pos=10, aa_alt="E"),
+			dict(protein="ENSP00003", aa_pos=300),
+			dict(protein="ENSP00003", aa_pos=301),
+			dict(transcript="GENE3"),
+			dict(chr="1", start=100, alt=["C", "G"])]
+
+		predictors = ["SIFT", "PPH2", "MA"]
+		expected = [(index, row) for index, filters in enumerate(queries)
+					for row in self.db.query_scores(predictors=predictors, maps=["symbol"], **filters)]
+
+		rows = list(self.db.query_scores_bulk(queries, predictors=predictors, maps=["symbol"], chunk_size=1))
+
+		self.assertEqual([index for index, row in rows], sorted(index for index, row in expected))
+		key = lambda (index, row): (index, row["id"])
+		self.assertEqual(sorted(rows, key=key), sorted(expected, key=key))
+		self.assertEqual([len([i for i, row in rows if i == index]) for index in range(6)], [2, 1, 3, 3, 1, 0])
+
+# Test metrics -------------------------------------------------------------------------------------------------------
+
+def reference_perf(y_true, tset, cutoffs, scores):
+	"""
+	Calculates the scores with a confusion matrix for every cutoff
+	"""
+
+	perf = np.zeros((len(cutoffs), len(scores)))
+	for i, cutoff in enumerate(cutoffs):
+		y_pred = np.array(tset >= cutoff, dtype=np.int8)
+		cm = confusion_matrix(y_true, y_pred)
+		tp, fp, fn, tn = cm[0, 0], cm[0, 1], cm[1, 0], cm[1, 1]
+		for j, score in enumerate(scores):
+			with np.errstate(divide="ignore", invalid="ignore"):
+				v = metrics.score_fn[score](y_true, y_pred, tp, fp, fn, tn)
+			perf[i, j] = v if np.isfinite(v) else 0.0
+	return perf
+
+class MetricsTests(ut.TestCase):
+	def setUp(self):
+		# Rounded values have ties at the cutoffs
+		rs = np.random.RandomState(3)
+		self.pos = pd.Series(rs.beta(4, 2, 12).round(2))
+		self.neg = pd.Series(rs.beta(2, 4, 1000).round(2))
+		self.cutoffs = np.linspace(-0.1, 1.1, 25).round(2)
+		self.scores = sorted(metrics.score_fn.keys())
+
+	def test_balanced_perf(self):
+		perf, roc, auc_value = metrics.balanced_perf(self.pos, self.neg, self.cutoffs, self.scores)
+
+		y_true = np.array([1] * len(self.pos) + [0] * len(self.neg), dtype=np.int8)
+		tset = pd.concat([self.pos, self.neg])
+		self.assertEqual(list(perf.columns), self.scores)
+		np.testing.assert_allclose(perf.values, reference_perf(y_true, tset, self.cutoffs, self.scores), rtol=1e-12)
+
+	def test_undersampling_cores(self):
+		# The samples are split into several tasks
+		self.assertTrue(len(self.neg) // len(self.pos) > metrics.SAMPLES_PER_TASK)
+
+		perf, roc, auc_value = metrics.undersampling_perf(self.pos, self.neg, self.cutoffs, self.scores,
+														  num_cores=1, seed=5)
+		cores_perf, cores_roc, cores_auc = metrics.undersampling_perf(self.pos, self.neg, self.cutoffs, self.scores,
+																	  num_cores=3, seed=5)
+		np.testing.assert_array_equal(cores_perf.values, perf.values)
+		np.testing.assert_array_equal(cores_roc.values, roc.values)
+		self.assertEqual(cores_auc, auc_value)
+
+		other_perf = metrics.undersampling_perf(self.pos, self.neg, self.cutoffs, self.scores, seed=6)[0]
+		self.assertFalse(np.array_equal(other_perf.values, perf.values))
+
+if __name__ == "__main__":
+	ut.main()